@@ -1,11 +1,20 @@
 from dataclasses import dataclass
-from typing import Dict, Callable, Optional, List, Tuple, Union
+from typing import Dict, Callable, Optional, List, Tuple, Union, TYPE_CHECKING
 
 import redis
 from galileo.shell.shell import RoutingTableHelper, Galileo, Telemd, Experiment
+from galileodb.model import RequestTrace
 from kubernetes import client
 
 from galileoexperiments.api.profiling import ProfilingApplication
+from galileoexperiments.utils.arrivalprofile import default_upload_concurrency, Profile
+from galileoexperiments.utils.barriers import default_setup_timeout, default_drain_quiet_period, default_drain_timeout
+
+if TYPE_CHECKING:
+    # the weights and podpool modules depend on this one
+    from galileoexperiments.utils.weights import WeightPolicy
+    from galileoexperiments.utils.podpool import PodPool
+    from galileoexperiments.utils.latency import LatencyAggregator
 
 
 @dataclass
@@ -14,6 +23,8 @@ class Pod:
     ip: str
     labels: Dict[str, str]
     name: str
+    # the node the pod is scheduled on
+    node: str = None
 
 
 @dataclass
@@ -25,6 +36,21 @@ class ExperimentRunConfiguration:
     # arbitrary Dict that will be saved with the Experiment
     metadata: Optional[Dict] = None
     exp_name: str = None
+    # started right before and stopped right after the requests, objects with `start()` and `stop()`
+    # (e.g., a `ReweightingController`)
+    controllers: List[object] = None
+    # max. seconds each setup step (e.g., worker discovery) may take
+    setup_timeout: float = default_setup_timeout
+    # after the requests, traces are drained until none arrived for this many seconds (at most `drain_timeout`)
+    drain_quiet_period: float = default_drain_quiet_period
+    drain_timeout: float = default_drain_timeout
+    # if False, the telemd-kubernetes-adapter is expected to run already and is neither started nor stopped
+    manage_adapter: bool = True
+    # if False, workers are expected to be discovered and tracing to be started already, both are left as they are
+    manage_workers: bool = True
+    # optional live aggregation of the latencies, runs from the start of the recorder until the traces are drained,
+    # its summary is published as `latency` event and added to the stored metadata of the experiment
+    latency_aggregator: 'LatencyAggregator' = None
 
     @property
     def galileo(self) -> Galileo:
@@ -47,6 +73,37 @@ class ExperimentRunConfiguration:
         return self.galileo_context['rds']
 
 
+@dataclass
+class EarlyStoppingConfiguration:
+    """
+    Ends a profiling run as soon as its estimates are precise enough, or aborts it on an SLO breach or error spike,
+    see `galileoexperiments.utils.earlystop`.
+    """
+    # stop once the confidence intervals of throughput and latency quantile are at most this wide (relative half-width)
+    precision: float = 0.05
+    confidence: float = 0.95
+    # the latency quantile whose confidence interval is tracked and that is compared with the SLO
+    quantile: float = 0.99
+    # seconds at the beginning of the run that are not part of the estimates (e.g., cold starts)
+    warmup: float = 0
+    # min. number of windows (of `LatencyAggregator.resolution` seconds) before the estimates are checked
+    min_windows: int = 10
+    # windows are merged into batches of at least this many requests, so the quantile of a batch is not just its
+    # maximum. If None, ceil(100 / (1 - quantile)), i.e., 100 requests above the quantile
+    batch_requests: int = None
+    # min. number of batches before the estimates are checked
+    min_batches: int = 5
+    # seconds between two checks
+    check_interval: float = 1
+    # abort if the latency quantile of the last `breach_window` seconds exceeds this many seconds, None disables it
+    slo: float = None
+    # abort if the ratio of failed requests of the last `breach_window` seconds exceeds this, None disables it
+    max_error_rate: float = None
+    breach_window: float = 5
+    # min. number of requests in the last `breach_window` seconds before SLO and error rate are checked
+    min_requests: int = 100
+
+
 @dataclass
 class ProfilingWorkloadConfiguration:
     """
@@ -72,8 +129,8 @@ class ProfilingWorkloadConfiguration:
     profiling_app: ProfilingApplication
     # context contains all dependencies, instantiated using `galileo.shell.shell.init`
     context: Dict
-    # list of profiles - one per client
-    profiles: List[str] = None
+    # list of profiles (paths or `ProfileSource`, e.g., synthetic profiles) - one per client
+    profiles: List[Profile] = None
     # number of requests
     n: int = None
     # interarrival config
@@ -82,6 +139,26 @@ class ProfilingWorkloadConfiguration:
     n_clients: int = None
     # optional load balancer ip, if None, will be read dynamically based on given zone
     lb_ip: str = None
+    # max. number of profiles uploaded concurrently
+    upload_concurrency: int = default_upload_concurrency
+    # if set, profiles are fed in windows of this many inter-arrivals instead of being uploaded before the run
+    profile_window: int = None
+    # optional check whether a load balancer applied the weights (lb pod, function, weights) -> bool, without it
+    # the requests start a fixed delay after the etcd commit
+    weight_probe: Callable[[Pod, str, Dict], bool] = None
+    # if True, teardown blocks until the pods of the run are gone, so the next run can start right away
+    wait_for_teardown: bool = True
+    # if True, workers, tracing and the telemd-kubernetes-adapter are managed by the caller, e.g., when several
+    # workloads run in parallel (see `run_parallel_profiling_workloads`)
+    shared_setup: bool = False
+    # optional pool of warm pods, if None, pods are spawned for the run and removed afterwards (cold start)
+    pod_pool: 'PodPool' = None
+    # optional live aggregation of the latencies (see `ExperimentRunConfiguration.latency_aggregator`), clients are
+    # labeled with zone and application name. Must not be shared by workloads that run in parallel
+    latency_aggregator: 'LatencyAggregator' = None
+    # if set, the requests end as soon as the estimates converged, or on an SLO breach or error spike, instead of
+    # after `n` requests or the whole profile. A latency aggregator is created if none is set
+    early_stopping: EarlyStoppingConfiguration = None
 
     @property
     def galileo(self) -> Galileo:
@@ -136,8 +213,27 @@ class ScenarioWorkloadConfiguration:
     # context contains all dependencies, instantiated using `galileo.shell.shell.init`
     context: Dict
 
-    # per zone: {image: list of profiles - one per client}
-    profiles: Dict[str, Dict[str, List[str]]]
+    # per zone: {image: list of profiles (paths or `ProfileSource`) - one per client}
+    profiles: Dict[str, Dict[str, List[Profile]]]
+
+    # the following options behave like those of `ProfilingWorkloadConfiguration`, applied to all zones and images
+    upload_concurrency: int = default_upload_concurrency
+    profile_window: int = None
+    # probed for the load balancer of every zone
+    weight_probe: Callable[[Pod, str, Dict], bool] = None
+    wait_for_teardown: bool = True
+    # decides the load balancer weights of pods and zones, round robin if None
+    weight_policy: 'WeightPolicy' = None
+    # if set, the weights are adapted every this many seconds during the experiment, see `ReweightingController`
+    reweight_interval: float = None
+    # returns the address of the pod that served the request of a trace, used to attribute latencies when reweighting
+    # (the `server` of a trace is the load balancer). If None, it is read from the response header the go-load-balancer
+    # sets, see `reweighting.header_target`
+    trace_target: Callable[[RequestTrace], str] = None
+    # pods of every node and image are acquired from it
+    pod_pool: 'PodPool' = None
+    # clients are labeled with their zone and function
+    latency_aggregator: 'LatencyAggregator' = None
 
     @property
     def galileo(self) -> Galileo:
@@ -182,6 +278,10 @@ class ProfilingExperimentConfiguration:
     n_clients: int
     app_workload_config: AppWorkloadConfiguration
     exp_run_config: ExperimentRunConfiguration
+    # taken over from the `ProfilingWorkloadConfiguration` of the run
+    weight_probe: Callable[[Pod, str, Dict], bool] = None
+    wait_for_teardown: bool = True
+    pod_pool: 'PodPool' = None
 
     @property
     def rtbl(self) -> RoutingTableHelper:
@@ -193,3 +293,14 @@ class ScenarioExperimentConfiguration:
     # apps per (function, zone)
     apps: List[AppWorkloadConfiguration]
     exp_run_config: ExperimentRunConfiguration
+
+
+@dataclass
+class ProfilingCampaignConfiguration:
+    """
+    A series of profiling experiments that share their infrastructure, see `experiment.campaign.run`.
+    """
+    # values of all parameters that are not part of the matrix
+    base: ProfilingWorkloadConfiguration
+    # field names of `ProfilingWorkloadConfiguration` with the values to sweep, every combination is run once
+    matrix: Dict[str, List]
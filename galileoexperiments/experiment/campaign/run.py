@@ -0,0 +1,281 @@
+import copy
+import dataclasses
+import itertools
+import json
+import logging
+import time
+from typing import List, Dict, Tuple, Optional
+
+from galileo.shell.shell import ClientGroup
+
+from galileoexperiments.api.model import ProfilingCampaignConfiguration, ProfilingWorkloadConfiguration, Pod, \
+    ExperimentRunConfiguration, AppWorkloadConfiguration, ProfilingExperimentConfiguration
+from galileoexperiments.api.profiling import GalileoClientGroupConfig
+from galileoexperiments.experiment.profiling.run import _run, _requests, _label_clients
+from galileoexperiments.experiment.scenario.run import set_loadbalancer_weights
+from galileoexperiments.utils.arrivalprofile import profile_metadata
+from galileoexperiments.utils.barriers import wait_for_clients, default_setup_timeout, discover_workers, \
+    start_tracing
+from galileoexperiments.utils.constants import function_label, zone_label, run_label
+from galileoexperiments.utils.helpers import WeightWriter
+from galileoexperiments.utils.k8s import spawn_pods, get_pods, new_run_id, remove_pods_by_label, \
+    start_telemd_kubernetes_adapter, stop_telemd_kubernetes_adapter
+from galileoexperiments.utils.latency import LatencyAggregator
+from galileoexperiments.utils.rds import wait_for_galileo_events
+from galileoexperiments.utils.teardown import Teardown
+from galileoexperiments.utils.timing import Timer, span
+from galileoexperiments.utils.topology import get_topology
+
+logger = logging.getLogger(__name__)
+
+
+def _n_clients(config: ProfilingWorkloadConfiguration) -> int:
+    return len(config.profiles) if config.profiles is not None else config.n_clients
+
+
+def _pod_key(config: ProfilingWorkloadConfiguration) -> Tuple:
+    return config.app_name, config.image, config.host, config.zone, config.no_pods
+
+
+def _client_group_key(config: ProfilingWorkloadConfiguration) -> Tuple:
+    params = {key: value for key, value in config.params.items() if key != 'exp'}
+    return config.app_name, config.zone, _n_clients(config), json.dumps(params, sort_keys=True, default=str)
+
+
+def expand_matrix(base: ProfilingWorkloadConfiguration,
+                  matrix: Dict[str, List]) -> List[ProfilingWorkloadConfiguration]:
+    """
+    Creates one workload configuration for each combination of the matrix values.
+    The configurations are ordered so that runs which can share pods and client groups follow each other.
+    """
+    fields = list(matrix.keys())
+    configs = []
+    for values in itertools.product(*[matrix[f] for f in fields]):
+        config = dataclasses.replace(base, **dict(zip(fields, values)))
+        config.params = copy.deepcopy(base.params)
+        configs.append(config)
+    return sorted(configs, key=lambda c: [str(v) for v in _pod_key(c) + _client_group_key(c)])
+
+
+class WarmInfrastructure:
+    """
+    Infrastructure shared by the runs of a campaign: workers are discovered and tracing is started once, the
+    telemd-kubernetes-adapter runs during the whole campaign, pods are only replaced if a run needs a different image,
+    host, zone or number of pods, and client groups are reused by all runs with the same number of clients (and
+    parameters). After a failed run, `discard` removes pods and client groups, so the next run gets new ones.
+    """
+
+    def __init__(self, master_node: str, context: Dict, wait_for_teardown: bool = True):
+        self.master_node = master_node
+        self.context = context
+        self.wait_for_teardown = wait_for_teardown
+        self._pod_key: Optional[Tuple] = None
+        self._pod_selector: Optional[str] = None
+        self._pods: List[Pod] = []
+        self._weight_keys: List[str] = []
+        self._client_groups: Dict[Tuple, ClientGroup] = {}
+        self._adapter_started = False
+        self._tracing = False
+
+    def start(self, timeout: float = default_setup_timeout):
+        # discovery resets the registrations of the clients of a worker, it must not run while client groups exist
+        galileo = self.context['g']
+        with span('discover_workers'):
+            workers = discover_workers(galileo, timeout)
+        logger.info(f"Discovered workers: {workers}")
+        with span('start_tracing'):
+            start_tracing(galileo, workers, timeout)
+            self._tracing = True
+        with span('start_telemd_adapter'):
+            start_telemd_kubernetes_adapter(self.master_node)
+            self._adapter_started = True
+            logger.info("Waiting for telemd_kubernetes adapter to publish galileo events")
+            wait_for_galileo_events(self.context['rds'], timeout)
+
+    def _remove_pods(self, teardown: Teardown):
+        if self._pod_selector is not None:
+            teardown.add('remove_pods', remove_pods_by_label, self._pod_selector, wait=self.wait_for_teardown)
+        if len(self._weight_keys) > 0:
+            teardown.add('remove_weights', WeightWriter().remove, self._weight_keys)
+        self._pod_key = None
+        self._pod_selector = None
+        self._pods = []
+        self._weight_keys = []
+
+    def pods(self, config: ProfilingWorkloadConfiguration) -> List[Pod]:
+        """
+        :return: the pods for the run, spawned only if the previous run used different ones
+        """
+        key = _pod_key(config)
+        if key == self._pod_key:
+            logger.info(f'Reuse {len(self._pods)} pod(s) of {config.app_name} on {config.host}')
+            return self._pods
+
+        teardown = Teardown()
+        self._remove_pods(teardown)
+        teardown.run()
+
+        pod_set_id = new_run_id()
+        selector = f'{run_label}={pod_set_id}'
+        labels = {
+            function_label: config.app_name,
+            zone_label: config.zone,
+            run_label: pod_set_id
+        }
+        lb_pods = get_topology().load_balancers()
+        env_vars = {
+            'API_GATEWAY': lb_pods[config.zone].ip
+        }
+        self._pod_selector = selector
+        pod_names = spawn_pods(config.image, f'{config.app_name}-deployment', config.host, labels, config.no_pods,
+                               config.profiling_app.pod_factory, env_vars)
+        pods = get_pods(pod_names, label_selector=selector)
+        self._weight_keys = set_loadbalancer_weights({(config.app_name, config.zone): pods}, lb_pods,
+                                                     config.weight_probe)
+        self._pod_key = key
+        self._pods = pods
+        return pods
+
+    def client_group(self, config: ProfilingWorkloadConfiguration) -> ClientGroup:
+        """
+        :return: a client group for the run, spawned only if no previous run used the same shape
+        """
+        key = _client_group_key(config)
+        group = self._client_groups.get(key)
+        if group is not None:
+            logger.info(f'Reuse client group with {len(group.clients)} client(s)')
+            return group
+        n_clients = _n_clients(config)
+        client_group_config = GalileoClientGroupConfig(
+            n_clients=n_clients,
+            zone=config.zone,
+            fn_name=config.app_name,
+            params=config.params
+        )
+        with span('spawn_clients'):
+            group = config.profiling_app.spawn_group(n_clients, config.rds, config.galileo, client_group_config)
+            wait_for_clients(group)
+        self._client_groups[key] = group
+        return group
+
+    def _close_client_groups(self, teardown: Teardown):
+        for i, group in enumerate(self._client_groups.values()):
+            teardown.add(f'close_client_group/{i}', group.close)
+        self._client_groups = {}
+
+    def discard(self):
+        """
+        Removes the pods and closes the client groups, e.g., because a failed run may have left them in an unknown
+        state.
+        """
+        teardown = Teardown()
+        self._remove_pods(teardown)
+        self._close_client_groups(teardown)
+        teardown.run()
+
+    def close(self):
+        teardown = Teardown()
+        self._remove_pods(teardown)
+        self._close_client_groups(teardown)
+        if self._adapter_started:
+            teardown.add('stop_telemd_adapter', stop_telemd_kubernetes_adapter)
+            self._adapter_started = False
+        if self._tracing:
+            teardown.add('stop_tracing', self.context['g'].stop_tracing)
+            self._tracing = False
+        teardown.run()
+
+
+def _run_campaign_experiment(config: ProfilingWorkloadConfiguration, infra: WarmInfrastructure) -> str:
+    params = config.params
+    if params.get('exp') is None or params['exp'].get('requests') is None:
+        params['exp'] = {
+            'requests': {}
+        }
+    n_clients = _n_clients(config)
+    requests_params = params['exp']['requests']
+    requests_params['n_clients'] = n_clients
+    requests_params['no_pods'] = config.no_pods
+
+    if config.early_stopping is not None and config.latency_aggregator is None:
+        config.latency_aggregator = LatencyAggregator(config.rds)
+
+    with span('lb_discovery'):
+        lb_ip = config.lb_ip if config.lb_ip is not None else get_topology().load_balancers()[config.zone].ip
+
+    infra.pods(config)
+    client_group = infra.client_group(config)
+    params['exp']['clients'] = [c.client_id for c in client_group.clients]
+    _label_clients(config)
+
+    if config.profiles is not None:
+        requests_params['profiles'] = [profile_metadata(p) for p in config.profiles]
+    else:
+        requests_params['n'] = config.n
+        requests_params['ia'] = config.ia
+    # client groups are closed with the infrastructure
+    requests = _requests(config, client_group, close=False)
+
+    params['exp']['run_id'] = new_run_id()
+    params['exp']['host'] = config.host
+    params['exp']['zone'] = config.zone
+    params['exp']['app_name'] = config.app_name
+    params['exp']['app_container_image'] = config.image
+
+    exp_run_config = ExperimentRunConfiguration(
+        creator=config.creator,
+        master_node=config.master_node,
+        galileo_context=config.context,
+        metadata=params,
+        exp_name=f'{config.app_name}-clients-{n_clients}-{int(time.time())}',
+        manage_adapter=False,
+        manage_workers=False,
+        latency_aggregator=config.latency_aggregator
+    )
+    experiment_config = ProfilingExperimentConfiguration(
+        app_name=config.app_name,
+        zone=config.zone,
+        host=config.host,
+        lb_ip=lb_ip,
+        no_pods=config.no_pods,
+        n_clients=n_clients,
+        app_workload_config=AppWorkloadConfiguration(
+            app_container_image=config.image,
+            pod_factory=config.profiling_app.pod_factory,
+            requests=requests
+        ),
+        exp_run_config=exp_run_config
+    )
+    logger.info(f'run: {params}')
+    with span('experiment'):
+        succeeded = _run(experiment_config)
+    if not succeeded:
+        raise RuntimeError(f'Experiment {exp_run_config.exp_name} failed')
+    return exp_run_config.exp_name
+
+
+def run_profiling_campaign(campaign: ProfilingCampaignConfiguration) -> List[str]:
+    """
+    Runs a profiling experiment for every combination of the campaign matrix, back to back.
+    Every run is recorded as its own experiment, but runs share the telemd-kubernetes-adapter, pods and client groups
+    wherever their configuration allows it. Pods and client groups of a failed run are not reused.
+    :return: the names of the experiments that succeeded
+    """
+    configs = expand_matrix(campaign.base, campaign.matrix)
+    infra = WarmInfrastructure(campaign.base.master_node, campaign.base.context, campaign.base.wait_for_teardown)
+    names = []
+    try:
+        infra.start()
+        for i, config in enumerate(configs):
+            logger.info(f'Start run {i + 1}/{len(configs)} of campaign')
+            timer = Timer().start()
+            try:
+                names.append(_run_campaign_experiment(config, infra))
+            except Exception as e:
+                logger.error(f'Run {i + 1} failed: {e}')
+                infra.discard()
+            finally:
+                timer.finish()
+    finally:
+        infra.close()
+    return names
@@ -1,17 +1,30 @@
+import copy
+import dataclasses
 import logging
+import threading
 import time
+from typing import List, Set, Dict, Tuple, Callable
 
-from galileo.shell.shell import RoutingTableHelper, Galileo
+from galileo.shell.shell import RoutingTableHelper, Galileo, Experiment, ClientGroup
 
 from galileoexperiments.api.model import ProfilingWorkloadConfiguration, \
     ExperimentRunConfiguration, AppWorkloadConfiguration, ProfilingExperimentConfiguration
 from galileoexperiments.api.profiling import GalileoClientGroupConfig
 from galileoexperiments.experiment.run import run_profiling_experiment
 from galileoexperiments.experiment.scenario.run import set_loadbalancer_weights
-from galileoexperiments.utils.arrivalprofile import clear_list, read_and_save_profile
-from galileoexperiments.utils.constants import function_label, zone_label
-from galileoexperiments.utils.helpers import set_weights_rr, EtcdClient
-from galileoexperiments.utils.k8s import spawn_pods, get_pods, remove_pods, get_load_balancer_pods
+from galileoexperiments.utils.arrivalprofile import upload_profiles, profile_metadata
+from galileoexperiments.utils.barriers import wait_for_clients, discover_workers, start_tracing, default_setup_timeout
+from galileoexperiments.utils.constants import function_label, zone_label, run_label
+from galileoexperiments.utils.earlystop import EarlyStopper, stop_reason_event
+from galileoexperiments.utils.helpers import WeightWriter
+from galileoexperiments.utils.k8s import spawn_pods, get_pods, new_run_id, \
+    remove_pods_by_label, start_telemd_kubernetes_adapter, stop_telemd_kubernetes_adapter
+from galileoexperiments.utils.latency import LatencyAggregator
+from galileoexperiments.utils.profilefeeder import ProfileFeeder
+from galileoexperiments.utils.rds import wait_for_galileo_events
+from galileoexperiments.utils.teardown import Teardown
+from galileoexperiments.utils.timing import Timer, span
+from galileoexperiments.utils.topology import get_topology
 
 logger = logging.getLogger(__name__)
 
@@ -36,7 +49,17 @@ def _run(config: ProfilingExperimentConfiguration):
 
 
 def run_profiling_workload(workload_config: ProfilingWorkloadConfiguration):
+    timer = Timer().start()
+    try:
+        _run_profiling_workload(workload_config)
+    finally:
+        timer.finish()
+
+
+def _run_profiling_workload(workload_config: ProfilingWorkloadConfiguration):
     rds = workload_config.rds
+    if workload_config.early_stopping is not None and workload_config.latency_aggregator is None:
+        workload_config.latency_aggregator = LatencyAggregator(rds)
     galileo: Galileo = workload_config.galileo
     client_group = None
 
@@ -47,7 +70,8 @@ def run_profiling_workload(workload_config: ProfilingWorkloadConfiguration):
     image = workload_config.image
     profiling_app = workload_config.profiling_app
     if workload_config.lb_ip is None:
-        lb_pods = get_load_balancer_pods()
+        with span('lb_discovery'):
+            lb_pods = get_topology().load_balancers()
         lb_ips = {}
         for cluster, pod in lb_pods.items():
             lb_ips[cluster] = pod.ip
@@ -64,7 +88,7 @@ def run_profiling_workload(workload_config: ProfilingWorkloadConfiguration):
     use_profiles = workload_config.profiles is not None
     if use_profiles:
         profiles = workload_config.profiles
-        workload_config.params['exp']['requests']['profiles'] = profiles
+        workload_config.params['exp']['requests']['profiles'] = [profile_metadata(p) for p in profiles]
         n_clients = len(profiles)
         workload_config.params['exp']['requests']['n_clients'] = n_clients
         workload_config.params['exp']['requests']['no_pods'] = workload_config.no_pods
@@ -76,17 +100,12 @@ def run_profiling_workload(workload_config: ProfilingWorkloadConfiguration):
             params=workload_config.params
         )
 
-        client_group = profiling_app.spawn_group(n_clients, rds, galileo, client_group_config)
-        time.sleep(1)
-        for index, client in enumerate(client_group.clients):
-            profile_path = profiles[index]
-            clear_list(client.client_id, rds)
-            read_and_save_profile(profile_path, client, rds)
-
-
-        def requests():
-            client_group.request(ia=('prerecorded', 'ran')).wait()
-            client_group.close()
+        with span('spawn_clients'):
+            client_group = profiling_app.spawn_group(n_clients, rds, galileo, client_group_config)
+            wait_for_clients(client_group)
+        workload_config.params['exp']['clients'] = [client.client_id for client in client_group.clients]
+        _label_clients(workload_config)
+        requests = _requests(workload_config, client_group)
 
         try:
             exp_run_config = ExperimentRunConfiguration(
@@ -94,6 +113,9 @@ def run_profiling_workload(workload_config: ProfilingWorkloadConfiguration):
                 master_node=master_node,
                 galileo_context=workload_config.context,
                 metadata=workload_config.params,
+                manage_adapter=not workload_config.shared_setup,
+                manage_workers=not workload_config.shared_setup,
+                latency_aggregator=workload_config.latency_aggregator
             )
             app_workload_config = AppWorkloadConfiguration(
                 app_container_image=image,
@@ -108,7 +130,10 @@ def run_profiling_workload(workload_config: ProfilingWorkloadConfiguration):
                 n_clients=n_clients,
                 app_workload_config=app_workload_config,
                 exp_run_config=exp_run_config,
-                lb_ip=workload_config.lb_ip
+                lb_ip=workload_config.lb_ip,
+                weight_probe=workload_config.weight_probe,
+                wait_for_teardown=workload_config.wait_for_teardown,
+                pod_pool=workload_config.pod_pool
             )
 
             logger.info(f'run: {workload_config.params}')
@@ -130,12 +155,11 @@ def run_profiling_workload(workload_config: ProfilingWorkloadConfiguration):
             params=workload_config.params
         )
 
-        client_group = profiling_app.spawn_group(workload_config.n_clients, rds, galileo, client_group_config)
-
-        def requests():
-            # FIXME for some reason workers send only n-1 and not n requests
-            client_group.request(n=workload_config.n+1, ia=workload_config.ia).wait()
-            client_group.close()
+        with span('spawn_clients'):
+            client_group = profiling_app.spawn_group(workload_config.n_clients, rds, galileo, client_group_config)
+        workload_config.params['exp']['clients'] = [client.client_id for client in client_group.clients]
+        _label_clients(workload_config)
+        requests = _requests(workload_config, client_group)
 
         try:
             exp_run_config = ExperimentRunConfiguration(
@@ -143,6 +167,9 @@ def run_profiling_workload(workload_config: ProfilingWorkloadConfiguration):
                 master_node=master_node,
                 galileo_context=workload_config.context,
                 metadata=workload_config.params,
+                manage_adapter=not workload_config.shared_setup,
+                manage_workers=not workload_config.shared_setup,
+                latency_aggregator=workload_config.latency_aggregator
             )
             app_workload_config = AppWorkloadConfiguration(
                 app_container_image=image,
@@ -157,7 +184,10 @@ def run_profiling_workload(workload_config: ProfilingWorkloadConfiguration):
                 n_clients=workload_config.n_clients,
                 app_workload_config=app_workload_config,
                 exp_run_config=exp_run_config,
-                lb_ip=workload_config.lb_ip
+                lb_ip=workload_config.lb_ip,
+                weight_probe=workload_config.weight_probe,
+                wait_for_teardown=workload_config.wait_for_teardown,
+                pod_pool=workload_config.pod_pool
             )
 
             logger.info(f'run: {workload_config.params}')
@@ -166,8 +196,76 @@ def run_profiling_workload(workload_config: ProfilingWorkloadConfiguration):
             logger.error(e)
 
 
+def _label_clients(workload_config: ProfilingWorkloadConfiguration):
+    if workload_config.latency_aggregator is not None:
+        workload_config.latency_aggregator.label_clients(workload_config.params['exp']['clients'],
+                                                         zone=workload_config.zone, group=workload_config.app_name)
+
+
+def _requests(workload_config: ProfilingWorkloadConfiguration, client_group: ClientGroup,
+              close: bool = True) -> Callable[[], Dict]:
+    """
+    Prepares the requests of a run: the profiles are uploaded to the clients, or fed in windows while the requests
+    run. Without profiles, the clients send `n` requests with inter-arrival `ia`.
+    :param close: if True, the client group is closed once the requests are done
+    :return: the function that sends the requests and waits for them, see `_await_requests`
+    """
+    feeder = None
+    if workload_config.profiles is not None:
+        uploads = list(zip(workload_config.profiles, client_group.clients))
+        if workload_config.profile_window is None:
+            with span('upload_profiles'):
+                upload_profiles(uploads, workload_config.rds, workload_config.upload_concurrency)
+        else:
+            feeder = ProfileFeeder(workload_config.rds, workload_config.profile_window)
+            feeder.add(client_group, uploads)
+
+    def requests() -> Dict:
+        if feeder is not None:
+            metadata = _await_requests(workload_config, client_group, feeder.run, feeder.stop)
+        else:
+            if workload_config.profiles is not None:
+                future = client_group.request(ia=('prerecorded', 'ran'))
+            else:
+                # FIXME for some reason workers send only n-1 and not n requests
+                future = client_group.request(n=workload_config.n + 1, ia=workload_config.ia)
+            metadata = _await_requests(workload_config, client_group, future.wait, future.abort)
+        if close:
+            client_group.close()
+        return metadata
+
+    return requests
+
+
+def _await_requests(workload_config: ProfilingWorkloadConfiguration, client_group: ClientGroup,
+                    wait: Callable[[], None], abort: Callable[[], None]) -> Dict:
+    """
+    Calls `wait`, which blocks until the requests are done. With early stopping, the requests may end before: `abort`
+    is called (which ends `wait`, e.g., by aborting the request future or stopping the feeder) and the workloads of the
+    clients are stopped. Clients read prerecorded inter-arrivals at once, so they are stopped, not their lists cleared.
+    The reason is published as event.
+    :return: the values to add to the stored metadata of the experiment, with early stopping the reason (`stop_reason`)
+    """
+    if workload_config.early_stopping is None:
+        wait()
+        return {}
+
+    def stop():
+        abort()
+        # sends a stop command to every client
+        client_group.pause()
+
+    # only the clients of this run, see `_label_clients`
+    stopper = EarlyStopper(workload_config.latency_aggregator, workload_config.early_stopping,
+                           zone=workload_config.zone, group=workload_config.app_name)
+    reason = stopper.run(wait, stop)
+    workload_config.exp.event(stop_reason_event, reason)
+    return {'stop_reason': reason}
+
+
 def _run_profiling_experiment(config: ProfilingExperimentConfiguration):
     pod_names = None
+    pods = None
     params = config.exp_run_config.metadata
     image = config.app_workload_config.app_container_image
     name = config.app_name
@@ -176,6 +274,10 @@ def _run_profiling_experiment(config: ProfilingExperimentConfiguration):
     no_pods = config.no_pods
     n_clients = config.n_clients
     etcd_service_keys = []
+    succeeded = False
+    run_id = new_run_id()
+    run_selector = f'{run_label}={run_id}'
+    params['exp']['run_id'] = run_id
     params['exp']['host'] = host
     params['exp']['zone'] = config.zone
     params['exp']['app_name'] = config.app_name
@@ -184,38 +286,157 @@ def _run_profiling_experiment(config: ProfilingExperimentConfiguration):
     try:
         labels = {
             function_label: config.app_name,
-            zone_label: config.zone
+            zone_label: config.zone,
+            run_label: run_id
         }
 
-        lb_pods = get_load_balancer_pods()
+        lb_pods = get_topology().load_balancers()
         env_vars = {
             'API_GATEWAY': lb_pods[config.zone].ip
         }
 
-        pod_names = spawn_pods(image, pod_prefix, host, labels, no_pods, config.app_workload_config.pod_factory,
-                               env_vars)
-        pods = get_pods(pod_names)
+        if config.pod_pool is not None:
+            pods = config.pod_pool.acquire(image, pod_prefix, host, labels, no_pods,
+                                           config.app_workload_config.pod_factory, env_vars)
+            pod_names = [pod.name for pod in pods]
+        else:
+            pod_names = spawn_pods(image, pod_prefix, host, labels, no_pods, config.app_workload_config.pod_factory,
+                                   env_vars)
+            pods = get_pods(pod_names, label_selector=run_selector)
 
         logger.info("Set weights for Pod(s)")
         pods_per_fn_and_cluster = {
             (name, config.zone): pods
         }
-        lb_pods = get_load_balancer_pods()
+        lb_pods = get_topology().load_balancers()
 
-        etcd_service_keys = set_loadbalancer_weights(pods_per_fn_and_cluster, lb_pods)
+        etcd_service_keys = set_loadbalancer_weights(pods_per_fn_and_cluster, lb_pods, config.weight_probe)
 
-        time.sleep(1)
         if config.exp_run_config.exp_name is None:
             experiment_name = f'{name}-clients-{n_clients}-{int(time.time())}'
             config.exp_run_config.exp_name = experiment_name
-        return _run(config)
+        with span('experiment'):
+            succeeded = _run(config)
     except Exception as e:
         logger.error(e)
     finally:
-        if pod_names is not None:
-            logger.info(f'Remove {len(pod_names)} pods')
-            remove_pods(pod_names)
-        if len(etcd_service_keys) > 0:
-            client = EtcdClient.from_env()
-            for etcd_service_key in etcd_service_keys:
-                client.remove(etcd_service_key)
\ No newline at end of file
+        with span('teardown'):
+            teardown = Teardown()
+            if config.pod_pool is not None:
+                if pods is not None and succeeded:
+                    teardown.add('release_pods', config.pod_pool.release, pods)
+                elif pods is not None:
+                    # the pods may be in an unknown state, the next run must not get them
+                    teardown.add('discard_pods', config.pod_pool.discard, pods)
+            elif pod_names is not None:
+                logger.info(f'Remove {len(pod_names)} pods')
+                teardown.add('remove_pods', remove_pods_by_label, run_selector, wait=config.wait_for_teardown)
+            if len(etcd_service_keys) > 0:
+                teardown.add('remove_weights', WeightWriter().remove, etcd_service_keys)
+            teardown.run()
+
+
+class _Slots:
+    """
+    Tracks which hosts, zones and functions are occupied by the workloads that currently run.
+    """
+
+    def __init__(self, max_parallel: int, allow_shared_lb: bool):
+        self.max_parallel = max_parallel
+        self.allow_shared_lb = allow_shared_lb
+        self.hosts: Set[str] = set()
+        self.zones: Dict[str, int] = {}
+        # the routing table entry and the weights are per function and zone, they can never be shared
+        self.services: Set[Tuple[str, str]] = set()
+
+    @property
+    def running(self) -> int:
+        return len(self.hosts)
+
+    def fits(self, config: ProfilingWorkloadConfiguration) -> bool:
+        if self.running >= self.max_parallel:
+            return False
+        if config.host in self.hosts or (config.app_name, config.zone) in self.services:
+            return False
+        return self.allow_shared_lb or config.zone not in self.zones
+
+    def acquire(self, config: ProfilingWorkloadConfiguration):
+        self.hosts.add(config.host)
+        self.zones[config.zone] = self.zones.get(config.zone, 0) + 1
+        self.services.add((config.app_name, config.zone))
+
+    def release(self, config: ProfilingWorkloadConfiguration):
+        self.hosts.discard(config.host)
+        self.zones[config.zone] -= 1
+        if self.zones[config.zone] == 0:
+            del self.zones[config.zone]
+        self.services.discard((config.app_name, config.zone))
+
+
+def run_parallel_profiling_workloads(workloads: List[ProfilingWorkloadConfiguration], max_parallel: int = 4,
+                                     allow_shared_lb: bool = False, timeout: float = default_setup_timeout):
+    """
+    Runs the profiling workloads concurrently, each one as separate experiment with its own pods, clients, routing
+    table entry and recorder. Telemetry is only enabled for the hosts that are profiled at the moment.
+    Workers, tracing and the telemd-kubernetes-adapter are set up once for all workloads.
+
+    A workload starts as soon as a slot is free and it does not interfere with the running ones: a host is never
+    profiled twice at the same time, and workloads in the same zone would share the load balancer and therefore only
+    run concurrently if `allow_shared_lb` is set. Workloads of the same function in the same zone never overlap.
+
+    Note that all recorders receive the traces of all running workloads, the `clients` in the experiment metadata
+    tell them apart.
+    :param workloads: the workloads, started in the given order wherever possible
+    :param max_parallel: max. number of workloads that run at the same time
+    :param allow_shared_lb: if True, workloads in the same zone run concurrently
+    :param timeout: max. seconds to wait for each step of the shared setup
+    """
+    if len(workloads) == 0:
+        return
+    first = workloads[0]
+    galileo: Galileo = first.galileo
+    pending = list(workloads)
+    slots = _Slots(max(1, max_parallel), allow_shared_lb)
+    condition = threading.Condition()
+    threads = []
+
+    def run(config: ProfilingWorkloadConfiguration):
+        try:
+            # params become the metadata of the run, workloads built from the same base config must not share them
+            config = dataclasses.replace(config, context={**config.context, 'exp': Experiment(config.rds)},
+                                         params=copy.deepcopy(config.params), shared_setup=True)
+            run_profiling_workload(config)
+        except Exception as e:
+            logger.error(f'Profiling {config.app_name} on {config.host} failed: {e}')
+        finally:
+            with condition:
+                slots.release(config)
+                condition.notify_all()
+
+    try:
+        workers = discover_workers(galileo, timeout)
+        logger.info(f"Discovered workers: {workers}")
+        start_tracing(galileo, workers, timeout)
+        start_telemd_kubernetes_adapter(first.master_node)
+        wait_for_galileo_events(first.rds, timeout)
+
+        with condition:
+            while len(pending) > 0:
+                config = next((c for c in pending if slots.fits(c)), None)
+                if config is None:
+                    condition.wait()
+                    continue
+                pending.remove(config)
+                slots.acquire(config)
+                logger.info(f'Start profiling {config.app_name} on {config.host} ({len(pending)} pending, '
+                            f'{slots.running} running)')
+                thread = threading.Thread(target=run, args=(config,), name=f'profiling-{config.host}')
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+    finally:
+        teardown = Teardown()
+        teardown.add('stop_tracing', galileo.stop_tracing)
+        teardown.add('stop_telemd_adapter', stop_telemd_kubernetes_adapter)
+        teardown.run()
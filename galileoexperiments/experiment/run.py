@@ -1,83 +1,174 @@
+import json
 import logging
+import threading
 import time
-from typing import Callable, List
+from typing import Callable, List, Optional, Dict
 
 from galileoexperiments.api.model import ProfilingExperimentConfiguration, ScenarioExperimentConfiguration, \
     ExperimentRunConfiguration
+from galileoexperiments.utils.barriers import discover_workers, start_tracing, wait_for_telemd, trace_subscribers, \
+    wait_for_trace_subscribers, drain_traces
 from galileoexperiments.utils.k8s import start_telemd_kubernetes_adapter, stop_telemd_kubernetes_adapter
+from galileoexperiments.utils.latency import LatencyAggregator
+from galileoexperiments.utils.metadata import store_metadata
 from galileoexperiments.utils.rds import wait_for_galileo_events
+from galileoexperiments.utils.teardown import Teardown
+from galileoexperiments.utils.timing import span, current_timer, Timer
 
 logger = logging.getLogger(__name__)
 
+timings_event = 'timings'
+
+latency_event = 'latency'
+
+# experiments that run in parallel start their recorders one after another, otherwise one could mistake the recorder of
+# another experiment for its own
+_recorder_lock = threading.Lock()
+
 
 def run_profiling_experiment(config: ProfilingExperimentConfiguration):
-    run_experiment(config.exp_run_config, config.app_workload_config.requests, telemd_hosts=[config.host])
+    return run_experiment(config.exp_run_config, config.app_workload_config.requests, telemd_hosts=[config.host])
 
 
-def run_scenario_experiment(config: ScenarioExperimentConfiguration, requests: Callable):
-    return run_experiment(config.exp_run_config, requests)
+def run_scenario_experiment(config: ScenarioExperimentConfiguration, requests: Callable, hosts: List[str] = None):
+    """
+    :param hosts: the hosts that run pods of the scenario, all hosts emit telemetry but only these are awaited
+    """
+    return run_experiment(config.exp_run_config, requests, awaited_hosts=hosts)
 
 
-def run_experiment(config: ExperimentRunConfiguration, requests: Callable, telemd_hosts: List[str]=None):
+def run_experiment(config: ExperimentRunConfiguration, requests: Callable, telemd_hosts: List[str]=None,
+                   awaited_hosts: List[str] = None):
     """
     Starts an experiment. That includes: discovering workers, starting tracing, starting telemd, the experiment
     and the telemd-kubernetes-adapter. Then it waits for the telemd-kubernetes-adapter to publish events.
     As soon as the first event arrives, the requests begin.
+    Every step waits for an explicit readiness condition (see `galileoexperiments.utils.barriers`), bounded by
+    `config.setup_timeout`. After the requests, the traces still in flight are drained.
+    If `config.latency_aggregator` is set, it aggregates the traces from the start of the recorder until they are
+    drained and its summary is published as `latency` event and added to the stored metadata (key `latency`).
     Afterwards, we stop tracing, telemd, the experiment and teardown the telemd-kubernetes-adapter
     :param config: contains all components (i.e., telemd, galileo)
-    :param requests: function invoked after everything is setup, should start galileo workers
+    :param requests: function invoked after everything is setup, should start galileo workers. It may return a Dict
+                     of values that are added to the stored metadata of the experiment (e.g., why the requests ended)
     :param telemd_hosts: hosts that should emit telemetry. if None, tells all hosts to emit telemetry
-    :return:
+    :param awaited_hosts: hosts whose telemetry must arrive before the experiment starts, by default `telemd_hosts`.
+                          If both are None, all registered telemd hosts are awaited, but the experiment starts anyway
+                          if some of them (e.g., stale registrations) did not send telemetry in time
+    :return: True if the experiment ran through, False if a step failed (the error is logged)
     """
     metadata = config.metadata
     if metadata is None:
         metadata = {}
+    controllers = config.controllers if config.controllers is not None else []
+    timeout = config.setup_timeout
+    timer = current_timer()
+    aggregator = None
+    # added to the stored metadata when the experiment stops
+    results = {}
+    # right before the recorder was started, identifies the recorded experiment
+    started = None
+    succeeded = False
     try:
 
-        # discover workers
-        workers = config.galileo.discover()
-        logger.info(f"Discovered workers: {workers}")
-        time.sleep(1)
+        if config.manage_workers:
+            # discover workers
+            with span('discover_workers'):
+                workers = discover_workers(config.galileo, timeout)
+            logger.info(f"Discovered workers: {workers}")
 
-        # toggle tracing
-        logger.info("Start tracing")
-        config.galileo.start_tracing()
+            # toggle tracing
+            logger.info("Start tracing")
+            with span('start_tracing'):
+                start_tracing(config.galileo, workers, timeout)
 
         # unpause telemd
         logger.info(f"Unpause telemd")
-        if telemd_hosts is not None:
-            config.telemd.start_telemd(telemd_hosts)
-        else:
-            config.telemd.start_telemd()
+        with span('start_telemd'):
+            if telemd_hosts is not None:
+                config.telemd.start_telemd(telemd_hosts)
+            else:
+                config.telemd.start_telemd()
+            if awaited_hosts is None:
+                awaited_hosts = telemd_hosts
+            if awaited_hosts is not None:
+                wait_for_telemd(config.rds, awaited_hosts, timeout)
+            else:
+                wait_for_telemd(config.rds, config.telemd.list_telemd_hosts(), timeout, required=False)
 
         # start exp
-        logger.info("Start experiment and wait for 1 second")
-        config.exp.start(
-            name=config.exp_name,
-            creator=config.creator,
-            metadata=metadata
-        )
-        time.sleep(1)
+        logger.info("Start experiment and wait for the recorder")
+        if timer is not None:
+            # phases up to here, the remaining ones are added when the experiment stops
+            metadata['timings'] = timer.to_metadata()
+        with span('start_experiment'), _recorder_lock:
+            subscribers = trace_subscribers(config.rds)
+            started = time.time()
+            config.exp.start(
+                name=config.exp_name,
+                creator=config.creator,
+                metadata=metadata
+            )
+            wait_for_trace_subscribers(config.rds, subscribers, timeout)
+        if config.latency_aggregator is not None:
+            config.latency_aggregator.start()
+            aggregator = config.latency_aggregator
 
         # start telemd kubernetes adapter
-        start_telemd_kubernetes_adapter(config.master_node)
-        logger.info("Waiting for telemd_kubernetes adapter to publish galileo events")
-        wait_for_galileo_events(config.rds)
-        time.sleep(1)
+        if config.manage_adapter:
+            with span('start_telemd_adapter'):
+                start_telemd_kubernetes_adapter(config.master_node)
+                logger.info("Waiting for telemd_kubernetes adapter to publish galileo events")
+                wait_for_galileo_events(config.rds, timeout)
 
         # set requests
         logger.info("start requests")
-        requests()
-        time.sleep(5)
+        for controller in controllers:
+            controller.start()
+        try:
+            with span('requests'):
+                results = requests() or {}
+        finally:
+            for controller in controllers:
+                controller.stop()
+        with span('drain'):
+            drain_traces(config.rds, config.drain_quiet_period, config.drain_timeout)
+        if aggregator is not None:
+            aggregator.stop()
+        succeeded = True
 
     except Exception as e:
         logger.error(e)
     finally:
-        logger.info("Stop tracing")
-        config.galileo.stop_tracing()
-        logger.info("Pause telemd")
-        config.telemd.stop_telemd()
-        logger.info("Stop exp")
-        config.exp.stop()
-        logger.info("Shutdown telemd kubernetes adapter")
-        stop_telemd_kubernetes_adapter()
+        with span('stop_experiment'):
+            logger.info("Stop tracing, pause telemd and shutdown telemd kubernetes adapter")
+            teardown = Teardown()
+            if config.manage_workers:
+                teardown.add('stop_tracing', config.galileo.stop_tracing)
+            teardown.add('stop_telemd', config.telemd.stop_telemd, telemd_hosts)
+            if config.manage_adapter:
+                teardown.add('stop_telemd_adapter', stop_telemd_kubernetes_adapter)
+            # the recorder stops last, so it records everything the others emit until they stop
+            teardown.add('stop_recorder', _stop_experiment, config, timer, aggregator, started, results,
+                          stage=1)
+            teardown.run()
+    return succeeded
+
+
+def _stop_experiment(config: ExperimentRunConfiguration, timer: Optional[Timer],
+                     aggregator: Optional[LatencyAggregator], started: Optional[float], results: Dict):
+    # added to the metadata the recorder stored at the start
+    metadata = dict(results)
+    if timer is not None:
+        config.exp.event(timings_event, json.dumps(timer.totals()))
+        # replaces the phases up to the start of the experiment
+        metadata['timings'] = timer.to_metadata()
+    if aggregator is not None:
+        # stops it if the experiment failed before the traces were drained
+        aggregator.stop()
+        config.exp.event(latency_event, aggregator.to_event())
+        metadata['latency'] = aggregator.summary()
+    logger.info("Stop exp")
+    config.exp.stop()
+    if started is not None and len(metadata) > 0:
+        store_metadata(config.galileo_context, config.exp_name, config.creator, started, metadata)
@@ -1,5 +1,4 @@
 import logging
-import time
 from typing import List, Dict, Tuple, Callable
 
 from galileo.shell.shell import RoutingTableHelper, ClientGroup
@@ -8,16 +7,30 @@ from galileoexperiments.api.model import ScenarioWorkloadConfiguration, Pod, Sce
     ExperimentRunConfiguration, AppWorkloadConfiguration
 from galileoexperiments.api.profiling import GalileoClientGroupConfig
 from galileoexperiments.experiment.run import run_scenario_experiment
-from galileoexperiments.utils.arrivalprofile import clear_list, read_and_save_profile
-from galileoexperiments.utils.constants import function_label, zone_label
-from galileoexperiments.utils.helpers import EtcdClient, update_weights
-from galileoexperiments.utils.k8s import spawn_pods, get_pods, remove_pods, get_load_balancer_pods
+from galileoexperiments.utils.arrivalprofile import upload_profiles, profile_metadata
+from galileoexperiments.utils.barriers import wait_for_clients
+from galileoexperiments.utils.constants import function_label, zone_label, run_label
+from galileoexperiments.utils.helpers import WeightWriter, update_weights, WeightProbe
+from galileoexperiments.utils.k8s import spawn_pods, get_pods, new_run_id, \
+    remove_pods_by_label
+from galileoexperiments.utils.profilefeeder import ProfileFeeder
+from galileoexperiments.utils.reweighting import ReweightingController, header_target
+from galileoexperiments.utils.teardown import Teardown
+from galileoexperiments.utils.timing import Timer, span, timed
+from galileoexperiments.utils.topology import get_topology
+from galileoexperiments.utils.weights import WeightPolicy
 
 logger = logging.getLogger(__name__)
 
 
-def spawn_pods_for_config(workload_config: ScenarioWorkloadConfiguration, lb_pods: Dict[str, str]) -> List[Pod]:
+@timed()
+def spawn_pods_for_config(workload_config: ScenarioWorkloadConfiguration, lb_pods: Dict[str, str],
+                          run_id: str) -> List[Pod]:
+    """
+    Spawns the pods of all services, or acquires them from the pod pool of the workload if it has one.
+    """
     pod_names = []
+    pooled = []
     for host, values in workload_config.services.items():
         for image, no_pods in values.items():
             name = workload_config.app_names[image]
@@ -25,7 +38,8 @@ def spawn_pods_for_config(workload_config: ScenarioWorkloadConfiguration, lb_pod
             zone = workload_config.zone_mapping[host]
             labels = {
                 function_label: name,
-                zone_label: zone
+                zone_label: zone,
+                run_label: run_id
             }
 
             env_vars = {
@@ -34,10 +48,20 @@ def spawn_pods_for_config(workload_config: ScenarioWorkloadConfiguration, lb_pod
 
             profiling_app = workload_config.profiling_apps[image]
             pod_name_prefix = f'{name}-deployment'
-            names = spawn_pods(image, pod_name_prefix, host, labels, no_pods, profiling_app.pod_factory,
-                               env_vars=env_vars)
-            pod_names.extend(names)
-    return get_pods(pod_names)
+            if workload_config.pod_pool is not None:
+                try:
+                    pooled.extend(workload_config.pod_pool.acquire(image, pod_name_prefix, host, labels, no_pods,
+                                                                   profiling_app.pod_factory, env_vars))
+                except Exception:
+                    workload_config.pod_pool.release(pooled)
+                    raise
+            else:
+                names = spawn_pods(image, pod_name_prefix, host, labels, no_pods, profiling_app.pod_factory,
+                                   env_vars=env_vars)
+                pod_names.extend(names)
+    if workload_config.pod_pool is not None:
+        return pooled
+    return get_pods(pod_names, label_selector=f'{run_label}={run_id}')
 
 
 def _map_pods_to_dict(pods: List[Pod]) -> Dict[Tuple[str, str], List[Pod]]:
@@ -53,10 +77,28 @@ def _map_pods_to_dict(pods: List[Pod]) -> Dict[Tuple[str, str], List[Pod]]:
     return pods_map
 
 
-def set_loadbalancer_weights(pods: Dict[Tuple[str, str], List[Pod]], lbs: Dict[str, Pod]):
-    return update_weights(pods, lbs)
+@timed()
+def set_loadbalancer_weights(pods: Dict[Tuple[str, str], List[Pod]], lbs: Dict[str, Pod],
+                             probe: WeightProbe = None, policy: WeightPolicy = None) -> List[str]:
+    """
+    Sets the weights of all functions and zones and blocks until the load balancers applied them (with a probe), or
+    for a fixed delay without (see `WeightWriter.wait_for_propagation`).
+    :param probe: optional check whether a load balancer applied the weights, see `WeightWriter.wait_for_propagation`
+    :param policy: decides the weights, round robin if None
+    :return: the etcd keys that were written
+    """
+    writer = WeightWriter()
+    keys = update_weights(pods, lbs, writer, policy)
+    try:
+        writer.wait_for_propagation(lbs, probe)
+    except Exception:
+        # the caller never learns about the keys, therefore they are removed here
+        writer.remove(keys)
+        raise
+    return keys
 
 
+@timed()
 def set_rtbl(fns: List[str], load_balancers: Dict[str, str], rtbl: RoutingTableHelper) -> List[str]:
     """
     :param fns: function names available
@@ -73,10 +115,15 @@ def set_rtbl(fns: List[str], load_balancers: Dict[str, str], rtbl: RoutingTableH
     return services
 
 
+@timed()
 def prepare_client_groups_for_services(workload_config: ScenarioWorkloadConfiguration) -> Tuple[List[
                                                                                                     Tuple[
                                                                                                         str, str, ClientGroup]], Callable]:
     client_groups = []
+    uploads = []
+    feeder = None
+    if workload_config.profile_window is not None:
+        feeder = ProfileFeeder(workload_config.rds, workload_config.profile_window)
     for zone, values in workload_config.profiles.items():
         for image, profiles in values.items():
 
@@ -91,14 +138,22 @@ def prepare_client_groups_for_services(workload_config: ScenarioWorkloadConfigur
             rds = workload_config.rds
             galileo = workload_config.galileo
             client_group = profiling_app.spawn_group(n_clients, rds, galileo, client_group_config)
-            time.sleep(1)
-            for index, client in enumerate(client_group.clients):
-                profile_path = profiles[index]
-                clear_list(client.client_id, rds)
-                read_and_save_profile(profile_path, client, rds)
+            wait_for_clients(client_group)
+            if workload_config.latency_aggregator is not None:
+                workload_config.latency_aggregator.label_clients([c.client_id for c in client_group.clients],
+                                                                 zone=zone, group=workload_config.app_names[image])
+            if feeder is None:
+                uploads.extend(zip(profiles, client_group.clients))
+            else:
+                feeder.add(client_group, list(zip(profiles, client_group.clients)))
 
             client_groups.append((image, zone, client_group))
 
+    if feeder is not None:
+        return client_groups, feeder.run
+
+    upload_profiles(uploads, workload_config.rds, workload_config.upload_concurrency)
+
     def requests():
         all_cmds = []
         for idx, group in enumerate(client_groups):
@@ -113,7 +168,10 @@ def prepare_client_groups_for_services(workload_config: ScenarioWorkloadConfigur
 
 def set_params(workload_config: ScenarioWorkloadConfiguration):
     workload_config.params['app_params'] = workload_config.app_params
-    workload_config.params['profiles'] = workload_config.profiles
+    workload_config.params['profiles'] = {
+        zone: {image: [profile_metadata(p) for p in profiles] for image, profiles in values.items()}
+        for zone, values in workload_config.profiles.items()
+    }
     workload_config.params['lb_ips'] = workload_config.lb_ips
     workload_config.params['zone_mapping'] = workload_config.zone_mapping
     workload_config.params['services'] = workload_config.services
@@ -121,6 +179,14 @@ def set_params(workload_config: ScenarioWorkloadConfiguration):
 
 
 def run_scenario_workload(workload_config: ScenarioWorkloadConfiguration):
+    timer = Timer().start()
+    try:
+        _run_scenario_workload(workload_config)
+    finally:
+        timer.finish()
+
+
+def _run_scenario_workload(workload_config: ScenarioWorkloadConfiguration):
     rtbl: RoutingTableHelper = workload_config.rtbl
     pods = None
     rtbl_services = []
@@ -128,8 +194,12 @@ def run_scenario_workload(workload_config: ScenarioWorkloadConfiguration):
     creator = workload_config.creator
     master_node = workload_config.master_node
     client_groups = []
+    succeeded = False
+    run_id = new_run_id()
+    workload_config.params['run_id'] = run_id
 
-    lb_pods = get_load_balancer_pods()
+    with span('lb_discovery'):
+        lb_pods = get_topology().load_balancers()
     lb_ips = {}
     for zone, pod in lb_pods.items():
         lb_ips[zone] = pod.ip
@@ -137,20 +207,30 @@ def run_scenario_workload(workload_config: ScenarioWorkloadConfiguration):
     workload_config.lb_ips = lb_ips
     try:
         client_groups, requests = prepare_client_groups_for_services(workload_config)
-        pods = spawn_pods_for_config(workload_config, lb_ips)
+        pods = spawn_pods_for_config(workload_config, lb_ips, run_id)
 
         pods_per_fn_and_cluster = _map_pods_to_dict(pods)
 
-        etcd_service_keys = set_loadbalancer_weights(pods_per_fn_and_cluster, lb_pods)
+        etcd_service_keys = set_loadbalancer_weights(pods_per_fn_and_cluster, lb_pods, workload_config.weight_probe,
+                                                     workload_config.weight_policy)
         rtbl_services = set_rtbl(list(workload_config.app_names.values()), workload_config.lb_ips, rtbl)
 
         set_params(workload_config)
 
+        controllers = []
+        if workload_config.reweight_interval is not None:
+            controllers.append(ReweightingController(workload_config.rds, pods_per_fn_and_cluster, lb_pods,
+                                                     workload_config.exp, workload_config.weight_policy,
+                                                     workload_config.reweight_interval,
+                                                     target_of=workload_config.trace_target or header_target()))
+
         exp_run_config = ExperimentRunConfiguration(
             creator=creator,
             master_node=master_node,
             galileo_context=workload_config.context,
             metadata=workload_config.params,
+            controllers=controllers,
+            latency_aggregator=workload_config.latency_aggregator
         )
         app_configs = []
 
@@ -166,18 +246,28 @@ def run_scenario_workload(workload_config: ScenarioWorkloadConfiguration):
             apps=app_configs,
             exp_run_config=exp_run_config
         )
-        run_scenario_experiment(scenario_experiment_config, requests)
+        with span('experiment'):
+            hosts = sorted(node for node, instances in workload_config.services.items() if sum(instances.values()) > 0)
+            succeeded = run_scenario_experiment(scenario_experiment_config, requests, hosts)
     except Exception as e:
         logger.error(e)
     finally:
-        if pods is not None:
-            logger.info(f'Remove {len(pods)} pods')
-            remove_pods([x.name for x in pods])
-        for service in rtbl_services:
-            logger.info(f'Remove rtbl entry for: {service}')
-            rtbl.remove(service)
-        client = EtcdClient.from_env()
-        for key in etcd_service_keys:
-            client.remove(key)
-        for c_group in client_groups:
-            c_group[2].close()
+        with span('teardown'):
+            teardown = Teardown()
+            if workload_config.pod_pool is not None:
+                if pods is not None and succeeded:
+                    teardown.add('release_pods', workload_config.pod_pool.release, pods)
+                elif pods is not None:
+                    # the pods may be in an unknown state, the next run must not get them
+                    teardown.add('discard_pods', workload_config.pod_pool.discard, pods)
+            else:
+                # pods are removed by label, this includes pods of a partially failed spawn
+                teardown.add('remove_pods', remove_pods_by_label, f'{run_label}={run_id}',
+                             wait=workload_config.wait_for_teardown)
+            logger.info(f'Remove rtbl entries for: {rtbl_services}')
+            for service in rtbl_services:
+                teardown.add(f'remove_rtbl/{service}', rtbl.remove, service)
+            teardown.add('remove_weights', WeightWriter().remove, etcd_service_keys)
+            for image, zone, c_group in client_groups:
+                teardown.add(f'close_client_group/{zone}/{image}', c_group.close)
+            teardown.run()
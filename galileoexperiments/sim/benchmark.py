@@ -0,0 +1,172 @@
+"""
+Measures the orchestration overhead of `run_profiling_workload` and `run_scenario_workload` against a `Simulation`:
+the duration of every phase, the number of API calls by backend and the peak memory allocated by Python.
+Run it with::
+
+    python -m galileoexperiments.sim.benchmark --sizes 10 100 1000 --json results.json
+"""
+import argparse
+import dataclasses
+import json
+import logging
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from typing import Dict, List, Callable
+
+from galileoexperiments.api.model import ProfilingWorkloadConfiguration, ScenarioWorkloadConfiguration
+from galileoexperiments.experiment.profiling.run import run_profiling_workload
+from galileoexperiments.experiment.scenario.run import run_scenario_workload
+from galileoexperiments.sim.galileo import FakeProfilingApplication
+from galileoexperiments.sim.simulation import Simulation
+from galileoexperiments.utils.syntheticprofile import profiles_for_clients, PoissonProfile
+from galileoexperiments.utils.timing import Timer, add_hook, remove_hook
+
+logger = logging.getLogger(__name__)
+
+default_sizes = [10, 100, 1000]
+
+# requests sent by every client
+default_requests = 10
+
+image = 'edgerun/benchmark-fn'
+fn = 'benchmark'
+
+
+@dataclass
+class BenchmarkResult:
+    workload: str
+    n_pods: int
+    n_clients: int
+    elapsed: float
+    # summed duration by phase
+    phases: Dict[str, float] = field(default_factory=dict)
+    # number of calls by backend and operation
+    api_calls: Dict[str, int] = field(default_factory=dict)
+    # peak of the memory allocated during the run, in bytes
+    peak_memory: int = 0
+    # traces recorded by the experiment
+    traces: int = 0
+
+
+def _nodes(n_nodes: int, n_zones: int) -> Dict[str, str]:
+    return {f'node-{i}': f'zone-{i % n_zones}' for i in range(n_nodes)}
+
+
+def _measure(workload: str, n_pods: int, n_clients: int, sim: Simulation, context: Dict,
+             run: Callable[[], None]) -> BenchmarkResult:
+    timers: List[Timer] = []
+    add_hook(timers.append)
+    tracemalloc.start()
+    start = time.time()
+    try:
+        run()
+    finally:
+        elapsed = time.time() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        remove_hook(timers.append)
+    phases = {}
+    for timer in timers:
+        for path, duration in timer.totals().items():
+            phases[path] = phases.get(path, 0) + duration
+    traces = sum(e['traces'] for e in context['exp'].experiments)
+    return BenchmarkResult(workload, n_pods, n_clients, elapsed, phases, sim.api_calls(), peak, traces)
+
+
+def benchmark_profiling(n_pods: int, n_clients: int, n: int = default_requests) -> BenchmarkResult:
+    """
+    Profiles one host with `n_pods` pods and `n_clients` clients that each send `n` requests.
+    """
+    with Simulation(_nodes(2, 2)) as sim:
+        config = ProfilingWorkloadConfiguration(
+            creator='benchmark',
+            app_name=fn,
+            host='node-0',
+            zone='zone-0',
+            master_node='master',
+            image=image,
+            no_pods=n_pods,
+            params={},
+            profiling_app=FakeProfilingApplication(),
+            context=sim.context(),
+            n=n,
+            ia=0,
+            n_clients=n_clients
+        )
+        return _measure('profiling', n_pods, n_clients, sim, config.context, lambda: run_profiling_workload(config))
+
+
+def benchmark_scenario(n_pods: int, n_clients: int, n: int = default_requests, n_nodes: int = 10,
+                       n_zones: int = 3) -> BenchmarkResult:
+    """
+    Runs a scenario with `n_pods` pods and `n_clients` clients spread evenly across the nodes and zones, every client
+    replays a profile of `n` requests.
+    """
+    nodes = _nodes(n_nodes, n_zones)
+    zones = sorted(set(nodes.values()))
+    with Simulation(nodes) as sim:
+        services = {node: {image: n_pods // n_nodes + (1 if i < n_pods % n_nodes else 0)}
+                    for i, node in enumerate(nodes)}
+        profiles = {zone: {image: profiles_for_clients(PoissonProfile, n_clients // n_zones +
+                                                       (1 if i < n_clients % n_zones else 0), seed=i, rate=100, n=n)}
+                    for i, zone in enumerate(zones)}
+        config = ScenarioWorkloadConfiguration(
+            creator='benchmark',
+            app_names={image: fn},
+            master_node='master',
+            services={node: values for node, values in services.items() if values[image] > 0},
+            zone_mapping=nodes,
+            params={},
+            app_params={image: {}},
+            profiling_apps={image: FakeProfilingApplication()},
+            context=sim.context(),
+            profiles={zone: values for zone, values in profiles.items() if len(values[image]) > 0}
+        )
+        return _measure('scenario', n_pods, n_clients, sim, config.context, lambda: run_scenario_workload(config))
+
+
+def run_benchmarks(sizes: List[int] = None, n: int = default_requests) -> List[BenchmarkResult]:
+    """
+    Runs both workloads once for every size, with as many pods as clients.
+    """
+    results = []
+    for size in sizes or default_sizes:
+        for benchmark in [benchmark_profiling, benchmark_scenario]:
+            result = benchmark(size, size, n)
+            logger.info(f'{result.workload} with {size} pods and clients took {result.elapsed:.3f}s')
+            results.append(result)
+    return results
+
+
+def format_results(results: List[BenchmarkResult]) -> str:
+    lines = []
+    for result in results:
+        lines.append(f'{result.workload}: {result.n_pods} pods, {result.n_clients} clients, '
+                     f'{result.elapsed:.3f}s, {result.traces} traces, peak memory '
+                     f'{result.peak_memory / 1024 / 1024:.1f} MiB')
+        for path, duration in sorted(result.phases.items()):
+            lines.append(f'  {path:<70} {duration:8.3f}s')
+        for name, count in sorted(result.api_calls.items()):
+            lines.append(f'  {name:<70} {count:8d}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the orchestration of workloads against a simulation')
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes,
+                        help='number of pods and clients of each run')
+    parser.add_argument('--requests', type=int, default=default_requests, help='requests sent by every client')
+    parser.add_argument('--json', help='writes the results to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run_benchmarks(args.sizes, args.requests)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump([dataclasses.asdict(r) for r in results], fd, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+In-memory stand-in for `EtcdClient`, install it with `EtcdClient._shared = FakeEtcdClient()` (see `Simulation`).
+"""
+import threading
+from collections import Counter
+from typing import Dict, List, Iterable, Tuple
+
+from galileoexperiments.utils.helpers import EtcdClient, max_txn_ops
+
+
+class FakeEtcdClient(EtcdClient):
+    """
+    Keeps the keys in a dict and counts every revision, like etcd does. Every operation is counted in `calls`.
+    """
+
+    def __init__(self):
+        self.etcd_host = 'fake'
+        self.etcd_port = 0
+        self.calls = Counter()
+        self.data: Dict[str, str] = {}
+        self.revision = 0
+        self._lock = threading.Lock()
+
+    def _apply(self, ops: List[Tuple[str, str, str]]):
+        with self._lock:
+            self.revision += 1
+            for op, key, value in ops:
+                if op == 'put':
+                    self.data[key] = value
+                else:
+                    self.data.pop(key, None)
+
+    def write(self, key: str, value: str):
+        self.calls['put'] += 1
+        self._apply([('put', key, value)])
+
+    def remove(self, key: str):
+        self.calls['delete'] += 1
+        self._apply([('delete', key, None)])
+
+    def _commit(self, ops: List):
+        for offset in range(0, len(ops), max_txn_ops):
+            self.calls['txn'] += 1
+            self._apply(ops[offset:offset + max_txn_ops])
+
+    def write_all(self, values: Dict[str, str]):
+        self._commit([('put', key, value) for key, value in values.items()])
+
+    def remove_all(self, keys: Iterable[str]):
+        self._commit([('delete', key, None) for key in keys])
+
@@ -0,0 +1,282 @@
+"""
+Stand-ins for the galileo objects of a galileo context (see `galileo.shell.shell.init`): the cluster controller behind
+`Galileo` and client groups, the routing table behind `RoutingTableHelper`, and the experiment recorder.
+Clients do not sleep between requests, they publish one trace per request right away.
+"""
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional
+
+from galileo.controller import ClusterController
+from galileo.routing.table import RoutingTable, RoutingRecord
+from galileo.worker.api import ClientConfig, ClientDescription
+from galileodb.db import ExperimentDatabase
+from galileodb.model import RequestTrace, Experiment, generate_experiment_id
+from galileodb.reporter.traces import RedisTraceReporter
+from kubernetes import client
+
+from galileoexperiments.api.profiling import ProfilingApplication, GalileoClientGroupConfig
+from galileoexperiments.sim.rds import FakeRedis
+
+# simulated seconds between sending a request and receiving the response
+default_service_time = 0.01
+
+
+class FakeRoutingTable(RoutingTable):
+
+    def __init__(self):
+        self.records: Dict[str, RoutingRecord] = {}
+        self._lock = threading.Lock()
+
+    def get_routing(self, service) -> RoutingRecord:
+        with self._lock:
+            record = self.records.get(service)
+        if record is None:
+            raise ValueError(f'No routing record for service {service}')
+        return record
+
+    def set_routing(self, record: RoutingRecord):
+        with self._lock:
+            self.records[record.service] = record
+
+    def clear(self):
+        with self._lock:
+            self.records = {}
+
+    def list_services(self):
+        with self._lock:
+            return list(self.records.keys())
+
+    def remove_service(self, service):
+        with self._lock:
+            self.records.pop(service, None)
+
+
+class FakeClusterController(ClusterController):
+    """
+    Manages simulated workers and clients. A workload of a client sends `n` requests, or, for prerecorded
+    inter-arrivals, one request per entry of the list of the client (which is deleted afterwards, like galileo does).
+    Traces are only published while tracing is enabled.
+    """
+
+    def __init__(self, rds: FakeRedis, table: RoutingTable, workers: List[str],
+                 service_time: float = default_service_time):
+        self.rds = rds
+        self.table = table
+        self.workers = list(workers)
+        self.service_time = service_time
+        self.calls = Counter()
+        self.tracing = False
+        self.clients: Dict[str, ClientDescription] = {}
+        self._lock = threading.Lock()
+        self._reporter = RedisTraceReporter(rds)
+
+    def ping(self):
+        self.calls['ping'] += 1
+        return [{'worker': worker, 'ping': True} for worker in self.workers]
+
+    def discover(self):
+        self.calls['discover'] += 1
+        return len(self.workers)
+
+    def create_clients(self, cfg: ClientConfig, num=1) -> List[ClientDescription]:
+        self.calls['create_clients'] += 1
+        clients = []
+        with self._lock:
+            for i in range(num):
+                worker = self.workers[(len(self.clients) + i) % len(self.workers)]
+                description = ClientDescription(f'{worker}:{uuid.uuid4().hex[:8]}', worker, cfg)
+                self.clients[description.client_id] = description
+                clients.append(description)
+        return clients
+
+    def create_client(self, host: str, cfg: ClientConfig, num=1) -> List[ClientDescription]:
+        return self.create_clients(cfg, num)
+
+    def list_workers(self, pattern: str = ''):
+        return list(self.workers)
+
+    def list_clients(self, worker: str = None) -> List[ClientDescription]:
+        self.calls['list_clients'] += 1
+        with self._lock:
+            return [c for c in self.clients.values() if worker is None or c.worker == worker]
+
+    def get_client_description(self, client_id: str) -> Optional[ClientDescription]:
+        with self._lock:
+            return self.clients.get(client_id)
+
+    def unregister_client(self, client_id: str):
+        with self._lock:
+            self.clients.pop(client_id, None)
+
+    def start_tracing(self):
+        self.calls['start_tracing'] += 1
+        self.tracing = True
+        return len(self.workers)
+
+    def stop_tracing(self):
+        self.calls['stop_tracing'] += 1
+        self.tracing = False
+        return len(self.workers)
+
+    def _requests(self, client_id: str, ia, n: int) -> int:
+        if isinstance(ia, tuple) and len(ia) > 0 and ia[0] == 'prerecorded':
+            pipe = self.rds.pipeline(transaction=False)
+            pipe.llen(client_id)
+            pipe.delete(client_id)
+            available, _ = pipe.execute()
+            return available if n is None else min(n, available)
+        return n if n is not None else 0
+
+    def run_workload(self, client_id: str, ia=None, n: int = None):
+        """
+        Sends the requests of the workload, blocks until the last trace is published.
+        """
+        description = self.get_client_description(client_id)
+        if description is None:
+            return
+        service = description.config.service
+        try:
+            server = random.choice(self.table.get_routing(service).hosts)
+        except ValueError:
+            server = None
+        count = self._requests(client_id, ia, n)
+        if not self.tracing or count == 0:
+            return
+        now = time.time()
+        traces = [RequestTrace(f'{client_id}:{i}', client_id, service, now, now, now + self.service_time, 200, server)
+                  for i in range(count)]
+        self._reporter.report_multiple(traces)
+
+    def set_workload(self, client_id, ia=None, n: int = None):
+        self.calls['set_workload'] += 1
+        self.run_workload(client_id, ia, n)
+
+    def stop_workload(self, client_id):
+        self.calls['stop_workload'] += 1
+
+
+class FakeRequestFuture:
+
+    def __init__(self, thread: threading.Thread):
+        self._thread = thread
+        self.aborted = False
+
+    def stopped(self) -> bool:
+        return self.aborted or not self._thread.is_alive()
+
+    def abort(self):
+        self.aborted = True
+
+    def wait(self, timeout=None, abort_after_timeout=True):
+        self._thread.join(timeout)
+        if self._thread.is_alive() and abort_after_timeout:
+            self.abort()
+
+
+class FakeClientGroup:
+    """
+    Like `galileo.shell.shell.ClientGroup`, the workloads of all clients run in one background thread.
+    """
+
+    def __init__(self, ctrl: FakeClusterController, clients: List[ClientDescription], cfg: ClientConfig = None):
+        self.ctrl = ctrl
+        self.clients = clients
+        self.cfg = cfg
+
+    def request(self, n=None, ia=None) -> FakeRequestFuture:
+        client_ids = [c.client_id for c in self.clients]
+
+        def run():
+            for client_id in client_ids:
+                self.ctrl.set_workload(client_id, ia, n)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return FakeRequestFuture(thread)
+
+    def pause(self):
+        for c in self.clients:
+            self.ctrl.stop_workload(c.client_id)
+
+    def close(self, n=None):
+        if n is None:
+            n = len(self.clients)
+        removed = [self.clients.pop() for _ in range(n)]
+        for c in removed:
+            self.ctrl.unregister_client(c.client_id)
+        return [c.client_id for c in removed]
+
+
+class FakeProfilingApplication(ProfilingApplication):
+    """
+    Spawns simulated clients that request the service `<function>-<zone>`.
+    """
+
+    def spawn_group(self, clients: int, rds, galileo, config: GalileoClientGroupConfig) -> FakeClientGroup:
+        cfg = ClientConfig(f'{config.fn_name}-{config.zone}', parameters=config.params)
+        return FakeClientGroup(galileo.ctrl, galileo.ctrl.create_clients(cfg, clients), cfg)
+
+    def pod_factory(self, pod_name: str, image: str, resource_requests: Dict) -> client.V1Container:
+        return client.V1Container(name=pod_name, image=image, env=[])
+
+
+class FakeExperiment:
+    """
+    Replaces `galileo.shell.shell.Experiment`: instead of a recorder process, a thread subscribes to the traces and
+    events and counts them. Finished experiments are kept in `experiments`. If a database is given, experiment and
+    metadata are saved in it like the recorder does.
+    """
+
+    def __init__(self, rds: FakeRedis, db: ExperimentDatabase = None):
+        self.rds = rds
+        self.db = db
+        self.experiment: Optional[Dict] = None
+        self.experiments: List[Dict] = []
+        self._pubsub = None
+        self._thread = None
+
+    def _on_trace(self, message):
+        self.experiment['traces'] += 1
+
+    def _on_event(self, message):
+        self.experiment['events'] += 1
+
+    def event(self, name: str, value: str = None):
+        msg = f'{time.time()} {name}' if value is None else f'{time.time()} {name} {value}'
+        self.rds.publish('galileo/events', msg)
+
+    def start(self, name=None, creator=None, metadata=None):
+        if self.experiment is not None:
+            raise ValueError('experiment already running')
+        self.experiment = {'name': name, 'creator': creator, 'metadata': metadata, 'start': time.time(),
+                           'traces': 0, 'events': 0}
+        if self.db is not None:
+            now = time.time()
+            exp_id = generate_experiment_id()
+            self.experiment['exp'] = Experiment(exp_id, name=name or exp_id, creator=creator, start=now, created=now,
+                                                status='RUNNING')
+            self.db.save_experiment(self.experiment['exp'])
+            self.db.save_metadata(exp_id, dict(metadata or {}))
+        self._pubsub = self.rds.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{RedisTraceReporter.channel: self._on_trace})
+        self._pubsub.psubscribe(**{'galileo/events': self._on_event})
+        self._thread = self._pubsub.run_in_thread(sleep_time=0.01, daemon=True)
+
+    def stop(self, wait=5):
+        if self.experiment is None:
+            return
+        self._thread.stop()
+        self._thread.join(wait)
+        # deliver what arrived before the recorder stopped
+        while self._pubsub.pending() > 0:
+            self._pubsub.get_message()
+        self._pubsub.close()
+        self.experiment['end'] = time.time()
+        if self.db is not None:
+            self.db.finalize_experiment(self.experiment['exp'], 'FINISHED')
+        self.experiments.append(self.experiment)
+        self.experiment = None
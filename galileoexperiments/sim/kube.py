@@ -0,0 +1,294 @@
+"""
+In-memory stand-in for the Kubernetes API calls used by `galileoexperiments.utils.k8s` and
+`galileoexperiments.utils.topology`. Install it with `set_kube_client(FakeKubernetesClient(cluster))`.
+"""
+import copy
+import datetime
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional, Tuple, Callable
+
+from kubernetes import client
+from kubernetes.client.exceptions import ApiException
+
+from galileoexperiments.utils.constants import pod_running, pod_pending, zone_label, pod_type_label, \
+    api_gateway_type_label
+from galileoexperiments.utils.k8s import KubernetesClient
+
+# seconds from the creation of a pod until it is ready
+default_startup_delay = 0
+
+# max. number of events kept for watches, older resource versions are answered with 410 (Gone)
+default_event_history = 100_000
+
+
+def parse_selector(label_selector: Optional[str]) -> List[Tuple[str, Optional[str]]]:
+    """
+    Parses equality (`key=value`) and existence (`key`) requirements, separated by commas.
+    """
+    if not label_selector:
+        return []
+    requirements = []
+    for term in label_selector.split(','):
+        if '=' in term:
+            key, value = term.split('=', maxsplit=1)
+            requirements.append((key.strip(), value.strip()))
+        else:
+            requirements.append((term.strip(), None))
+    return requirements
+
+
+def matches(labels: Dict[str, str], requirements: List[Tuple[str, Optional[str]]]) -> bool:
+    labels = labels or {}
+    for key, value in requirements:
+        if key not in labels or (value is not None and labels[key] != value):
+            return False
+    return True
+
+
+class FakeCluster:
+    """
+    Holds the pods and deployments of a simulated cluster. Pods are scheduled onto the node of their node selector,
+    get an IP and become ready after `startup_delay` seconds. Every change is appended to an event log with an
+    increasing resource version, which the watches of `FakeWatch` read from.
+    """
+
+    def __init__(self, nodes: Dict[str, str] = None, startup_delay: float = default_startup_delay,
+                 event_history: int = default_event_history):
+        """
+        :param nodes: zone by node name
+        :param startup_delay: seconds until a created pod is ready
+        """
+        self.nodes = nodes or {}
+        self.startup_delay = startup_delay
+        self.event_history = event_history
+        self.calls = Counter()
+        self.pods: Dict[str, client.V1Pod] = {}
+        self.deployments: Dict[str, client.V1Deployment] = {}
+        self.resource_version = 0
+        self._events: List[Tuple[int, str, client.V1Pod]] = []
+        self._ips = 0
+        self._changed = threading.Condition()
+        # called with the name of a deployment and True if it was created, False if it was deleted
+        self.deployment_listeners: List[Callable[[str, bool], None]] = []
+
+    def _emit(self, event_type: str, pod: client.V1Pod):
+        # callers hold the condition
+        self.resource_version += 1
+        pod.metadata.resource_version = str(self.resource_version)
+        self._events.append((self.resource_version, event_type, pod))
+        if len(self._events) > self.event_history:
+            del self._events[:len(self._events) - self.event_history]
+        self._changed.notify_all()
+
+    def _next_ip(self) -> str:
+        self._ips += 1
+        return f'10.0.{self._ips // 250}.{self._ips % 250 + 1}'
+
+    def add_load_balancer(self, zone: str, node: str = None) -> client.V1Pod:
+        """
+        Adds a running load balancer pod for the zone, like the go-load-balancer deployment of the cluster setup.
+        """
+        name = f'go-load-balancer-deployment-{zone}-{uuid.uuid4().hex[:5]}'
+        pod = client.V1Pod(
+            metadata=client.V1ObjectMeta(name=name, labels={pod_type_label: api_gateway_type_label, zone_label: zone}),
+            spec=client.V1PodSpec(containers=[], node_name=node)
+        )
+        self.create_pod(pod)
+        return self.pods[name]
+
+    def create_pod(self, body: client.V1Pod) -> client.V1Pod:
+        with self._changed:
+            name = body.metadata.name
+            if name in self.pods:
+                raise ApiException(status=409, reason=f'pods "{name}" already exists')
+            pod = copy.copy(body)
+            pod.metadata = copy.copy(body.metadata)
+            pod.metadata.uid = str(uuid.uuid4())
+            pod.metadata.namespace = 'default'
+            pod.spec = copy.copy(body.spec)
+            if pod.spec.node_name is None and pod.spec.node_selector:
+                pod.spec.node_name = pod.spec.node_selector.get('kubernetes.io/hostname')
+            pod.status = client.V1PodStatus(phase=pod_pending)
+            self.pods[name] = pod
+            self._emit('ADDED', pod)
+        if self.startup_delay > 0:
+            threading.Timer(self.startup_delay, self._start, args=(name, pod.metadata.uid)).start()
+        else:
+            self._start(name, pod.metadata.uid)
+        return pod
+
+    def _start(self, name: str, uid: str):
+        with self._changed:
+            pod = self.pods.get(name)
+            if pod is None or pod.metadata.uid != uid:
+                return
+            # pods are replaced instead of modified, so events keep the state they reported
+            started = copy.copy(pod)
+            started.metadata = copy.copy(pod.metadata)
+            started.status = client.V1PodStatus(
+                phase=pod_running,
+                pod_ip=self._next_ip(),
+                conditions=[client.V1PodCondition(type='Ready', status='True')]
+            )
+            self.pods[name] = started
+            self._emit('MODIFIED', started)
+
+    def delete_pod(self, name: str):
+        with self._changed:
+            pod = self.pods.pop(name, None)
+            if pod is None:
+                raise ApiException(status=404, reason=f'pods "{name}" not found')
+            deleted = copy.copy(pod)
+            deleted.metadata = copy.copy(pod.metadata)
+            deleted.metadata.deletion_timestamp = datetime.datetime.now(datetime.timezone.utc)
+            self._emit('DELETED', deleted)
+
+    def list_pods(self, label_selector: str = None) -> client.V1PodList:
+        requirements = parse_selector(label_selector)
+        with self._changed:
+            items = [pod for pod in self.pods.values() if matches(pod.metadata.labels, requirements)]
+            return client.V1PodList(items=items,
+                                    metadata=client.V1ListMeta(resource_version=str(self.resource_version)))
+
+    def events_since(self, resource_version: int, label_selector: str, timeout: float,
+                     stopped: threading.Event) -> List[Tuple[int, str, client.V1Pod]]:
+        """
+        Blocks until events newer than the resource version exist (or the timeout passed).
+        :raises ApiException: with status 410 if the resource version is older than the event history
+        """
+        requirements = parse_selector(label_selector)
+        deadline = time.time() + timeout
+        with self._changed:
+            while not stopped.is_set():
+                # resource versions of the log are contiguous
+                first = self._events[0][0] if len(self._events) > 0 else self.resource_version + 1
+                if first > resource_version + 1:
+                    raise ApiException(status=410, reason='too old resource version')
+                events = [e for e in self._events[resource_version - first + 1:]
+                          if matches(e[2].metadata.labels, requirements)]
+                if len(events) > 0:
+                    return events
+                if self.resource_version > resource_version:
+                    resource_version = self.resource_version
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                self._changed.wait(min(remaining, 0.5))
+            return []
+
+    def wake_up(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    def create_deployment(self, body: client.V1Deployment) -> client.V1Deployment:
+        name = body.metadata.name
+        with self._changed:
+            if name in self.deployments:
+                raise ApiException(status=409, reason=f'deployments.apps "{name}" already exists')
+            self.deployments[name] = body
+        for listener in list(self.deployment_listeners):
+            listener(name, True)
+        return body
+
+    def delete_deployment(self, name: str):
+        with self._changed:
+            if self.deployments.pop(name, None) is None:
+                raise ApiException(status=404, reason=f'deployments.apps "{name}" not found')
+        for listener in list(self.deployment_listeners):
+            listener(name, False)
+
+
+class FakeCoreV1Api:
+
+    def __init__(self, cluster: FakeCluster):
+        self.cluster = cluster
+
+    def list_namespaced_pod(self, namespace: str, label_selector: str = None, **kwargs) -> client.V1PodList:
+        self.cluster.calls['list_namespaced_pod'] += 1
+        return self.cluster.list_pods(label_selector)
+
+    def create_namespaced_pod(self, namespace: str, body: client.V1Pod, **kwargs) -> client.V1Pod:
+        self.cluster.calls['create_namespaced_pod'] += 1
+        return self.cluster.create_pod(body)
+
+    def delete_namespaced_pod(self, name: str, namespace: str, **kwargs):
+        self.cluster.calls['delete_namespaced_pod'] += 1
+        self.cluster.delete_pod(name)
+
+    def delete_collection_namespaced_pod(self, namespace: str, label_selector: str = None, **kwargs):
+        self.cluster.calls['delete_collection_namespaced_pod'] += 1
+        for pod in self.cluster.list_pods(label_selector).items:
+            try:
+                self.cluster.delete_pod(pod.metadata.name)
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+
+
+class FakeAppsV1Api:
+
+    def __init__(self, cluster: FakeCluster):
+        self.cluster = cluster
+
+    def create_namespaced_deployment(self, namespace: str, body: client.V1Deployment, **kwargs):
+        self.cluster.calls['create_namespaced_deployment'] += 1
+        return self.cluster.create_deployment(body)
+
+    def delete_namespaced_deployment(self, name: str, namespace: str, **kwargs):
+        self.cluster.calls['delete_namespaced_deployment'] += 1
+        self.cluster.delete_deployment(name)
+
+
+class FakeWatch:
+    """
+    Replaces `kubernetes.watch.Watch` for `list_namespaced_pod` of a `FakeCoreV1Api`.
+    """
+
+    def __init__(self):
+        self.resource_version: Optional[str] = None
+        self._stopped = threading.Event()
+        self._cluster: Optional[FakeCluster] = None
+
+    def stream(self, func, namespace: str, label_selector: str = None, resource_version: str = None,
+               timeout_seconds: int = 300, **kwargs):
+        api: FakeCoreV1Api = func.__self__
+        self._cluster = api.cluster
+        api.cluster.calls['watch'] += 1
+        if resource_version is None:
+            resource_version = api.cluster.list_pods(label_selector).metadata.resource_version
+        self.resource_version = resource_version
+        deadline = time.time() + timeout_seconds
+        while not self._stopped.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            events = api.cluster.events_since(int(self.resource_version), label_selector, remaining, self._stopped)
+            for version, event_type, pod in events:
+                self.resource_version = str(version)
+                yield {'type': event_type, 'object': pod}
+                if self._stopped.is_set():
+                    return
+
+    def stop(self):
+        self._stopped.set()
+        if self._cluster is not None:
+            self._cluster.wake_up()
+
+
+class FakeKubernetesClient(KubernetesClient):
+
+    def __init__(self, cluster: FakeCluster):
+        super().__init__()
+        self.cluster = cluster
+        self._core_v1 = FakeCoreV1Api(cluster)
+        self._apps_v1 = FakeAppsV1Api(cluster)
+
+    @property
+    def api_client(self) -> client.ApiClient:
+        raise RuntimeError('The simulated cluster has no api client')
+
+    def watch(self) -> FakeWatch:
+        return FakeWatch()
@@ -0,0 +1,289 @@
+"""
+Micro-benchmarks of the orchestration steps whose cost grows with the size of an experiment, run against the
+in-memory stand-ins of `galileoexperiments.sim`. Results are compared with a JSON baseline, a benchmark that got
+slower than the baseline by more than the tolerance is reported as regression::
+
+    # the first run records the baseline, later runs exit with 1 if any benchmark regressed
+    python -m galileoexperiments.sim.microbench
+    # records a new baseline
+    python -m galileoexperiments.sim.microbench --update
+
+Timings depend on the machine and its load, every run therefore also times a fixed reference workload and benchmarks
+are compared relative to it. The baseline is generated locally and not part of the repository.
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from galileo.shell.shell import RoutingTableHelper
+from galileo.worker.api import ClientDescription
+from kubernetes import client
+
+from galileoexperiments.api.model import Pod
+from galileoexperiments.experiment.scenario.run import _map_pods_to_dict, set_rtbl
+from galileoexperiments.sim.etcd import FakeEtcdClient
+from galileoexperiments.sim.galileo import FakeRoutingTable
+from galileoexperiments.sim.kube import FakeCluster, FakeKubernetesClient
+from galileoexperiments.sim.rds import FakeRedis
+from galileoexperiments.utils.arrivalprofile import read_and_save_profile, clear_list, ProfileCache, \
+    digest_key
+from galileoexperiments.utils.constants import function_label, zone_label, run_label
+from galileoexperiments.utils.helpers import update_weights, WeightWriter
+from galileoexperiments.utils.k8s import get_pods, set_kube_client
+
+logger = logging.getLogger(__name__)
+
+default_baseline = os.path.join('benchmarks', 'microbench.json')
+
+# a benchmark regressed if its median is this much slower than the baseline (relative)
+default_tolerance = 0.5
+
+# name of the benchmark all others are relative to
+reference_benchmark = 'reference'
+
+# ...and slower by at least this many seconds, which keeps very short benchmarks from flagging noise
+default_min_delta = 0.001
+
+default_repeat = 5
+
+
+@dataclass
+class MicrobenchResult:
+    name: str
+    repeat: int
+    median: float
+    min: float
+    # median relative to the median of the reference benchmark of the same run
+    relative: float = None
+
+
+@dataclass
+class Regression:
+    name: str
+    # median of the baseline, scaled to the current run, see `compare`
+    baseline: float
+    current: float
+
+    @property
+    def ratio(self) -> float:
+        return self.current / self.baseline if self.baseline > 0 else float('inf')
+
+
+def measure(name: str, fn: Callable[[], None], setup: Callable[[], None] = None,
+            repeat: int = default_repeat) -> MicrobenchResult:
+    """
+    Calls `fn` `repeat` times after one unmeasured warm-up call, `setup` runs before each call and is not measured.
+    """
+    durations = []
+    for i in range(repeat + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        if i > 0:
+            durations.append(time.perf_counter() - start)
+    return MicrobenchResult(name, repeat, statistics.median(durations), min(durations))
+
+
+def _reference_workload():
+    # serialization, sorting and dict operations, like the orchestration steps
+    rng = np.random.default_rng(0)
+    values = [float(v) for v in rng.random(20_000)]
+    json.loads(json.dumps({str(i): v for i, v in enumerate(values)}))
+    sorted(values)
+
+
+def bench_reference(repeat: int) -> MicrobenchResult:
+    return measure(reference_benchmark, _reference_workload, repeat=repeat)
+
+
+def _pods(n: int, fns: List[str], zones: List[str]) -> List[Pod]:
+    return [Pod(str(i), f'10.{i // 65536}.{i // 256 % 256}.{i % 256}',
+                {function_label: fns[i % len(fns)], zone_label: zones[i // len(fns) % len(zones)]}, f'pod-{i}',
+                f'node-{i % 100}')
+            for i in range(n)]
+
+
+def bench_profile_upload(sizes: List[int], repeat: int) -> List[MicrobenchResult]:
+    """
+    Uploads `.npy` profiles of the given numbers of inter-arrivals and clears the lists again.
+    """
+    results = []
+    rds = FakeRedis()
+    client_desc = ClientDescription('benchmark-client', 'benchmark-worker', None)
+    list_key = client_desc.client_id
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            path = os.path.join(directory, f'profile-{size}.npy')
+            np.save(path, np.random.default_rng(size).exponential(0.01, size))
+            cache = ProfileCache()
+            results.append(measure(f'read_and_save_profile/{size}',
+                                   lambda: read_and_save_profile(path, client_desc, rds, cache),
+                                   setup=lambda: rds.delete(list_key, digest_key(list_key)), repeat=repeat))
+            results.append(measure(f'clear_list/{size}', lambda: clear_list(list_key, rds),
+                                   setup=lambda: read_and_save_profile(path, client_desc, rds, cache), repeat=repeat))
+    return results
+
+
+def bench_update_weights(shapes: List[Tuple[int, int]], repeat: int, pods_per_cluster: int = 3) -> List[
+    MicrobenchResult]:
+    """
+    Computes and writes the weights of the given numbers of functions and zones.
+    """
+    results = []
+    for n_fns, n_zones in shapes:
+        fns = [f'fn-{i}' for i in range(n_fns)]
+        zones = [f'zone-{i}' for i in range(n_zones)]
+        pods = _map_pods_to_dict(_pods(n_fns * n_zones * pods_per_cluster, fns, zones))
+        lbs = {zone: Pod('', f'192.168.0.{i}', {zone_label: zone}, f'lb-{zone}') for i, zone in enumerate(zones)}
+        writer = WeightWriter(FakeEtcdClient())
+        results.append(measure(f'update_weights/{n_fns}x{n_zones}', lambda: update_weights(pods, lbs, writer),
+                               repeat=repeat))
+    return results
+
+
+def bench_map_pods(sizes: List[int], repeat: int, n_fns: int = 10, n_zones: int = 3) -> List[MicrobenchResult]:
+    fns = [f'fn-{i}' for i in range(n_fns)]
+    zones = [f'zone-{i}' for i in range(n_zones)]
+    results = []
+    for size in sizes:
+        pods = _pods(size, fns, zones)
+        results.append(measure(f'_map_pods_to_dict/{size}', lambda: _map_pods_to_dict(pods), repeat=repeat))
+    return results
+
+
+def bench_set_rtbl(shapes: List[Tuple[int, int]], repeat: int) -> List[MicrobenchResult]:
+    """
+    Sets the routing records of the given numbers of functions and zones.
+    """
+    results = []
+    for n_fns, n_zones in shapes:
+        fns = [f'fn-{i}' for i in range(n_fns)]
+        lbs = {f'zone-{i}': f'192.168.0.{i}' for i in range(n_zones)}
+        rtbl = RoutingTableHelper(FakeRoutingTable())
+        results.append(measure(f'set_rtbl/{n_fns}x{n_zones}', lambda: set_rtbl(fns, lbs, rtbl), repeat=repeat))
+    return results
+
+
+def bench_get_pods(namespace_sizes: List[int], repeat: int, n: int = 10) -> List[MicrobenchResult]:
+    """
+    Waits for `n` ready pods of a run in namespaces that contain the given numbers of pods.
+    """
+    results = []
+    for size in namespace_sizes:
+        cluster = FakeCluster()
+        set_kube_client(FakeKubernetesClient(cluster))
+        try:
+            for i in range(size):
+                run_id = 'benchmark' if i < n else f'other-{i // 100}'
+                cluster.create_pod(client.V1Pod(
+                    metadata=client.V1ObjectMeta(name=f'pod-{i}', labels={run_label: run_id}),
+                    spec=client.V1PodSpec(containers=[], node_selector={'kubernetes.io/hostname': 'node-0'})
+                ))
+            names = [f'pod-{i}' for i in range(n)]
+            results.append(measure(f'get_pods/{size}',
+                                   lambda: get_pods(names, label_selector=f'{run_label}=benchmark'), repeat=repeat))
+        finally:
+            set_kube_client(None)
+    return results
+
+
+def run_microbenchmarks(repeat: int = default_repeat) -> List[MicrobenchResult]:
+    """
+    :return: the results of all benchmarks, the reference benchmark first
+    """
+    reference = bench_reference(repeat)
+    results = []
+    results.extend(bench_profile_upload([1_000, 10_000, 100_000], repeat))
+    results.extend(bench_update_weights([(1, 3), (10, 3), (50, 10), (200, 10)], repeat))
+    results.extend(bench_map_pods([100, 1_000, 10_000], repeat))
+    results.extend(bench_set_rtbl([(10, 3), (100, 10), (500, 10)], repeat))
+    results.extend(bench_get_pods([100, 1_000, 5_000], repeat))
+    # timed before and after the others, the faster one is less disturbed by other load
+    after = bench_reference(repeat)
+    if after.median < reference.median:
+        reference = after
+    reference.relative = 1
+    for result in results:
+        result.relative = result.median / reference.median
+    return [reference] + results
+
+
+def load_baseline(path: str) -> Optional[Dict[str, MicrobenchResult]]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as fd:
+        return {r['name']: MicrobenchResult(**r) for r in json.load(fd)}
+
+
+def save_baseline(path: str, results: List[MicrobenchResult]):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as fd:
+        json.dump([asdict(r) for r in results], fd, indent=2)
+
+
+def compare(results: List[MicrobenchResult], baseline: Dict[str, MicrobenchResult],
+            tolerance: float = default_tolerance, min_delta: float = default_min_delta) -> List[Regression]:
+    """
+    The baseline of a benchmark is scaled to the current run by the reference benchmark: its relative median times the
+    median of the current reference.
+    :return: the benchmarks whose median exceeds the scaled baseline by more than `tolerance` and `min_delta`,
+             benchmarks without baseline are skipped
+    """
+    current_reference = next((r for r in results if r.name == reference_benchmark), None)
+    regressions = []
+    for result in results:
+        previous = baseline.get(result.name)
+        if previous is None or result.name == reference_benchmark:
+            continue
+        if current_reference is not None and previous.relative is not None:
+            expected = previous.relative * current_reference.median
+        else:
+            expected = previous.median
+        if result.median > expected * (1 + tolerance) and result.median - expected > min_delta:
+            regressions.append(Regression(result.name, expected, result.median))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of orchestration hot paths')
+    parser.add_argument('--baseline', default=default_baseline, help='JSON file with the baseline')
+    parser.add_argument('--update', action='store_true', help='stores the results as new baseline')
+    parser.add_argument('--repeat', type=int, default=default_repeat, help='calls per benchmark')
+    parser.add_argument('--tolerance', type=float, default=default_tolerance,
+                        help='relative slowdown that counts as regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run_microbenchmarks(args.repeat)
+    baseline = load_baseline(args.baseline)
+    for result in results:
+        previous = baseline.get(result.name) if baseline is not None else None
+        change = ''
+        if previous is not None and previous.relative:
+            change = f'{result.relative / previous.relative:6.2f}x'
+        print(f'{result.name:<40} {result.median * 1000:10.3f}ms {result.relative:10.4f} {change}')
+
+    if args.update or baseline is None:
+        save_baseline(args.baseline, results)
+        print(f'Stored baseline in {args.baseline}')
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    for r in regressions:
+        print(f'REGRESSION {r.name}: expected {r.baseline * 1000:.3f}ms, took {r.current * 1000:.3f}ms ({r.ratio:.2f}x)')
+    if len(regressions) > 0:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
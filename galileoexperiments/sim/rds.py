@@ -0,0 +1,265 @@
+"""
+In-memory stand-in for the parts of `redis.Redis` used by the experiments and galileo: strings, lists and pub/sub.
+Values are stored as bytes and returned as bytes, or as str with `decode_responses` (like the galileo shell uses it).
+"""
+import fnmatch
+import queue
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Callable
+
+
+def _encode(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value).encode()
+    return str(value).encode()
+
+
+class FakePipeline:
+    """
+    Buffers commands until `execute`, like a non-transactional redis pipeline.
+    """
+
+    def __init__(self, rds: 'FakeRedis'):
+        self.rds = rds
+        self._commands = []
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __getattr__(self, name):
+        command = getattr(self.rds, name)
+
+        def buffer(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+
+        return buffer
+
+    def execute(self) -> List:
+        self.rds.calls['execute'] += 1
+        commands, self._commands = self._commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class FakePubSub:
+
+    def __init__(self, rds: 'FakeRedis', ignore_subscribe_messages: bool = False):
+        self.rds = rds
+        self.ignore_subscribe_messages = ignore_subscribe_messages
+        self.channels: Dict[str, Optional[Callable]] = {}
+        self.patterns: Dict[str, Optional[Callable]] = {}
+        self._messages = queue.Queue()
+
+    def subscribe(self, *channels, **handlers):
+        for channel in channels:
+            self.channels[channel] = None
+        self.channels.update(handlers)
+        self.rds._attach(self)
+
+    def psubscribe(self, *patterns, **handlers):
+        for pattern in patterns:
+            self.patterns[pattern] = None
+        self.patterns.update(handlers)
+        self.rds._attach(self)
+
+    def _deliver(self, channel: str, data: bytes):
+        decode = self.rds.decode
+        if channel in self.channels:
+            self._messages.put({'type': 'message', 'pattern': None, 'channel': decode(channel.encode()),
+                                'data': decode(data)})
+        for pattern in list(self.patterns):
+            if fnmatch.fnmatchcase(channel, pattern):
+                self._messages.put({'type': 'pmessage', 'pattern': decode(pattern.encode()),
+                                    'channel': decode(channel.encode()), 'data': decode(data)})
+
+    def get_message(self, ignore_subscribe_messages: bool = False, timeout: float = 0):
+        try:
+            message = self._messages.get(timeout=timeout) if timeout > 0 else self._messages.get_nowait()
+        except queue.Empty:
+            return None
+        handlers = self.channels if message['pattern'] is None else self.patterns
+        key = message['pattern'] or message['channel']
+        handler = handlers.get(key.decode() if isinstance(key, bytes) else key)
+        if handler is not None:
+            handler(message)
+            return None
+        return message
+
+    def pending(self) -> int:
+        """
+        :return: the number of messages that were delivered but not yet read
+        """
+        return self._messages.qsize()
+
+    def listen(self):
+        while True:
+            message = self.get_message(timeout=1)
+            if message is not None:
+                yield message
+
+    def run_in_thread(self, sleep_time: float = 0, daemon: bool = False) -> 'FakePubSubWorker':
+        worker = FakePubSubWorker(self, sleep_time, daemon)
+        worker.start()
+        return worker
+
+    def close(self):
+        self.rds._detach(self)
+        self.channels = {}
+        self.patterns = {}
+
+    def unsubscribe(self, *channels):
+        for channel in channels or list(self.channels):
+            self.channels.pop(channel, None)
+
+    def punsubscribe(self, *patterns):
+        for pattern in patterns or list(self.patterns):
+            self.patterns.pop(pattern, None)
+
+
+class FakePubSubWorker(threading.Thread):
+
+    def __init__(self, pubsub: FakePubSub, sleep_time: float, daemon: bool):
+        super().__init__(daemon=daemon)
+        self.pubsub = pubsub
+        self.sleep_time = sleep_time
+        self._running = threading.Event()
+
+    def run(self):
+        self._running.set()
+        while self._running.is_set():
+            self.pubsub.get_message(timeout=max(self.sleep_time, 0.01))
+
+    def stop(self):
+        self._running.clear()
+
+
+class FakeRedis:
+    """
+    Implements the commands used by `galileoexperiments` on plain dicts. Every command is counted in `calls`.
+    Keys with an expiry are dropped lazily on access.
+    """
+
+    def __init__(self, decode_responses: bool = False):
+        self.decode_responses = decode_responses
+        self.calls = Counter()
+        self._data: Dict[str, object] = {}
+        self._expiry: Dict[str, float] = {}
+        self._subscribers: List[FakePubSub] = []
+        self._lock = threading.RLock()
+
+    def decode(self, value: bytes):
+        return value.decode() if self.decode_responses else value
+
+    def _get(self, key: str):
+        expiry = self._expiry.get(key)
+        if expiry is not None and expiry <= time.time():
+            self._data.pop(key, None)
+            self._expiry.pop(key, None)
+        return self._data.get(key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        self.calls['get'] += 1
+        with self._lock:
+            value = self._get(key)
+            return self.decode(value) if isinstance(value, bytes) else None
+
+    def set(self, key: str, value, ex: int = None):
+        self.calls['set'] += 1
+        with self._lock:
+            self._data[key] = _encode(value)
+            if ex is not None:
+                self._expiry[key] = time.time() + ex
+            else:
+                self._expiry.pop(key, None)
+        return True
+
+    def delete(self, *keys) -> int:
+        self.calls['delete'] += 1
+        with self._lock:
+            deleted = 0
+            for key in keys:
+                if self._get(key) is not None:
+                    deleted += 1
+                self._data.pop(key, None)
+                self._expiry.pop(key, None)
+            return deleted
+
+    def _list(self, key: str) -> List[bytes]:
+        value = self._get(key)
+        if value is None:
+            value = []
+            self._data[key] = value
+        return value
+
+    def lpush(self, key: str, *values) -> int:
+        self.calls['lpush'] += 1
+        with self._lock:
+            values = [_encode(v) for v in values]
+            values.reverse()
+            lst = self._list(key)
+            lst[:0] = values
+            return len(lst)
+
+    def rpush(self, key: str, *values) -> int:
+        self.calls['rpush'] += 1
+        with self._lock:
+            lst = self._list(key)
+            lst.extend(_encode(v) for v in values)
+            return len(lst)
+
+    def llen(self, key: str) -> int:
+        self.calls['llen'] += 1
+        with self._lock:
+            value = self._get(key)
+            return len(value) if isinstance(value, list) else 0
+
+    def lrange(self, key: str, start: int, end: int) -> List[bytes]:
+        self.calls['lrange'] += 1
+        with self._lock:
+            value = self._get(key)
+            if not isinstance(value, list):
+                return []
+            values = value[start:] if end == -1 else value[start:end + 1]
+            return [self.decode(v) for v in values]
+
+    def pipeline(self, transaction: bool = True) -> FakePipeline:
+        self.calls['pipeline'] += 1
+        return FakePipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages: bool = False) -> FakePubSub:
+        return FakePubSub(self, ignore_subscribe_messages)
+
+    def _attach(self, pubsub: FakePubSub):
+        with self._lock:
+            if pubsub not in self._subscribers:
+                self._subscribers.append(pubsub)
+
+    def _detach(self, pubsub: FakePubSub):
+        with self._lock:
+            if pubsub in self._subscribers:
+                self._subscribers.remove(pubsub)
+
+    def publish(self, channel: str, message) -> int:
+        self.calls['publish'] += 1
+        data = _encode(message)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for pubsub in subscribers:
+            pubsub._deliver(channel, data)
+        return len(subscribers)
+
+    def pubsub_numsub(self, *channels) -> List:
+        self.calls['pubsub_numsub'] += 1
+        with self._lock:
+            return [(self.decode(channel.encode()), sum(1 for p in self._subscribers if channel in p.channels))
+                    for channel in channels]
+
+    def pubsub_channels(self, pattern: str = '*') -> List:
+        self.calls['pubsub_channels'] += 1
+        with self._lock:
+            channels = {channel for p in self._subscribers for channel in p.channels}
+        return [self.decode(channel.encode()) for channel in sorted(channels) if fnmatch.fnmatchcase(channel, pattern)]
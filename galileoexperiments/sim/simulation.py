@@ -0,0 +1,157 @@
+"""
+Wires the in-memory stand-ins into a simulated environment, so workloads run without Kubernetes, etcd, redis and
+galileo workers::
+
+    with Simulation({'node-a': 'zone-a', 'node-b': 'zone-b'}) as sim:
+        run_profiling_workload(ProfilingWorkloadConfiguration(..., profiling_app=FakeProfilingApplication(),
+                                                              context=sim.context()))
+        print(sim.api_calls())
+
+While installed, the helpers of `galileoexperiments.utils.k8s`, the topology index and the shared `EtcdClient` use the
+simulation. Feeding profiles in windows (`ProfileFeeder`) requires real galileo client groups and is not supported.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, Set
+
+from galileo.shell.shell import Galileo, Telemd, RoutingTableHelper
+from galileodb.sql.adapter import ExperimentSQLDatabase
+from galileodb.sql.driver.sqlite import SqliteAdapter
+from telemc import TelemetryController
+
+from galileoexperiments.sim.etcd import FakeEtcdClient
+from galileoexperiments.sim.galileo import FakeClusterController, FakeRoutingTable, FakeExperiment, \
+    default_service_time
+from galileoexperiments.sim.kube import FakeCluster, FakeKubernetesClient, default_startup_delay
+from galileoexperiments.sim.rds import FakeRedis
+from galileoexperiments.utils.helpers import EtcdClient
+from galileoexperiments.utils.k8s import set_kube_client
+from galileoexperiments.utils.topology import set_topology
+
+logger = logging.getLogger(__name__)
+
+# seconds between two telemetry values of a node (and two events of the telemd-kubernetes-adapter)
+default_tick = 0.05
+
+adapter_deployment = 'telemd-kubernetes-adapter'
+
+
+class Simulation:
+
+    def __init__(self, nodes: Dict[str, str], startup_delay: float = default_startup_delay,
+                 service_time: float = default_service_time, tick: float = default_tick):
+        """
+        :param nodes: zone by node, every zone gets a load balancer and every node a galileo worker and telemd
+        :param startup_delay: seconds until a spawned pod is ready
+        :param service_time: simulated response time of every request
+        :param tick: seconds between two telemetry values of a node
+        """
+        self.nodes = nodes
+        self.tick = tick
+        self.rds = FakeRedis(decode_responses=True)
+        self.cluster = FakeCluster(nodes, startup_delay)
+        self.etcd = FakeEtcdClient()
+        self.table = FakeRoutingTable()
+        self.ctrl = FakeClusterController(self.rds, self.table, [f'galileo-worker-{node}' for node in nodes],
+                                          service_time)
+        for zone in sorted(set(nodes.values())):
+            self.cluster.add_load_balancer(zone)
+        self.cluster.deployment_listeners.append(self._on_deployment)
+        self._unpaused: Set[str] = set()
+        self._adapter = False
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pubsub = None
+        self._pubsub_thread = None
+        # the experiment database, a SQLite file that exists while the simulation is installed
+        self.db = None
+        self._db_dir = None
+
+    def context(self) -> Dict:
+        """
+        :return: a galileo context like `galileo.shell.shell.init` creates it, with a new experiment, plus the
+                 experiment database (`db`)
+        """
+        return {
+            'g': Galileo(self.ctrl),
+            'rtbl': RoutingTableHelper(self.table),
+            'exp': FakeExperiment(self.rds, self.db),
+            'telemd': Telemd(TelemetryController(self.rds)),
+            'rds': self.rds,
+            'db': self.db
+        }
+
+    def _on_deployment(self, name: str, created: bool):
+        if name == adapter_deployment:
+            self._adapter = created
+
+    def _on_telemd_command(self, message):
+        # channel: telemcmd/<node>
+        node = message['channel'].split('/', maxsplit=1)[1]
+        if message['data'] == 'pause':
+            self._unpaused.discard(node)
+        elif message['data'] == 'unpause':
+            self._unpaused.add(node)
+
+    def _run(self):
+        while not self._stopped.wait(self.tick):
+            now = time.time()
+            for node in list(self._unpaused):
+                self.rds.publish(f'telem/{node}/cpu', f'{now} 50.0')
+            if self._adapter:
+                self.rds.publish('galileo/events', f'{now} pod/running')
+
+    def install(self) -> 'Simulation':
+        set_kube_client(FakeKubernetesClient(self.cluster))
+        set_topology(None)
+        with EtcdClient._shared_lock:
+            EtcdClient._shared = self.etcd
+        self._db_dir = tempfile.mkdtemp(prefix='galileo-sim-')
+        self.db = ExperimentSQLDatabase(SqliteAdapter(os.path.join(self._db_dir, 'galileodb.sqlite')))
+        self.db.open()
+        # every node runs a telemd daemon that listens for pause and unpause commands
+        self._pubsub = self.rds.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{f'telemcmd/{node}': self._on_telemd_command for node in self.nodes})
+        self._pubsub_thread = self._pubsub.run_in_thread(sleep_time=0.01, daemon=True)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='simulation', daemon=True)
+        self._thread.start()
+        logger.info(f'Installed simulation of {len(self.nodes)} node(s)')
+        return self
+
+    def uninstall(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._pubsub_thread.stop()
+            self._pubsub.close()
+        set_topology(None)
+        set_kube_client(None)
+        with EtcdClient._shared_lock:
+            EtcdClient._shared = None
+        if self.db is not None:
+            self.db.close()
+            shutil.rmtree(self._db_dir, ignore_errors=True)
+            self.db = None
+            self._db_dir = None
+
+    def __enter__(self) -> 'Simulation':
+        return self.install()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.uninstall()
+
+    def api_calls(self) -> Dict[str, int]:
+        """
+        :return: the number of calls by backend and operation, e.g., `k8s/create_namespaced_pod`
+        """
+        calls = {}
+        for backend, counter in [('k8s', self.cluster.calls), ('etcd', self.etcd.calls), ('redis', self.rds.calls),
+                                 ('galileo', self.ctrl.calls)]:
+            for name, count in counter.items():
+                calls[f'{backend}/{name}'] = count
+        return calls
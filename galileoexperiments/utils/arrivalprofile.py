@@ -1,25 +1,335 @@
+import abc
+import hashlib
+import json
+import logging
+import os
 import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Tuple, Dict, Iterator, Union
 
+import numpy as np
 import redis
 from galileo.worker.api import ClientDescription
 
+logger = logging.getLogger(__name__)
+
+# number of inter-arrivals sent with one LPUSH command
+default_chunk_size = 10_000
+
+# number of LPUSH commands buffered in the pipeline before it is flushed
+default_pipeline_depth = 10
+
+# replaces inter-arrivals of 0, because they may lead to a crash
+min_ia = 0.00000000001
+
+# upper bound for the size of all profiles held by the default profile cache
+default_cache_size = 512 * 1024 * 1024
+
+# number of profiles uploaded concurrently by `upload_profiles`
+default_upload_concurrency = 8
+
+# digests outlive the lists (galileo clients only delete the list), therefore they expire
+digest_ttl = 24 * 60 * 60
+
+
+@dataclass
+class UploadStats:
+    list_key: str
+    # number of inter-arrivals written
+    entries: int
+    # payload size in bytes (encoded values, without protocol overhead)
+    bytes: int
+    # time in seconds it took to clear and write the list
+    elapsed: float
+    # True if the list already contained the profile and the upload was skipped
+    skipped: bool = False
+
+
+class ProfileSource(abc.ABC):
+    """
+    A profile that produces its inter-arrivals lazily, chunk by chunk.
+    Iterating `chunks` twice must yield the same inter-arrivals.
+    """
+
+    @abc.abstractmethod
+    def chunks(self, chunk_size: int = default_chunk_size) -> Iterator[np.ndarray]: ...
+
+    @abc.abstractmethod
+    def to_metadata(self) -> Dict:
+        """
+        :return: a JSON serializable description that allows to reproduce the profile
+        """
+        ...
+
+    def digest(self) -> str:
+        value = json.dumps(self.to_metadata(), sort_keys=True)
+        return hashlib.sha1(value.encode()).hexdigest()
+
+
+Profile = Union[str, ProfileSource]
+
+
+@dataclass
+class CachedProfile:
+    ias: np.ndarray
+    # sha1 of the inter-arrivals as they are written to redis (i.e., with zeros replaced)
+    digest: str
+
+    @property
+    def nbytes(self) -> int:
+        # memory-mapped profiles are read from the page cache and not resident in the process
+        if isinstance(self.ias, np.memmap):
+            return 0
+        return self.ias.nbytes
+
+
+class ProfileCache:
+    """
+    In-process LRU cache of loaded profiles and their digests.
+    Entries are keyed by path, modification time and size of the file, so a changed file is loaded again.
+    The least recently used profiles are evicted as soon as the cached profiles exceed `max_bytes`, memory-mapped
+    profiles do not count towards it.
+    """
+
+    def __init__(self, max_bytes: int = default_cache_size):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._profiles: OrderedDict[Tuple[str, int, int], CachedProfile] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, profile_path: str) -> CachedProfile:
+        stat = os.stat(profile_path)
+        key = (os.path.abspath(profile_path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            profile = self._profiles.get(key)
+            if profile is not None:
+                self._profiles.move_to_end(key)
+                return profile
+
+        ias = load_profile(profile_path)
+        profile = CachedProfile(ias, profile_digest(ias))
+
+        with self._lock:
+            if key not in self._profiles:
+                self._profiles[key] = profile
+                self._size += profile.nbytes
+                self._evict()
+        return profile
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+            self._size = 0
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._profiles) > 0:
+            _, evicted = self._profiles.popitem(last=False)
+            self._size -= evicted.nbytes
+
+
+profile_cache = ProfileCache()
+
+
+class FileProfile(ProfileSource):
+    """
+    A profile stored on disk, see `load_profile` for the supported formats.
+    """
+
+    def __init__(self, profile_path: str, cache: ProfileCache = None):
+        self.profile_path = profile_path
+        self.cache = cache if cache is not None else profile_cache
+
+    def chunks(self, chunk_size: int = default_chunk_size) -> Iterator[np.ndarray]:
+        ias = self.cache.get(self.profile_path).ias
+        for offset in range(0, len(ias), chunk_size):
+            yield ias[offset:offset + chunk_size]
+
+    def to_metadata(self) -> Dict:
+        return {
+            'type': 'file',
+            'path': self.profile_path
+        }
+
+    def digest(self) -> str:
+        return self.cache.get(self.profile_path).digest
+
+
+def as_profile_source(profile: Profile, cache: ProfileCache = None) -> ProfileSource:
+    if isinstance(profile, ProfileSource):
+        return profile
+    return FileProfile(profile, cache)
+
+
+def profile_metadata(profile: Profile):
+    """
+    :return: the value that describes the profile in the experiment metadata (type and path for files)
+    """
+    return as_profile_source(profile).to_metadata()
+
 
 def clear_list(list_key: str, rds: redis.Redis):
-    while rds.llen(list_key) != 0:
-        rds.lpop(list_key)
+    rds.delete(list_key)
 
 
-def read_and_save_profile(profile_path: str, client_desc: ClientDescription, rds: redis.Redis):
+def load_profile(profile_path: str) -> np.ndarray:
+    """
+    Loads the inter-arrivals of a profile.
+    Profiles stored as `.npy` (1-dimensional, float64) are memory-mapped and therefore read lazily, all other files
+    are treated as pickled lists of floats.
+    :param profile_path: path to the profile
+    :return: the inter-arrivals as float64 array
+    """
+    if profile_path.endswith('.npy'):
+        ias = np.load(profile_path, mmap_mode='r')
+        if ias.ndim != 1 or ias.dtype != np.float64:
+            raise ValueError(f'Profile {profile_path} must be a 1-dimensional float64 array, '
+                             f'got {ias.ndim} dimension(s) of {ias.dtype}')
+        return ias
     with open(profile_path, 'rb') as fd:
-        ias = pickle.load(fd)
-        for index, ia in enumerate(ias):
-            if ia == 0:
-                # prevents of using 0 because it may lead to crash
-                ias[index] = 0.00000000001
-        list_key = client_desc.client_id
-        print(f'clear list, with key: {list_key}')
-        clear_list(list_key, rds)
-        print('list cleared, start push')
-        rds.lpush(list_key, *ias[0:])
-        llen = rds.llen(list_key)
-        print('pushed list')
+        return np.asarray(pickle.load(fd), dtype=np.float64)
+
+
+def convert_profile(pickle_path: str, npy_path: str = None) -> str:
+    """
+    Converts a pickled profile into the `.npy` format that can be memory-mapped by `load_profile`.
+    :param pickle_path: path to the pickled list of inter-arrivals
+    :param npy_path: target path, defaults to the pickle path with the extension replaced by `.npy`
+    :return: the path of the written file
+    """
+    if npy_path is None:
+        npy_path = f'{os.path.splitext(pickle_path)[0]}.npy'
+    with open(pickle_path, 'rb') as fd:
+        ias = np.asarray(pickle.load(fd), dtype='<f8')
+    np.save(npy_path, ias, allow_pickle=False)
+    return npy_path
+
+
+def fix_zero_ias(ias: np.ndarray) -> np.ndarray:
+    # prevents of using 0 because it may lead to crash
+    return np.where(ias == 0, min_ia, ias)
+
+
+def profile_digest(ias: np.ndarray, chunk_size: int = 1_000_000) -> str:
+    digest = hashlib.sha1()
+    for offset in range(0, len(ias), chunk_size):
+        chunk = fix_zero_ias(ias[offset:offset + chunk_size])
+        digest.update(np.ascontiguousarray(chunk, dtype='<f8').tobytes())
+    return digest.hexdigest()
+
+
+def digest_key(list_key: str) -> str:
+    return f'{list_key}:digest'
+
+
+def is_uploaded(list_key: str, digest: str, rds: redis.Redis) -> bool:
+    """
+    Checks whether the list already holds the profile with the given digest.
+    Galileo clients delete their list as soon as they read it, therefore the length is compared too.
+    """
+    pipe = rds.pipeline(transaction=False)
+    pipe.get(digest_key(list_key))
+    pipe.llen(list_key)
+    stored, llen = pipe.execute()
+    if stored is None:
+        return False
+    if isinstance(stored, bytes):
+        stored = stored.decode()
+    stored_digest, _, entries = stored.partition(':')
+    return stored_digest == digest and str(llen) == entries
+
+
+def _encode(ias: np.ndarray) -> List[bytes]:
+    # same encoding redis-py uses for floats, done once here so we can count the payload
+    return [repr(ia).encode() for ia in fix_zero_ias(ias).tolist()]
+
+
+def upload_chunks(list_key: str, chunks: Iterator[np.ndarray], rds: redis.Redis,
+                  pipeline_depth: int = default_pipeline_depth, digest: str = None) -> UploadStats:
+    """
+    Replaces the content of the list with the given chunks of inter-arrivals.
+    The key is deleted and every chunk is pushed with one LPUSH through a non-transactional pipeline, which is
+    flushed every `pipeline_depth` chunks. The resulting list equals `rds.lpush(list_key, *ias)`.
+    Zero inter-arrivals are replaced chunk-wise, therefore the whole profile is never held in memory.
+    :param list_key: the redis list to write
+    :param chunks: the inter-arrivals
+    :param rds: redis client
+    :param pipeline_depth: max. number of commands sent in one round trip
+    :param digest: optional digest of the profile, stored next to the list once the upload is done
+    :return: stats about the upload
+    """
+    start = time.time()
+    entries = 0
+    size = 0
+    pipe = rds.pipeline(transaction=False)
+    pipe.delete(list_key, digest_key(list_key))
+    for ias in chunks:
+        if len(ias) == 0:
+            continue
+        chunk = _encode(ias)
+        entries += len(chunk)
+        size += sum(len(value) for value in chunk)
+        pipe.lpush(list_key, *chunk)
+        if len(pipe) >= pipeline_depth:
+            pipe.execute()
+    if digest is not None:
+        pipe.set(digest_key(list_key), f'{digest}:{entries}', ex=digest_ttl)
+    pipe.execute()
+    stats = UploadStats(list_key, entries, size, time.time() - start)
+    logger.debug(f'Uploaded {stats.entries} entries ({stats.bytes} bytes) to {list_key} in {stats.elapsed:.3f}s')
+    return stats
+
+
+def upload_profile(list_key: str, ias: np.ndarray, rds: redis.Redis, chunk_size: int = default_chunk_size,
+                   pipeline_depth: int = default_pipeline_depth, digest: str = None) -> UploadStats:
+    """
+    Replaces the content of the list with the given inter-arrivals, see `upload_chunks`.
+    :param chunk_size: max. number of values per LPUSH command
+    """
+    chunks = (ias[offset:offset + chunk_size] for offset in range(0, len(ias), chunk_size))
+    return upload_chunks(list_key, chunks, rds, pipeline_depth, digest)
+
+
+def read_and_save_profile(profile: Profile, client_desc: ClientDescription, rds: redis.Redis,
+                          cache: ProfileCache = None) -> UploadStats:
+    """
+    Uploads the profile to the list of the given client, unless the list already contains it.
+    :param profile: path to the profile or a `ProfileSource`
+    :param client_desc: the galileo client that reads the profile
+    :param rds: redis client
+    :param cache: profile cache for files, defaults to the module-wide `profile_cache`
+    :return: stats about the upload
+    """
+    source = as_profile_source(profile, cache)
+    digest = source.digest()
+    list_key = client_desc.client_id
+    if is_uploaded(list_key, digest, rds):
+        logger.info(f'Profile {profile_metadata(source)} already uploaded to list with key: {list_key}')
+        return UploadStats(list_key, rds.llen(list_key), 0, 0, skipped=True)
+    logger.info(f'Upload profile {profile_metadata(source)} to list with key: {list_key}')
+    stats = upload_chunks(list_key, source.chunks(), rds, digest=digest)
+    logger.info(f'Pushed {stats.entries} entries ({stats.bytes} bytes) in {stats.elapsed:.3f}s')
+    return stats
+
+
+def upload_profiles(uploads: List[Tuple[Profile, ClientDescription]], rds: redis.Redis,
+                    concurrency: int = default_upload_concurrency,
+                    cache: ProfileCache = None) -> Dict[str, UploadStats]:
+    """
+    Uploads the profiles of many clients concurrently, sharing the connection pool of the given redis client.
+    :param uploads: pairs of profile and the client that reads it
+    :param rds: redis client
+    :param concurrency: max. number of uploads in flight
+    :param cache: profile cache for files, defaults to the module-wide `profile_cache`
+    :return: upload stats by client id
+    """
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [executor.submit(read_and_save_profile, profile, client_desc, rds, cache)
+                   for profile, client_desc in uploads]
+        stats = [future.result() for future in futures]
+    logger.info(f'Uploaded {len(uploads)} profiles in {time.time() - start:.3f}s')
+    return {s.list_key: s for s in stats}
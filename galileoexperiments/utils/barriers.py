@@ -0,0 +1,154 @@
+"""
+Readiness conditions that replace fixed sleeps during the setup and teardown of an experiment.
+Every barrier returns as soon as its condition holds and raises a `TimeoutError` otherwise.
+"""
+import logging
+import time
+from typing import List, Callable
+
+import redis
+from galileo.shell.shell import Galileo, ClientGroup
+from galileodb.reporter.traces import RedisTraceReporter
+
+logger = logging.getLogger(__name__)
+
+# max. seconds a single setup barrier waits
+default_setup_timeout = 30
+
+# the drain ends once no trace arrived for this many seconds
+default_drain_quiet_period = 1
+
+# max. seconds to wait for the last traces after the requests are done
+default_drain_timeout = 5
+
+default_poll_interval = 0.05
+
+
+def wait_until(condition: Callable[[], bool], timeout: float, description: str,
+               poll_interval: float = default_poll_interval) -> float:
+    """
+    Polls the condition until it holds.
+    :return: the seconds it took
+    :raises TimeoutError: if the condition did not hold within `timeout` seconds
+    """
+    start = time.time()
+    while not condition():
+        if time.time() - start >= timeout:
+            raise TimeoutError(f'Timed out after {timeout}s waiting for {description}')
+        time.sleep(poll_interval)
+    elapsed = time.time() - start
+    logger.debug(f'Waited {elapsed:.3f}s for {description}')
+    return elapsed
+
+
+def discover_workers(galileo: Galileo, timeout: float = default_setup_timeout) -> List[str]:
+    """
+    Sends a discover command and waits until every worker that received it registered again.
+    :return: the registered workers
+    """
+    expected = galileo.discover()
+    workers = []
+
+    def registered():
+        nonlocal workers
+        workers = list(galileo.workers())
+        return len(workers) >= max(1, expected)
+
+    wait_until(registered, timeout, f'{expected} worker(s) to register')
+    return workers
+
+
+def start_tracing(galileo: Galileo, workers: List[str], timeout: float = default_setup_timeout):
+    """
+    Starts tracing and waits until all workers answered a subsequent ping. Workers handle commands in order, therefore
+    an answered ping acknowledges the start tracing command.
+    """
+    galileo.start_tracing()
+
+    def acknowledged():
+        responses = [r for r in galileo.ping() if not isinstance(r, tuple)]
+        return len(responses) >= len(workers)
+
+    wait_until(acknowledged, timeout, f'{len(workers)} worker(s) to acknowledge tracing')
+
+
+def wait_for_telemd(rds: redis.Redis, hosts: List[str], timeout: float = default_setup_timeout,
+                    required: bool = True):
+    """
+    Waits until telemetry was received from each of the given hosts.
+    :param required: if False, hosts without telemetry are only logged after the timeout instead of raising an error
+    """
+    pending = set(hosts)
+    if len(pending) == 0:
+        return
+    p = rds.pubsub(ignore_subscribe_messages=True)
+    p.psubscribe(*[f'telem/{host}/*' for host in pending])
+    deadline = time.time() + timeout
+    try:
+        while len(pending) > 0:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                if not required:
+                    logger.warning(f'No telemetry within {timeout}s of: {sorted(pending)}, continue without')
+                    return
+                raise TimeoutError(f'Timed out after {timeout}s waiting for telemetry of: {sorted(pending)}')
+            message = p.get_message(timeout=min(remaining, 1))
+            if message is None:
+                continue
+            channel = message['channel']
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            pending.discard(channel.split('/', maxsplit=2)[1])
+    finally:
+        p.close()
+
+
+def trace_subscribers(rds: redis.Redis) -> int:
+    return rds.pubsub_numsub(RedisTraceReporter.channel)[0][1]
+
+
+def wait_for_trace_subscribers(rds: redis.Redis, previous: int, timeout: float = default_setup_timeout):
+    """
+    Waits until more than `previous` subscribers listen for traces, i.e., until a just started experiment recorder is
+    ready to record.
+    """
+    wait_until(lambda: trace_subscribers(rds) > previous, timeout, 'the experiment recorder to subscribe to traces')
+
+
+def wait_for_clients(client_group: ClientGroup, timeout: float = default_setup_timeout):
+    """
+    Waits until all clients of the group are registered.
+    """
+    expected = {client.client_id for client in client_group.clients}
+
+    def registered():
+        return expected.issubset(client.client_id for client in client_group.ctrl.list_clients())
+
+    wait_until(registered, timeout, f'{len(expected)} client(s) to register')
+
+
+def drain_traces(rds: redis.Redis, quiet_period: float = default_drain_quiet_period,
+                 timeout: float = default_drain_timeout) -> int:
+    """
+    Waits for traces of requests that are still in flight: returns as soon as no trace arrived for `quiet_period`
+    seconds, or after `timeout` seconds at the latest.
+    :return: the number of traces that arrived during the drain
+    """
+    p = rds.pubsub(ignore_subscribe_messages=True)
+    p.subscribe(RedisTraceReporter.channel)
+    start = time.time()
+    last = start
+    received = 0
+    try:
+        while True:
+            now = time.time()
+            if now - last >= quiet_period or now - start >= timeout:
+                break
+            message = p.get_message(timeout=min(quiet_period - (now - last), timeout - (now - start)))
+            if message is not None:
+                received += 1
+                last = time.time()
+    finally:
+        p.close()
+    logger.info(f'Drained {received} trace(s) in {time.time() - start:.3f}s')
+    return received
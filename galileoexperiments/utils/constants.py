@@ -5,6 +5,10 @@ api_gateway_type_label = 'api-gateway'
 function_type_label = 'fn'
 client_role_label = 'node-role.kubernetes.io/client'
 worker_role_label = 'node-role.kubernetes.io/worker'
+# identifies all pods spawned for one experiment run
+run_label = 'galileo.edgerun.io/run'
+# identifies all pods of one pod pool, see `galileoexperiments.utils.podpool`
+pool_label = 'galileo.edgerun.io/pool'
 
 # Pod status constants
 pod_not_running = 'Not Running'
@@ -0,0 +1,148 @@
+"""
+Ends the requests of a profiling run once throughput and latency estimates are precise enough.
+The estimates are batch means: consecutive windows of the `LatencyAggregator` (e.g., one second) are merged into
+batches of enough requests for a meaningful latency quantile, every batch yields one throughput and one quantile, their
+confidence intervals shrink with the number of batches.
+"""
+import logging
+import math
+import statistics
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from galileoexperiments.api.model import EarlyStoppingConfiguration
+from galileoexperiments.utils.latency import LatencyAggregator, LatencySketch, Window
+
+logger = logging.getLogger(__name__)
+
+stop_reason_event = 'stop_reason'
+
+# the requests ended by themselves
+completed = 'completed'
+converged = 'converged'
+slo_breach = 'slo_breach'
+error_rate = 'error_rate'
+
+
+def _is_precise(values: List[float], precision: float, z: float) -> bool:
+    if len(values) < 2:
+        return False
+    mean = statistics.mean(values)
+    if mean <= 0:
+        return False
+    half_width = z * statistics.stdev(values) / math.sqrt(len(values))
+    return half_width <= precision * mean
+
+
+def _batches(windows: List[Window], min_requests: int, relative_accuracy: float) -> Tuple[List[LatencySketch], int]:
+    """
+    Merges consecutive windows into batches of equal length that hold `min_requests` requests on average. An
+    incomplete last batch and batches with fewer requests are left out.
+    :return: the sketches of the batches and the number of windows per batch
+    """
+    total = sum(w.sketch.count for w in windows)
+    if total == 0:
+        return [], 0
+    size = max(1, math.ceil(min_requests * len(windows) / total))
+    batches = []
+    for offset in range(0, len(windows) - size + 1, size):
+        sketch = LatencySketch(relative_accuracy)
+        for window in windows[offset:offset + size]:
+            sketch.merge(window.sketch)
+        if sketch.count >= min_requests:
+            batches.append(sketch)
+    return batches, size
+
+
+class EarlyStopper:
+
+    def __init__(self, aggregator: LatencyAggregator, config: EarlyStoppingConfiguration, zone: str = None,
+                 group: str = None):
+        """
+        :param aggregator: the aggregator of the run, it may also receive the traces of other clients
+        :param config: the early stopping configuration
+        :param zone: only the traces of clients labeled with this zone are considered, all if None
+        :param group: only the traces of clients labeled with this group are considered, all if None
+        """
+        self.aggregator = aggregator
+        self.config = config
+        self.zone = zone
+        self.group = group
+        self.started: Optional[float] = None
+        self._z = statistics.NormalDist().inv_cdf(0.5 + config.confidence / 2)
+        if config.batch_requests is not None:
+            self.batch_requests = config.batch_requests
+        else:
+            self.batch_requests = math.ceil(100 / (1 - config.quantile))
+
+    def check(self, now: float = None) -> Optional[str]:
+        """
+        :return: the reason to stop the requests now, or None to continue
+        """
+        now = now if now is not None else time.time()
+        config = self.config
+        resolution = self.aggregator.resolution
+        windows = self.aggregator.windows(since=self.started, now=now, zone=self.zone, group=self.group)
+
+        recent = windows[-max(1, math.ceil(config.breach_window / resolution)):]
+        sketch = LatencySketch(self.aggregator.relative_accuracy)
+        errors = 0
+        for window in recent:
+            sketch.merge(window.sketch)
+            errors += window.errors
+        total = sketch.count + errors
+        if total >= config.min_requests:
+            if config.max_error_rate is not None and errors / total > config.max_error_rate:
+                logger.info(f'Error rate {errors / total:.3f} exceeds {config.max_error_rate}')
+                return error_rate
+            if config.slo is not None and sketch.count > 0 and sketch.quantile(config.quantile) > config.slo:
+                logger.info(f'Latency p{config.quantile * 100:g} {sketch.quantile(config.quantile):.4f}s exceeds '
+                            f'{config.slo}s')
+                return slo_breach
+
+        if self.started is not None:
+            windows = [w for w in windows if w.start >= self.started + config.warmup]
+        if len(windows) < config.min_windows:
+            return None
+        batches, size = _batches(windows, self.batch_requests, self.aggregator.relative_accuracy)
+        if len(batches) < config.min_batches:
+            return None
+        throughputs = [b.count / (size * resolution) for b in batches]
+        latencies = [b.quantile(config.quantile) for b in batches]
+        if _is_precise(throughputs, config.precision, self._z) and _is_precise(latencies, config.precision, self._z):
+            return converged
+        return None
+
+    def run(self, wait: Callable[[], None], stop: Callable[[], None]) -> str:
+        """
+        Calls `wait` (blocks until the requests are done) and checks the estimates every `check_interval` seconds
+        meanwhile. Calls `stop` if the requests should end early, `wait` is expected to return shortly after.
+        :return: the reason why the requests ended
+        """
+        self.started = time.time()
+        errors = []
+
+        def target():
+            try:
+                wait()
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=target, name='early-stopping', daemon=True)
+        thread.start()
+        reason = completed
+        while True:
+            thread.join(self.config.check_interval)
+            if not thread.is_alive():
+                break
+            check = self.check()
+            if check is not None:
+                reason = check
+                logger.info(f'Stop requests after {time.time() - self.started:.1f}s: {reason}')
+                stop()
+                thread.join()
+                break
+        if len(errors) > 0:
+            raise errors[0]
+        return reason
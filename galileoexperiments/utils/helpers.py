@@ -1,18 +1,35 @@
 import json
 import logging
 import os
-from typing import List, Dict, Tuple
+import threading
+import time
+from typing import List, Dict, Tuple, Iterable, Callable
 
 import etcd3
 
 from galileoexperiments.api.model import Pod
 from galileoexperiments.utils.constants import function_label, zone_label
+from galileoexperiments.utils.weights import WeightPolicy, compute_weights
 
 logger = logging.getLogger(__name__)
 
+# etcd rejects transactions with more operations than this (default of --max-txn-ops)
+max_txn_ops = 128
+
+# max. seconds to wait until the load balancers confirmed written weights
+default_propagation_timeout = 10
+
+# seconds the load balancers are given to pick up written weights from their etcd watch if they cannot be probed
+default_propagation_delay = 1
+
+# checks whether a load balancer pod applied the given weights of a function, see `WeightWriter.wait_for_propagation`
+WeightProbe = Callable[[Pod, str, Dict], bool]
+
 
 class EtcdClient:
     _etcd_client: etcd3
+    _shared: 'EtcdClient' = None
+    _shared_lock = threading.Lock()
 
     def __init__(self, etcd_host: str, etcd_port: int):
         self.etcd_host = etcd_host
@@ -26,37 +43,148 @@ class EtcdClient:
         logger.info(f"Connect to etcd instance {etcd_host}:{etcd_port}")
         return EtcdClient(etcd_host, etcd_port)
 
+    @staticmethod
+    def shared() -> 'EtcdClient':
+        """
+        :return: a process-wide client (created with `from_env` on first use) that reuses one gRPC channel
+        """
+        with EtcdClient._shared_lock:
+            if EtcdClient._shared is None:
+                EtcdClient._shared = EtcdClient.from_env()
+            return EtcdClient._shared
+
     def write(self, key: str, value: str):
         self._etcd_client.put(key, value)
 
     def remove(self, key: str):
         self._etcd_client.delete(key)
 
+    def _commit(self, ops: List):
+        """
+        Executes the operations in as few transactions as possible.
+        """
+        for offset in range(0, len(ops), max_txn_ops):
+            self._etcd_client.transaction(compare=[], success=ops[offset:offset + max_txn_ops])
 
-def set_weights_rr(pods: List[Pod], cluster: str, fn: str):
-    client = EtcdClient.from_env()
-    weights = {
+    def write_all(self, values: Dict[str, str]):
+        """
+        Writes all key-value pairs in one transaction (or one per `max_txn_ops` keys).
+        """
+        ops = [self._etcd_client.transactions.put(key, value) for key, value in values.items()]
+        self._commit(ops)
+
+    def remove_all(self, keys: Iterable[str]):
+        """
+        Deletes all keys in one transaction (or one per `max_txn_ops` keys).
+        """
+        ops = [self._etcd_client.transactions.delete(key) for key in keys]
+        self._commit(ops)
+
+
+def weight_key(zone: str, fn: str) -> str:
+    return f'golb/function/{zone}/{fn}'
+
+
+def rr_weights(pods: List[Pod]) -> Dict:
+    return {
         "ips": [f'{pod.ip}:8080' for pod in pods],
         "weights": [1] * len(pods)
     }
-    key = f'golb/function/{cluster}/{fn}'
-    value = json.dumps(weights)
+
+
+class WeightWriter:
+    """
+    Collects the weights of several functions and zones and writes them at once, so the load balancers never see a
+    partially updated weight table. All writers share one etcd connection by default.
+    """
+
+    def __init__(self, client: EtcdClient = None):
+        self.client = client if client is not None else EtcdClient.shared()
+        self._weights: Dict[Tuple[str, str], Dict] = {}
+        # weights of the last commit by (zone, function)
+        self.committed: Dict[Tuple[str, str], Dict] = {}
+
+    def set(self, zone: str, fn: str, weights: Dict) -> str:
+        self._weights[(zone, fn)] = weights
+        return weight_key(zone, fn)
+
+    def set_rr(self, pods: List[Pod], zone: str, fn: str) -> str:
+        return self.set(zone, fn, rr_weights(pods))
+
+    def commit(self) -> List[str]:
+        """
+        Writes all collected weights in a single transaction (chunked if there are more than `max_txn_ops`).
+        :return: the keys that were written
+        """
+        values = {weight_key(zone, fn): json.dumps(weights) for (zone, fn), weights in self._weights.items()}
+        for key, value in values.items():
+            logger.info(f'Set following in etcd {key} - {value}')
+        self.client.write_all(values)
+        self.committed = self._weights
+        self._weights = {}
+        return list(values.keys())
+
+    def remove(self, keys: List[str]):
+        if len(keys) == 0:
+            return
+        logger.info(f'Remove {len(keys)} weight(s) from etcd')
+        self.client.remove_all(keys)
+
+    def wait_for_propagation(self, lbs: Dict[str, Pod] = None, probe: WeightProbe = None,
+                             timeout: float = default_propagation_timeout, poll_interval: float = 0.1,
+                             delay: float = default_propagation_delay):
+        """
+        Blocks until every load balancer reports the weights of its zone of the last commit as applied.
+        Without probe (or load balancers), whether the load balancers picked up the weights cannot be observed, it
+        waits `delay` seconds (at most `timeout`) instead.
+        :param lbs: load balancer pods by zone
+        :param probe: called with load balancer, function and expected weights, returns True once they are applied
+        :param timeout: max. seconds to wait for all load balancers
+        :param poll_interval: seconds between two probes of a load balancer
+        :param delay: seconds to wait without probe
+        :raises TimeoutError: if the weights did not propagate in time
+        """
+        if len(self.committed) == 0:
+            return
+        if probe is None or lbs is None:
+            logger.info(f'Committed weights of {len(self.committed)} key(s), propagation is not probed, '
+                        f'wait {min(delay, timeout)}s')
+            time.sleep(min(delay, timeout))
+            return
+        start = time.time()
+        pending = [(lbs[zone], fn, weights) for (zone, fn), weights in self.committed.items() if zone in lbs]
+        while True:
+            pending = [(lb, fn, weights) for lb, fn, weights in pending if not probe(lb, fn, weights)]
+            if len(pending) == 0:
+                break
+            if time.time() - start >= timeout:
+                missing = [f'{lb.name}: {fn}' for lb, fn, _ in pending]
+                raise TimeoutError(f'Load balancers did not apply weights within {timeout}s: {missing}')
+            time.sleep(poll_interval)
+        logger.info(f'Weights of {len(self.committed)} key(s) propagated in {time.time() - start:.3f}s')
+
+
+def set_weights_rr(pods: List[Pod], cluster: str, fn: str):
+    client = EtcdClient.shared()
+    key = weight_key(cluster, fn)
+    value = json.dumps(rr_weights(pods))
     logger.info(f'Set following in etcd {key} - {value}')
     client.write(key=key, value=value)
     return key
 
 
 def set_weight(pod: Pod, weight: int):
-    client = EtcdClient.from_env()
+    client = EtcdClient.shared()
     zone = pod.labels[zone_label]
     fn = pod.labels[function_label]
     ip = pod.ip
-    key = f'golb/function/{zone}/{fn}'
+    key = weight_key(zone, fn)
     value = json.dumps({"ips": [f'{ip}:8080'], "weights": [weight]})
     client.write(key=key, value=value)
 
 
-def update_weights(pods_per_cluster: Dict[Tuple[str, str], List[Pod]], lbs: Dict[str, Pod]) -> List[str]:
+def update_weights(pods_per_cluster: Dict[Tuple[str, str], List[Pod]], lbs: Dict[str, Pod],
+                   writer: WeightWriter = None, policy: WeightPolicy = None) -> List[str]:
     """
     Sets load balancer weights according to the given arguments.
     Sets for each cluster the internal Pods, as well as adds other clusters that also host the function.
@@ -64,47 +192,12 @@ def update_weights(pods_per_cluster: Dict[Tuple[str, str], List[Pod]], lbs: Dict
     will re-direct requests to that cluster.
     :param pods_per_cluster: a dict, that contains a List of Pods for each Tuple[function, cluster]
     :param lbs: a dict, keyed by cluster and containing the  associated load balancer pod
+    :param writer: writer that commits all weights in one transaction, a new one is created if None
+    :param policy: decides the weight of pods and remote clusters, see `compute_weights` (round robin by default)
     :return: list of etcd keys that were written
     """
-    keys = []
-    for pair in pods_per_cluster.keys():
-        fn = pair[0]
-        cluster = pair[1]
-        # fetch pods in cluster
-        pods = pods_per_cluster[pair].copy()
-
-        # look for other clusters that node the function
-        for lb_cluster, lb_pod in lbs.items():
-            if lb_cluster == cluster:
-                continue
-            else:
-                pods_of_cluster = pods_per_cluster.get((fn, lb_cluster))
-                if pods_of_cluster is not None and len(pods_of_cluster) > 0:
-                    pods.append(lb_pod)
-
-        # update weights
-        keys.append(set_weights_rr(pods, cluster, fn))
-
-    # set also weights for clusters that do not host any instance and re-route them to the others
-    for fn,_ in pods_per_cluster.keys():
-        for cluster in lbs.keys():
-            pods_of_cluster = pods_per_cluster.get((fn, cluster))
-            if pods_of_cluster is not None:
-                # we can skip this case, because weights have already been set before
-                continue
-
-            # look for clusters that host the function
-            other_lbs = []
-            for other_cluster in lbs.keys():
-                if cluster == other_cluster:
-                    pass
-                pods_of_other_cluster = pods_per_cluster.get((fn, other_cluster))
-                if pods_of_other_cluster is not None:
-                    # we have found a cluster that hosts the function, we add its load balancer to the list
-                    other_lbs.append(lbs[other_cluster])
-
-            # set the weights for the cluster that has no Pods and re-direct all requests equally to all other clusters
-            # that host a function
-            keys.append(set_weights_rr(other_lbs, cluster, fn))
-
-    return keys
+    if writer is None:
+        writer = WeightWriter()
+    for (zone, fn), weights in compute_weights(pods_per_cluster, lbs, policy).items():
+        writer.set(zone, fn, weights)
+    return writer.commit()
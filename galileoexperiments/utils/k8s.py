@@ -1,23 +1,97 @@
 import logging
+import threading
 import time
-from typing import List, Dict, Callable
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Dict, Callable, Tuple
 
 import kubernetes
 from galileoexperiments.api.model import Pod
-from galileoexperiments.utils.constants import zone_label
-from kubernetes import client, config
+from galileoexperiments.utils.constants import zone_label, pod_failed, pod_type_label, api_gateway_type_label
+from galileoexperiments.utils.timing import timed
+from kubernetes import client, config, watch
+from kubernetes.client.exceptions import ApiException
 from kubernetes.client import V1Deployment, V1ObjectMeta, V1DeploymentSpec, V1LabelSelector, V1PodTemplateSpec, \
     V1PodSpec, V1Toleration, V1Container, V1EnvFromSource, V1ConfigMapEnvSource
 from kubernetes.client import V1EnvVar
 
 logger = logging.getLogger(__name__)
 
+# seconds to wait until spawned pods are ready
+default_pod_timeout = 300
+
+# max. number of concurrent requests when creating or removing pods
+default_max_in_flight = 10
+
+# max. number of connections kept open to the kubernetes api server
+default_pool_maxsize = 32
+
+
+class KubernetesClient:
+    """
+    Holds one api client, and therefore one urllib3 connection pool, that is shared by all helpers in this module.
+    The kubeconfig is loaded lazily on first use.
+    Tests can pass a fake `api_client` or replace the whole client with `set_kube_client`.
+    """
+
+    def __init__(self, api_client: client.ApiClient = None, pool_maxsize: int = default_pool_maxsize):
+        self.pool_maxsize = pool_maxsize
+        self._api_client = api_client
+        self._core_v1 = None
+        self._apps_v1 = None
+        self._lock = threading.Lock()
+
+    @property
+    def api_client(self) -> client.ApiClient:
+        with self._lock:
+            if self._api_client is None:
+                configuration = client.Configuration()
+                config.load_kube_config(client_configuration=configuration)
+                configuration.connection_pool_maxsize = self.pool_maxsize
+                self._api_client = client.ApiClient(configuration)
+            return self._api_client
+
+    @property
+    def core_v1(self) -> client.CoreV1Api:
+        if self._core_v1 is None:
+            self._core_v1 = client.CoreV1Api(self.api_client)
+        return self._core_v1
+
+    @property
+    def apps_v1(self) -> client.AppsV1Api:
+        if self._apps_v1 is None:
+            self._apps_v1 = client.AppsV1Api(self.api_client)
+        return self._apps_v1
+
+    def watch(self) -> watch.Watch:
+        return watch.Watch()
+
+
+_kube_client: KubernetesClient = None
+_kube_client_lock = threading.Lock()
+
+
+def get_kube_client() -> KubernetesClient:
+    global _kube_client
+    with _kube_client_lock:
+        if _kube_client is None:
+            _kube_client = KubernetesClient()
+        return _kube_client
+
+
+def set_kube_client(kube_client: KubernetesClient):
+    """
+    Replaces the client used by all helpers of this module, e.g., with a fake in tests.
+    """
+    global _kube_client
+    with _kube_client_lock:
+        _kube_client = kube_client
 
-def start_telemd_kubernetes_adapter(master_node: str) -> V1Deployment:
-    # Configs can be set in Configuration class directly or using helper utility
-    config.load_kube_config()
 
-    v1 = client.AppsV1Api()
+@timed()
+def start_telemd_kubernetes_adapter(master_node: str) -> V1Deployment:
+    v1 = get_kube_client().apps_v1
     image = 'edgerun/telemd-kubernetes-adapter:0.1.20'
     return v1.create_namespaced_deployment(pretty=True, namespace='default',
                                            body=V1Deployment(
@@ -63,40 +137,164 @@ def start_telemd_kubernetes_adapter(master_node: str) -> V1Deployment:
                                            ))
 
 
+@timed()
 def stop_telemd_kubernetes_adapter():
-    # Configs can be set in Configuration class directly or using helper utility
-    config.load_kube_config()
-
-    v1 = client.AppsV1Api()
+    v1 = get_kube_client().apps_v1
     v1.delete_namespaced_deployment(name='telemd-kubernetes-adapter', namespace='default')
 
 
-def get_pods(pod_names: List[str], v1: client.CoreV1Api = None) -> List[Pod]:
+def _is_ready(pod) -> bool:
+    if pod.status is None or pod.status.pod_ip is None:
+        return False
+    for condition in pod.status.conditions or []:
+        if condition.type == 'Ready':
+            return condition.status == 'True'
+    return False
+
+
+def to_pod(pod) -> Pod:
+    return Pod(pod.metadata.uid, pod.status.pod_ip, pod.metadata.labels, pod.metadata.name, pod.spec.node_name)
+
+
+@timed()
+def wait_for_pods(pod_names: List[str], v1: client.CoreV1Api = None, label_selector: str = None,
+                  timeout: float = default_pod_timeout,
+                  namespace: str = 'default') -> Tuple[List[Pod], Dict[str, float]]:
+    """
+    Waits until all given pods have an IP and are Ready.
+    The pods are listed once and afterwards observed through a watch, thus the function returns as soon as the last
+    pod becomes ready.
+    :param pod_names: names of the pods to wait for
+    :param v1: optional api client
+    :param label_selector: optional selector that matches (at least) the pods, restricts list and watch server-side
+    :param timeout: seconds to wait for all pods
+    :param namespace: the namespace of the pods
+    :return: the pods (in the order of `pod_names`) and the seconds it took until each pod was ready
+    """
     if v1 is None:
-        config.load_kube_config()
-        v1 = client.CoreV1Api()
-    pod_list = v1.list_namespaced_pod("default")
-    pods = []
-    for pod in pod_list.items:
-        if pod.metadata.name in pod_names:
-            ip = pod.status.pod_ip
-            if ip is None:
-                logger.info(f'Pod IP for {pod.metadata.name} is not yet available. Sleep for 5 seconds...')
-                time.sleep(5)
-                return get_pods(pod_names, v1)
-            labels = pod.metadata.labels
-            pod_id = pod.metadata.uid
-            name = pod.metadata.name
-            pods.append(Pod(pod_id, ip, labels, name))
+        v1 = get_kube_client().core_v1
+    start = time.time()
+    deadline = start + timeout
+    pending = set(pod_names)
+    ready: Dict[str, Pod] = {}
+    durations: Dict[str, float] = {}
+
+    def observe(pod):
+        name = pod.metadata.name
+        if name not in pending:
+            return
+        if pod.status is not None and pod.status.phase == pod_failed:
+            raise RuntimeError(f'Pod {name} failed: {pod.status.reason} {pod.status.message}')
+        if _is_ready(pod):
+            pending.remove(name)
+            ready[name] = to_pod(pod)
+            durations[name] = time.time() - start
 
+    resource_version = None
+    while len(pending) > 0:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise TimeoutError(f'Pods not ready after {timeout}s: {sorted(pending)}')
+        if resource_version is None:
+            pod_list = v1.list_namespaced_pod(namespace, label_selector=label_selector)
+            for pod in pod_list.items:
+                observe(pod)
+            resource_version = pod_list.metadata.resource_version
+            continue
+
+        w = get_kube_client().watch()
+        try:
+            for event in w.stream(v1.list_namespaced_pod, namespace, label_selector=label_selector,
+                                  resource_version=resource_version, timeout_seconds=max(1, int(remaining))):
+                if event['type'] in ('ADDED', 'MODIFIED'):
+                    observe(event['object'])
+                if len(pending) == 0:
+                    break
+            resource_version = w.resource_version or resource_version
+        except ApiException as e:
+            if e.status != 410:
+                raise
+            # resource version is too old, list again
+            resource_version = None
+        finally:
+            w.stop()
+
+    for name, duration in durations.items():
+        logger.debug(f'Pod {name} ready after {duration:.2f}s')
+    return [ready[name] for name in pod_names], durations
+
+
+def get_pods(pod_names: List[str], v1: client.CoreV1Api = None, label_selector: str = None,
+             timeout: float = default_pod_timeout) -> List[Pod]:
+    pods, durations = wait_for_pods(pod_names, v1, label_selector, timeout)
+    if len(durations) > 0:
+        logger.info(f'{len(pods)} pod(s) ready after {max(durations.values()):.2f}s')
     return pods
 
 
+@dataclass
+class PodOperationResult:
+    # names of the pods the operation succeeded for
+    succeeded: List[str] = field(default_factory=list)
+    # errors by pod name
+    failed: Dict[str, Exception] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return len(self.failed) == 0
+
+
+class PodSpawnError(Exception):
+
+    def __init__(self, result: PodOperationResult):
+        super().__init__(f'Failed to create {len(result.failed)} pod(s): '
+                         f'{", ".join(f"{name} ({e})" for name, e in result.failed.items())}')
+        self.result = result
+
+
+def new_run_id() -> str:
+    """
+    :return: an id that can be used as value of the `run_label` to identify the pods of one experiment
+    """
+    return uuid.uuid4().hex[:12]
+
+
+@timed()
+def create_pods(pods: List[client.V1Pod], v1: client.CoreV1Api = None, max_in_flight: int = default_max_in_flight,
+                namespace: str = 'default') -> PodOperationResult:
+    """
+    Creates the pods concurrently, with at most `max_in_flight` requests at the same time.
+    :return: the names of the created pods and the errors of the failed ones
+    """
+    if v1 is None:
+        v1 = get_kube_client().core_v1
+
+    def create(pod: client.V1Pod):
+        logger.info(f"Create pod '{pod.metadata.name}'")
+        v1.create_namespaced_pod(namespace, pod, async_req=False)
+
+    result = PodOperationResult()
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        futures = {pod.metadata.name: executor.submit(create, pod) for pod in pods}
+        for name, future in futures.items():
+            try:
+                future.result()
+                result.succeeded.append(name)
+            except Exception as e:
+                logger.error(f'Failed to create pod {name}: {e}')
+                result.failed[name] = e
+    return result
+
+
+@timed()
 def spawn_pods(image: str, name: str, node: str, labels: Dict[str, str], n: int,
-               pod_factory: Callable[[str, str, Dict], client.V1Container], env_vars: Dict[str,str]= None) -> List[str]:
+               pod_factory: Callable[[str, str, Dict], client.V1Container], env_vars: Dict[str,str]= None,
+               max_in_flight: int = default_max_in_flight) -> List[str]:
     """
     Function spawns n pods on the given node. The pod factory creates the containers to allow
     different kinds of containers.
+    The pods are created concurrently. If any creation fails, the created pods are removed again and a
+    `PodSpawnError` that contains the partial result is raised.
     :param image: the container imag
     :param name: the pod name prefix
     :param node: the node
@@ -104,12 +302,11 @@ def spawn_pods(image: str, name: str, node: str, labels: Dict[str, str], n: int,
     :param n: the number of pods to spawn on the given node
     :param pod_factory: factory function to create V1Containers
     :param env_vars: a dict containing env variables that will be available in each Pod
+    :param max_in_flight: max. number of concurrent create requests
     :return: a list containing the names of pods created
     """
-    # Configs can be set in Configuration class directly or using helper utility
-    config.load_kube_config()
     resource_requests = {}
-    v1 = client.CoreV1Api()
+    v1 = get_kube_client().core_v1
     pods = []
     for idx in range(n):
         selector = {'kubernetes.io/hostname': node}
@@ -141,51 +338,133 @@ def spawn_pods(image: str, name: str, node: str, labels: Dict[str, str], n: int,
                 ]
             ),
         )
-        logger.info(f"Create pod '{pod_name}'")
-        v1.create_namespaced_pod('default', pod, async_req=False)
-        pods.append(pod_name)
-    return pods
+        pods.append(pod)
 
+    result = create_pods(pods, v1, max_in_flight)
+    if not result.ok:
+        remove_pods(result.succeeded)
+        raise PodSpawnError(result)
+    return result.succeeded
 
-def remove_pods(names: List[str]):
-    config.load_kube_config()
-    v1 = client.CoreV1Api()
-    for name in names:
+
+@timed()
+def remove_pods(names: List[str], max_in_flight: int = default_max_in_flight) -> PodOperationResult:
+    """
+    Deletes the pods concurrently. Pods that do not exist anymore count as removed.
+    :return: the names of the removed pods and the errors of the failed ones
+    """
+    v1 = get_kube_client().core_v1
+
+    def delete(name: str):
         try:
             v1.delete_namespaced_pod(name, 'default', async_req=False)
-        except kubernetes.client.exceptions.ApiException:
+        except kubernetes.client.exceptions.ApiException as e:
+            if e.status != 404:
+                raise
             logger.debug(f'Pod {name} was not available to teardown anymore')
 
+    result = PodOperationResult()
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        futures = {name: executor.submit(delete, name) for name in names}
+        for name, future in futures.items():
+            try:
+                future.result()
+                result.succeeded.append(name)
+            except Exception as e:
+                logger.error(f'Failed to remove pod {name}: {e}')
+                result.failed[name] = e
+    return result
+
+
+@timed()
+def remove_pods_by_label(label_selector: str, wait: bool = True, timeout: float = default_pod_timeout,
+                         v1: client.CoreV1Api = None, namespace: str = 'default') -> PodOperationResult:
+    """
+    Deletes all pods matching the selector with one `delete_collection` call and optionally waits (via watch) until
+    they are gone.
+    :param label_selector: selects the pods to remove, e.g., `f'{run_label}={run_id}'`
+    :param wait: wait until all pods are deleted
+    :param timeout: seconds to wait for the deletion
+    :return: the removed pods, pods that still exist after the timeout are reported as failed
+    """
+    if v1 is None:
+        v1 = get_kube_client().core_v1
+    pod_list = v1.list_namespaced_pod(namespace, label_selector=label_selector)
+    names = {pod.metadata.name for pod in pod_list.items}
+    result = PodOperationResult()
+    if len(names) == 0:
+        return result
+
+    logger.info(f'Remove {len(names)} pods with selector {label_selector}')
+    v1.delete_collection_namespaced_pod(namespace, label_selector=label_selector)
+    if not wait:
+        result.succeeded.extend(sorted(names))
+        return result
+
+    pending = set(names)
+    deadline = time.time() + timeout
+    resource_version = pod_list.metadata.resource_version
+    while len(pending) > 0 and time.time() < deadline:
+        w = get_kube_client().watch()
+        try:
+            for event in w.stream(v1.list_namespaced_pod, namespace, label_selector=label_selector,
+                                  resource_version=resource_version,
+                                  timeout_seconds=max(1, int(deadline - time.time()))):
+                if event['type'] == 'DELETED':
+                    pending.discard(event['object'].metadata.name)
+                if len(pending) == 0:
+                    break
+            resource_version = w.resource_version or resource_version
+        except ApiException as e:
+            if e.status != 410:
+                raise
+            # resource version is too old, check which pods still exist
+            pod_list = v1.list_namespaced_pod(namespace, label_selector=label_selector)
+            pending &= {pod.metadata.name for pod in pod_list.items}
+            resource_version = pod_list.metadata.resource_version
+        finally:
+            w.stop()
+
+    result.succeeded.extend(sorted(names - pending))
+    for name in sorted(pending):
+        result.failed[name] = TimeoutError(f'Pod {name} still exists after {timeout}s')
+    return result
+
 
 def fetch_pods(label: str, value: str):
-    config.load_kube_config()
-    v1 = client.CoreV1Api()
-    pods_list = v1.list_namespaced_pod('default')
-    pods = []
-    for pod in pods_list.items:
-        if pod.metadata.labels is None:
-            # labels object does not have to be set and can be None: ignore
-            continue
+    v1 = get_kube_client().core_v1
+    # labels are matched server-side
+    return v1.list_namespaced_pod('default', label_selector=f'{label}={value}').items
 
-        fn_value = pod.metadata.labels.get(label)
-        if fn_value == value:
-            pods.append(pod)
-    return pods
+
+def get_zone(pod) -> str:
+    """
+    Reads the zone of a pod from its zone label. Falls back to the name of load balancer pods that are not labelled,
+    i.e.: go-load-balancer-deployment-zone-b-xwg9c
+    """
+    labels = pod.metadata.labels or {}
+    zone = labels.get(zone_label)
+    if zone is None:
+        zone = f"zone-{pod.metadata.name.split('-')[5]}"
+    return zone
+
+
+def to_load_balancer_pod(pod) -> Pod:
+    labels = {
+        pod_type_label: api_gateway_type_label,
+        zone_label: get_zone(pod)
+    }
+    # pod id is not used
+    return Pod('', pod.status.pod_ip, labels, pod.metadata.name, pod.spec.node_name)
 
 
 def get_load_balancer_pods() -> Dict[str, Pod]:
-    pods = fetch_pods('type', 'api-gateway')
+    """
+    Lists the load balancer pods once, see `galileoexperiments.utils.topology` for a cached view.
+    :return: load balancer pods by zone
+    """
     lb = {}
-    for pod in pods:
-        # pod name, i.e.: go-load-balancer-deployment-zone-b-xwg9c
-        pod_name = pod.metadata.name
-        zone = f"zone-{pod_name.split('-')[5]}"
-        ip = pod.status.pod_ip
-        # not used
-        pod_id = ''
-        labels = {
-            'type': 'api-gateway',
-            zone_label: zone
-        }
-        lb[zone] = Pod(pod_id, ip, labels, pod_name)
+    for pod in fetch_pods(pod_type_label, api_gateway_type_label):
+        lb_pod = to_load_balancer_pod(pod)
+        lb[lb_pod.labels[zone_label]] = lb_pod
     return lb
@@ -0,0 +1,282 @@
+"""
+Live aggregation of request latencies while an experiment runs, without querying the traces afterwards.
+The `LatencyAggregator` subscribes to the traces galileo publishes via redis and keeps a `LatencySketch` per service,
+zone and client group, for the whole run and for rolling windows.
+"""
+import json
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Tuple, Optional, Deque
+
+import redis
+from galileodb.reporter.traces import RedisTraceReporter
+
+from galileoexperiments.utils.traces import parse_trace, decode
+
+logger = logging.getLogger(__name__)
+
+# relative error of the quantiles of a sketch
+default_relative_accuracy = 0.01
+
+# seconds covered by one bucket of the rolling windows
+default_resolution = 1
+
+# seconds of history kept for rolling windows
+default_retention = 300
+
+default_quantiles = [0.5, 0.9, 0.99]
+
+# service, zone and client group of a trace
+Key = Tuple[str, Optional[str], Optional[str]]
+
+
+class LatencySketch:
+    """
+    Histogram with logarithmically growing buckets: every value is counted in the bucket `ceil(log_gamma(value))`,
+    therefore quantiles have a relative error of at most `relative_accuracy`, regardless of the number of values.
+    Sketches with the same accuracy can be merged by adding their buckets.
+    """
+
+    def __init__(self, relative_accuracy: float = default_relative_accuracy):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets: Dict[int, int] = {}
+        # values <= 0, e.g., because of clock skew between client and worker
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value <= 0:
+            self.zeros += 1
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other: 'LatencySketch') -> 'LatencySketch':
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Only sketches with the same relative accuracy can be merged')
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0.0
+        seen = self.zeros
+        for index in sorted(self.buckets.keys()):
+            seen += self.buckets[index]
+            if seen > rank:
+                # the value in the middle of the bucket (in relative terms)
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.sum / self.count if self.count > 0 else None
+
+    def summary(self, quantiles: List[float] = None) -> Dict:
+        summary = {
+            'count': self.count,
+            'mean': self.mean,
+            'min': self.min if self.count > 0 else None,
+            'max': self.max if self.count > 0 else None,
+        }
+        for q in quantiles or default_quantiles:
+            summary[f'p{q * 100:g}'] = self.quantile(q)
+        return summary
+
+
+class Window:
+    """
+    Latencies and errors of `resolution` seconds starting at `start`.
+    """
+
+    def __init__(self, start: float, relative_accuracy: float):
+        self.start = start
+        self.sketch = LatencySketch(relative_accuracy)
+        self.errors = 0
+
+
+class _Series:
+
+    def __init__(self, relative_accuracy: float):
+        self.total = LatencySketch(relative_accuracy)
+        self.errors = 0
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        # oldest first
+        self.windows: Deque[Window] = deque()
+
+
+class LatencyAggregator:
+    """
+    Aggregates the latency (`done - sent`) of the traces of an experiment by service, zone and client group.
+    Zone and group of a trace are those of its client, see `label_clients`, and None for unknown clients.
+    Failed requests (status != 200) are counted as errors and not part of the latencies.
+
+    Start it with the experiment (`ExperimentRunConfiguration.latency_aggregator` does that), call `snapshot` at
+    any time, and `summary` for the whole run.
+    """
+
+    def __init__(self, rds: redis.Redis, relative_accuracy: float = default_relative_accuracy,
+                 resolution: float = default_resolution, retention: float = default_retention):
+        self.rds = rds
+        self.relative_accuracy = relative_accuracy
+        self.resolution = resolution
+        self.retention = retention
+        self._series: Dict[Key, _Series] = {}
+        self._labels: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        self._lock = threading.Lock()
+        self._pubsub = None
+        self._thread = None
+        self.started: Optional[float] = None
+        self.stopped: Optional[float] = None
+
+    def label_clients(self, client_ids: List[str], zone: str = None, group: str = None):
+        """
+        Sets zone and group of the traces of the given clients.
+        """
+        with self._lock:
+            for client_id in client_ids:
+                self._labels[client_id] = (zone, group)
+
+    def add(self, service: str, client_id: str, latency: Optional[float], now: float = None):
+        """
+        Adds the latency of a request, None counts as error.
+        """
+        now = now if now is not None else time.time()
+        with self._lock:
+            zone, group = self._labels.get(client_id, (None, None))
+            series = self._series.get((service, zone, group))
+            if series is None:
+                series = _Series(self.relative_accuracy)
+                self._series[(service, zone, group)] = series
+            if series.first is None:
+                series.first = now
+            series.last = now
+            start = now - now % self.resolution
+            if len(series.windows) == 0 or series.windows[-1].start != start:
+                series.windows.append(Window(start, self.relative_accuracy))
+                while series.windows[0].start < now - self.retention:
+                    series.windows.popleft()
+            window = series.windows[-1]
+            if latency is None:
+                series.errors += 1
+                window.errors += 1
+                return
+            series.total.add(latency)
+            window.sketch.add(latency)
+
+    def _on_trace(self, message):
+        trace = parse_trace(decode(message['data']))
+        if trace is None:
+            return
+        latency = trace.done - trace.sent if trace.status == 200 and trace.sent > 0 else None
+        self.add(trace.service, trace.client, latency)
+
+    def snapshot(self, window: float = None, quantiles: List[float] = None) -> Dict[Key, Dict]:
+        """
+        :param window: only the last this many seconds (at most `retention`), the whole run if None
+        :return: summary by service, zone and client group, incl. the throughput in requests per second
+        """
+        now = time.time()
+        snapshot = {}
+        with self._lock:
+            for key, series in self._series.items():
+                if window is None:
+                    sketch = series.total
+                    errors = series.errors
+                    elapsed = (self.stopped or now) - (self.started or series.first)
+                else:
+                    sketch = LatencySketch(self.relative_accuracy)
+                    errors = 0
+                    for w in series.windows:
+                        if w.start >= now - window:
+                            sketch.merge(w.sketch)
+                            errors += w.errors
+                    elapsed = window
+                summary = sketch.summary(quantiles)
+                summary['errors'] = errors
+                summary['throughput'] = sketch.count / elapsed if elapsed > 0 else None
+                snapshot[key] = summary
+        return snapshot
+
+    def windows(self, since: float = None, now: float = None, zone: str = None, group: str = None) -> List[Window]:
+        """
+        :param since: only windows that start at or after this timestamp, all retained ones if None
+        :param zone: only series of clients labeled with this zone, all zones if None
+        :param group: only series of clients labeled with this group, all groups if None
+        :return: the completed windows of the selected series merged, oldest first, windows without requests included
+        """
+        now = now if now is not None else time.time()
+        current = now - now % self.resolution
+        # by index of the window, i.e., start / resolution
+        merged: Dict[int, Window] = {}
+        with self._lock:
+            for (_, series_zone, series_group), series in self._series.items():
+                if (zone is not None and series_zone != zone) or (group is not None and series_group != group):
+                    continue
+                for w in series.windows:
+                    if w.start >= current or (since is not None and w.start < since):
+                        continue
+                    index = round(w.start / self.resolution)
+                    window = merged.get(index)
+                    if window is None:
+                        window = Window(w.start, self.relative_accuracy)
+                        merged[index] = window
+                    window.sketch.merge(w.sketch)
+                    window.errors += w.errors
+        if len(merged) == 0:
+            return []
+        indices = range(min(merged.keys()), round(current / self.resolution))
+        return [merged.get(i) or Window(i * self.resolution, self.relative_accuracy) for i in indices]
+
+    def summary(self, quantiles: List[float] = None) -> Dict[str, Dict]:
+        """
+        :return: the summary of the whole run, keyed by `service/zone/group`
+        """
+        return {'/'.join(str(k) for k in key): value for key, value in self.snapshot(None, quantiles).items()}
+
+    def start(self):
+        """
+        Starts the aggregation of a new experiment, latencies of a previous one are dropped, labels are kept.
+        """
+        with self._lock:
+            self._series = {}
+        self.started = time.time()
+        self.stopped = None
+        self._pubsub = self.rds.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{RedisTraceReporter.channel: self._on_trace})
+        self._thread = self._pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._thread.stop()
+        self._pubsub.close()
+        self._thread = None
+        self.stopped = time.time()
+        logger.info(f'Aggregated latencies of {len(self._series)} series')
+
+    def to_event(self) -> str:
+        return json.dumps(self.summary())
@@ -0,0 +1,68 @@
+"""
+The recorder of galileo stores the metadata of an experiment when it starts. Values that are only known afterwards
+(e.g., the latency summary) are added to the stored metadata with `store_metadata`.
+"""
+import json
+import logging
+from typing import Dict, Optional
+
+from galileodb.db import ExperimentDatabase
+from galileodb.factory import create_experiment_database_from_env
+from galileodb.mixed.db import MixedExperimentDatabase
+from galileodb.model import Experiment
+from galileodb.sql.adapter import ExperimentSQLDatabase
+
+logger = logging.getLogger(__name__)
+
+
+def find_experiment(db: ExperimentDatabase, name: str = None, creator: str = None,
+                    since: float = 0) -> Optional[Experiment]:
+    """
+    :param since: the timestamp right before the experiment was started
+    :return: the first experiment created at or after `since` with the given name and creator (None matches any), None
+             if there is none
+    """
+    experiments = [e for e in db.find_all() if (e.created or 0) >= since and
+                   (name is None or e.name == name) and (creator is None or e.creator == creator)]
+    return min(experiments, key=lambda e: e.created, default=None)
+
+
+def update_metadata(db: ExperimentDatabase, exp_id: str, values: Dict) -> Dict:
+    """
+    Adds the values to the stored metadata of the experiment, existing keys are overwritten.
+    :return: the updated metadata
+    :raises ValueError: if the database does not keep the metadata in SQL (e.g., InfluxDB)
+    """
+    sqldb = db.sqldb if isinstance(db, MixedExperimentDatabase) else db
+    if not isinstance(sqldb, ExperimentSQLDatabase):
+        raise ValueError(f'Cannot update metadata in {type(db).__name__}')
+    metadata = sqldb.get_metadata(exp_id)
+    if metadata is None:
+        # saving sets the exp_id
+        sqldb.save_metadata(exp_id, dict(values))
+        return sqldb.get_metadata(exp_id)
+    metadata.update(values)
+    sqldb.db.update_by_id('metadata', ('EXP_ID', exp_id), {'data': json.dumps(metadata)})
+    return metadata
+
+
+def store_metadata(context: Dict, name: str, creator: str, started: float, values: Dict):
+    """
+    Adds the values to the stored metadata of an experiment, see `find_experiment`. Experiments must be started one
+    after another, so that the first one created after `started` is the right one (`run_experiment` does that).
+    The database is taken from the galileo context (key `db`), or created from the environment like the recorder does.
+    """
+    db = context.get('db')
+    owned = db is None
+    if owned:
+        db = create_experiment_database_from_env()
+        db.open()
+    try:
+        experiment = find_experiment(db, name, creator, started)
+        if experiment is None:
+            raise ValueError(f'No experiment {name} of {creator} recorded')
+        update_metadata(db, experiment.id, values)
+        logger.info(f'Stored {", ".join(sorted(values.keys()))} in metadata of experiment {experiment.id}')
+    finally:
+        if owned:
+            db.close()
@@ -0,0 +1,160 @@
+"""
+A pool of warm application pods that are handed out to consecutive experiment runs instead of spawning and removing
+the pods of every run. Pods are pooled by image, node, labels and environment, i.e., a run only gets pods that are
+identical to the ones it would have spawned itself. Runs that want cold starts simply do not use a pool.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Tuple, Callable, FrozenSet
+
+from kubernetes import client
+
+from galileoexperiments.api.model import Pod
+from galileoexperiments.utils.constants import run_label, pool_label
+from galileoexperiments.utils.k8s import spawn_pods, get_pods, new_run_id, remove_pods, remove_pods_by_label
+
+logger = logging.getLogger(__name__)
+
+# seconds a pod stays idle in the pool before it is removed
+default_pod_ttl = 10 * 60
+
+PoolKey = Tuple[str, str, str, FrozenSet[Tuple[str, str]], FrozenSet[Tuple[str, str]]]
+
+
+@dataclass
+class _IdlePod:
+    pod: Pod
+    # time the pod was returned to the pool
+    since: float
+
+
+class PodPool:
+    """
+    Hands out running pods and takes them back after a run. Idle pods are removed once they were not used for `ttl`
+    seconds (checked whenever pods are acquired or released, or explicitly with `evict_idle`).
+    All pods of a pool carry the `pool_label`, `close` removes the ones that are left.
+    """
+
+    def __init__(self, ttl: float = default_pod_ttl, reset: Callable[[List[Pod]], None] = None):
+        """
+        :param ttl: seconds after which idle pods are removed
+        :param reset: optional function that resets the state of pods before they are used again, pods for which it
+                      fails are removed
+        """
+        self.id = new_run_id()
+        self.ttl = ttl
+        self.reset = reset
+        self._idle: Dict[PoolKey, List[_IdlePod]] = {}
+        self._leased: Dict[str, PoolKey] = {}
+        self._lock = threading.Lock()
+        # number of pods handed out warm and spawned cold
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(image: str, name: str, node: str, labels: Dict[str, str], env_vars: Dict[str, str] = None) -> PoolKey:
+        # the run label differs for every run and does not change the pod
+        labels = {k: v for k, v in labels.items() if k != run_label}
+        return image, name, node, frozenset(labels.items()), frozenset((env_vars or {}).items())
+
+    def acquire(self, image: str, name: str, node: str, labels: Dict[str, str], n: int,
+                pod_factory: Callable[[str, str, Dict], client.V1Container],
+                env_vars: Dict[str, str] = None) -> List[Pod]:
+        """
+        Returns `n` running pods, idle ones from the pool first, the rest is spawned (see `spawn_pods`).
+        The pods belong to the caller until they are released.
+        """
+        key = self.key(image, name, node, labels, env_vars)
+        self.evict_idle()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            pods = [p.pod for p in idle[:n]]
+            self._idle[key] = idle[n:]
+            for pod in pods:
+                self._leased[pod.name] = key
+            self.hits += len(pods)
+
+        missing = n - len(pods)
+        if missing > 0:
+            try:
+                pods.extend(self._spawn(key, image, name, node, labels, missing, pod_factory, env_vars))
+            except Exception:
+                self.release(pods)
+                raise
+        logger.info(f'Acquired {n} pod(s) of {image} on {node}, {n - missing} warm')
+        return pods
+
+    def _spawn(self, key: PoolKey, image: str, name: str, node: str, labels: Dict[str, str], n: int,
+               pod_factory: Callable[[str, str, Dict], client.V1Container], env_vars: Dict[str, str]) -> List[Pod]:
+        # pods of the same key can be alive at the same time, therefore every spawn gets its own name prefix
+        set_id = new_run_id()
+        labels = {**labels, run_label: set_id, pool_label: self.id}
+        pod_names = spawn_pods(image, f'{name}-{set_id[:6]}', node, labels, n, pod_factory, env_vars)
+        pods = get_pods(pod_names, label_selector=f'{run_label}={set_id}')
+        with self._lock:
+            for pod in pods:
+                self._leased[pod.name] = key
+            self.misses += len(pods)
+        return pods
+
+    def release(self, pods: List[Pod], reset: bool = True):
+        """
+        Returns the pods to the pool.
+        :param reset: if True and the pool has a reset function, the pods are reset before they become idle
+        """
+        if reset and self.reset is not None and len(pods) > 0:
+            try:
+                self.reset(pods)
+            except Exception as e:
+                logger.error(f'Resetting {len(pods)} pod(s) failed, remove them: {e}')
+                self.discard(pods)
+                return
+        now = time.time()
+        with self._lock:
+            for pod in pods:
+                key = self._leased.pop(pod.name, None)
+                if key is not None:
+                    self._idle.setdefault(key, []).append(_IdlePod(pod, now))
+        self.evict_idle()
+
+    def discard(self, pods: List[Pod]):
+        """
+        Removes the pods instead of returning them, e.g., after a run failed and left them in an unknown state.
+        """
+        with self._lock:
+            for pod in pods:
+                self._leased.pop(pod.name, None)
+        if len(pods) > 0:
+            remove_pods([pod.name for pod in pods])
+
+    def evict_idle(self) -> int:
+        """
+        Removes pods that were idle for longer than the ttl.
+        :return: the number of removed pods
+        """
+        deadline = time.time() - self.ttl
+        expired = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                expired.extend(p.pod.name for p in idle if p.since < deadline)
+                self._idle[key] = [p for p in idle if p.since >= deadline]
+        if len(expired) > 0:
+            logger.info(f'Evict {len(expired)} idle pod(s)')
+            remove_pods(expired)
+        return len(expired)
+
+    def idle(self) -> int:
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+    def close(self, wait: bool = True):
+        """
+        Removes all pods of the pool, including leased ones.
+        """
+        with self._lock:
+            self._idle = {}
+            self._leased = {}
+        remove_pods_by_label(f'{pool_label}={self.id}', wait=wait)
+        logger.info(f'Closed pod pool after {self.hits} warm and {self.misses} cold pod(s)')
@@ -0,0 +1,112 @@
+import logging
+import threading
+import time
+from typing import List, Tuple, Iterator, Optional
+
+import numpy as np
+import redis
+from galileo.shell.shell import ClientGroup
+from galileo.worker.api import ClientDescription
+
+from galileoexperiments.utils.arrivalprofile import Profile, as_profile_source, upload_chunks, UploadStats
+
+logger = logging.getLogger(__name__)
+
+# number of inter-arrivals per window
+default_window = 100_000
+
+
+class _FeedState:
+
+    def __init__(self, client_group: ClientGroup, client: ClientDescription, windows: Iterator[np.ndarray]):
+        self.client_group = client_group
+        self.client = client
+        self.windows = windows
+        self.current: Optional[np.ndarray] = None
+        self.windows_sent = 0
+        self.entries_sent = 0
+        # the workload of the current window
+        self.future = None
+
+
+class ProfileFeeder:
+    """
+    Feeds profiles to galileo clients in windows of `window` inter-arrivals, instead of pushing the whole profile
+    before the experiment starts. Redis therefore holds at most one window per client, regardless of the length of
+    the profile.
+
+    Galileo clients read their whole list when a prerecorded workload starts and delete it afterwards. The feeder
+    therefore runs one prerecorded workload per window: the next window is pushed as soon as the client has consumed
+    the current one (i.e., the list length drops to 0) and is started once the current workload is done. Between two
+    windows a client pauses for the duration of one command round trip.
+    """
+
+    def __init__(self, rds: redis.Redis, window: int = default_window, poll_interval: float = 0.1):
+        self.rds = rds
+        self.window = window
+        self.poll_interval = poll_interval
+        self._feeds: List[_FeedState] = []
+        self._stopped = threading.Event()
+
+    def add(self, client_group: ClientGroup, uploads: List[Tuple[Profile, ClientDescription]]):
+        """
+        Registers the profiles of clients of the given group and pushes their first window.
+        """
+        for profile, client in uploads:
+            windows = as_profile_source(profile).chunks(self.window)
+            feed = _FeedState(client_group, client, windows)
+            feed.current = next(windows, None)
+            if feed.current is not None:
+                self._push(feed, feed.current)
+            self._feeds.append(feed)
+
+    def _push(self, feed: _FeedState, window: np.ndarray) -> UploadStats:
+        stats = upload_chunks(feed.client.client_id, iter([window]), self.rds)
+        feed.windows_sent += 1
+        feed.entries_sent += stats.entries
+        return stats
+
+    def _wait_consumed(self, list_key: str, future) -> bool:
+        while not self._stopped.is_set():
+            if self.rds.llen(list_key) == 0:
+                return True
+            if future.stopped():
+                # the workload ended without reading the list (e.g., it was aborted)
+                return False
+            time.sleep(self.poll_interval)
+        return False
+
+    def _feed(self, feed: _FeedState):
+        list_key = feed.client.client_id
+        group = ClientGroup(feed.client_group.ctrl, [feed.client], feed.client_group.cfg)
+        while feed.current is not None and not self._stopped.is_set():
+            future = group.request(ia=('prerecorded', 'ran'))
+            feed.future = future
+            upcoming = next(feed.windows, None)
+            if upcoming is not None:
+                if self._wait_consumed(list_key, future):
+                    self._push(feed, upcoming)
+                else:
+                    upcoming = None
+            future.wait()
+            feed.current = upcoming
+        logger.info(f'Fed {feed.entries_sent} entries in {feed.windows_sent} windows to {list_key}')
+
+    def run(self):
+        """
+        Starts the workloads of all registered clients and blocks until every profile has been consumed.
+        """
+        threads = [threading.Thread(target=self._feed, args=(feed,), daemon=True) for feed in self._feeds]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        """
+        Stops feeding, the workloads of the current windows are aborted (the clients themselves are not paused).
+        """
+        self._stopped.set()
+        for feed in self._feeds:
+            if feed.future is not None:
+                feed.future.abort()
@@ -0,0 +1,232 @@
+"""
+Composable transformations of arrival profiles.
+Transformations wrap a `Profile` (a path or a `ProfileSource`) and are themselves a `ProfileSource`, so they can be
+used anywhere a profile is expected (e.g., in `ScenarioWorkloadConfiguration.profiles`). Nothing is read or computed
+until the profile is uploaded, and all transformations work chunk-wise on NumPy arrays.
+
+Example, spreads an aggregate trace across 4 clients and replays it twice as fast::
+
+    profiles = split(scale_rate('data/profiles/trace.npy', 2), 4)
+"""
+import hashlib
+import json
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+from galileoexperiments.utils.arrivalprofile import ProfileSource, Profile, as_profile_source, default_chunk_size
+
+split_round_robin = 'round-robin'
+split_hash = 'hash'
+
+
+def _arrival_times(source: ProfileSource, chunk_size: int) -> Iterator[np.ndarray]:
+    elapsed = 0.0
+    for ias in source.chunks(chunk_size):
+        if len(ias) == 0:
+            continue
+        times = elapsed + np.cumsum(ias)
+        elapsed = times[-1]
+        yield times
+
+
+def _inter_arrivals(times: Iterator[np.ndarray]) -> Iterator[np.ndarray]:
+    last = 0.0
+    for chunk in times:
+        if len(chunk) == 0:
+            continue
+        yield np.diff(chunk, prepend=last)
+        last = chunk[-1]
+
+
+class TransformedProfile(ProfileSource):
+    """
+    Base class for transformations. The digest covers the parameters and the digests of the wrapped profiles, therefore
+    a changed profile file also changes the digest of the transformation.
+    """
+    kind: str = None
+
+    def __init__(self, *sources: Profile):
+        self.sources = [as_profile_source(source) for source in sources]
+
+    def _params(self) -> Dict:
+        return {}
+
+    def to_metadata(self) -> Dict:
+        return {
+            'type': self.kind,
+            **self._params(),
+            'sources': [source.to_metadata() for source in self.sources]
+        }
+
+    def digest(self) -> str:
+        value = json.dumps({'type': self.kind, **self._params()}, sort_keys=True)
+        value += ''.join(source.digest() for source in self.sources)
+        return hashlib.sha1(value.encode()).hexdigest()
+
+
+class ScaledProfile(TransformedProfile):
+    """
+    Multiplies every inter-arrival with `factor`.
+    """
+    kind = 'scale'
+
+    def __init__(self, source: Profile, factor: float):
+        super().__init__(source)
+        if factor <= 0:
+            raise ValueError(f'factor must be positive, got {factor}')
+        self.factor = factor
+
+    def chunks(self, chunk_size: int = default_chunk_size) -> Iterator[np.ndarray]:
+        for ias in self.sources[0].chunks(chunk_size):
+            yield np.asarray(ias) * self.factor
+
+    def _params(self) -> Dict:
+        return {'factor': self.factor}
+
+
+class TruncatedProfile(TransformedProfile):
+    """
+    Ends the profile after `n` inter-arrivals or as soon as the arrivals pass `duration` seconds.
+    """
+    kind = 'truncate'
+
+    def __init__(self, source: Profile, n: int = None, duration: float = None):
+        super().__init__(source)
+        if n is None and duration is None:
+            raise ValueError('Either n or duration has to be set')
+        self.n = n
+        self.duration = duration
+
+    def chunks(self, chunk_size: int = default_chunk_size) -> Iterator[np.ndarray]:
+        remaining = self.n
+        elapsed = 0.0
+        for ias in self.sources[0].chunks(chunk_size):
+            if remaining is not None:
+                ias = ias[:remaining]
+                remaining -= len(ias)
+            if self.duration is not None:
+                times = elapsed + np.cumsum(ias)
+                ias = ias[:np.searchsorted(times, self.duration, side='right')]
+            if len(ias) == 0:
+                return
+            elapsed += float(np.sum(ias))
+            yield ias
+            if remaining == 0:
+                return
+
+    def _params(self) -> Dict:
+        return {'n': self.n, 'duration': self.duration}
+
+
+def _mix(index: np.ndarray, seed: int) -> np.ndarray:
+    # splitmix64 finalizer, spreads consecutive indices uniformly
+    x = index.astype(np.uint64) + np.uint64(seed % (2 ** 64))
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class SplitProfile(TransformedProfile):
+    """
+    One of `parts` profiles that together contain all arrivals of the source.
+    The arrival times are kept, each part only receives a subset of them: either every `parts`-th arrival
+    (round-robin) or the arrivals whose seeded hash of the arrival index maps to the part (hash).
+    """
+    kind = 'split'
+
+    def __init__(self, source: Profile, part: int, parts: int, mode: str = split_round_robin, seed: int = 0):
+        super().__init__(source)
+        if mode not in (split_round_robin, split_hash):
+            raise ValueError(f'Unknown split mode {mode}')
+        if not 0 <= part < parts:
+            raise ValueError(f'part must be in [0, {parts}), got {part}')
+        self.part = part
+        self.parts = parts
+        self.mode = mode
+        self.seed = seed
+
+    def _selected(self, times: Iterator[np.ndarray]) -> Iterator[np.ndarray]:
+        offset = 0
+        for chunk in times:
+            index = np.arange(offset, offset + len(chunk))
+            offset += len(chunk)
+            if self.mode == split_round_robin:
+                selected = index % self.parts == self.part
+            else:
+                selected = _mix(index, self.seed) % np.uint64(self.parts) == np.uint64(self.part)
+            yield chunk[selected]
+
+    def chunks(self, chunk_size: int = default_chunk_size) -> Iterator[np.ndarray]:
+        # read `parts` times as much, so the parts yield chunks of roughly `chunk_size`
+        times = _arrival_times(self.sources[0], chunk_size * self.parts)
+        yield from _inter_arrivals(self._selected(times))
+
+    def _params(self) -> Dict:
+        return {'part': self.part, 'parts': self.parts, 'mode': self.mode, 'seed': self.seed}
+
+
+class MergedProfile(TransformedProfile):
+    """
+    Superposition of several profiles: contains the arrivals of all sources, ordered by time.
+    """
+    kind = 'merge'
+
+    def _merged_times(self, chunk_size: int) -> Iterator[np.ndarray]:
+        iterators = [_arrival_times(source, chunk_size) for source in self.sources]
+        buffers = [np.empty(0) for _ in iterators]
+        exhausted = [False] * len(iterators)
+        while True:
+            for i, it in enumerate(iterators):
+                while not exhausted[i] and len(buffers[i]) == 0:
+                    try:
+                        buffers[i] = next(it)
+                    except StopIteration:
+                        exhausted[i] = True
+            if all(len(buffer) == 0 for buffer in buffers):
+                return
+            # arrivals up to the smallest buffered time of sources that continue are final
+            horizons = [buffers[i][-1] for i in range(len(iterators)) if not exhausted[i]]
+            horizon = min(horizons) if len(horizons) > 0 else np.inf
+            ready = []
+            for i, buffer in enumerate(buffers):
+                split = np.searchsorted(buffer, horizon, side='right')
+                ready.append(buffer[:split])
+                buffers[i] = buffer[split:]
+            yield np.sort(np.concatenate(ready), kind='mergesort')
+
+    def chunks(self, chunk_size: int = default_chunk_size) -> Iterator[np.ndarray]:
+        yield from _inter_arrivals(self._merged_times(chunk_size))
+
+
+def scale_rate(profile: Profile, factor: float) -> ScaledProfile:
+    """
+    Multiplies the request rate by `factor`, e.g., 2 replays the profile twice as fast.
+    """
+    return ScaledProfile(profile, 1 / factor)
+
+
+def scale_time(profile: Profile, factor: float) -> ScaledProfile:
+    """
+    Stretches (factor > 1) or compresses (factor < 1) the time axis of the profile.
+    """
+    return ScaledProfile(profile, factor)
+
+
+def truncate(profile: Profile, n: int = None, duration: float = None) -> TruncatedProfile:
+    return TruncatedProfile(profile, n, duration)
+
+
+def split(profile: Profile, parts: int, mode: str = split_round_robin, seed: int = 0) -> List[SplitProfile]:
+    """
+    Splits one profile (e.g., an aggregated trace) into `parts` client profiles.
+    :param profile: the profile to split
+    :param parts: the number of profiles to create, i.e., the number of clients
+    :param mode: `split_round_robin` or `split_hash`
+    :param seed: seed of the hash, only used by `split_hash`
+    """
+    return [SplitProfile(profile, part, parts, mode, seed) for part in range(parts)]
+
+
+def merge(*profiles: Profile) -> MergedProfile:
+    return MergedProfile(*profiles)
@@ -1,8 +1,24 @@
+import time
+
 import redis
 
 
-def wait_for_galileo_events(rds: redis.Redis):
+def wait_for_galileo_events(rds: redis.Redis, timeout: float = None):
+    """
+    Blocks until the next event is published on `galileo/events`.
+    :param timeout: max. seconds to wait, waits forever if None
+    :raises TimeoutError: if no event was published in time
+    """
     p = rds.pubsub( ignore_subscribe_messages=True)
     p.subscribe('galileo/events')
-    for _ in p.listen():
-        return
+    if timeout is None:
+        for _ in p.listen():
+            return
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            if p.get_message(timeout=min(deadline - time.time(), 1)) is not None:
+                return
+        raise TimeoutError(f'No galileo event published within {timeout}s')
+    finally:
+        p.close()
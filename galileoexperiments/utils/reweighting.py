@@ -0,0 +1,254 @@
+"""
+Closed-loop adaptation of the load balancer weights while an experiment runs.
+The `ReweightingController` listens to the request traces and the telemetry that are published via redis, keeps online
+estimates of the latency of each pod and of the utilization of each node and periodically rewrites the weights of all
+functions and zones.
+"""
+import json
+import logging
+import statistics
+import threading
+from typing import Dict, List, Tuple, Callable, Optional
+
+import redis
+from galileo.shell.shell import Experiment
+from galileodb.model import RequestTrace
+from galileodb.reporter.traces import RedisTraceReporter
+
+from galileoexperiments.api.model import Pod
+from galileoexperiments.utils.helpers import WeightWriter
+from galileoexperiments.utils.traces import parse_trace, decode
+from galileoexperiments.utils.weights import WeightPolicy, RoundRobinPolicy, compute_weights
+
+logger = logging.getLogger(__name__)
+
+# seconds between two weight updates
+default_reweight_interval = 5
+
+# smoothing factor of the exponentially weighted moving averages
+default_alpha = 0.2
+
+# weights of a pod change at most by this factor relative to the weight the base policy assigns
+max_factor = 10
+
+# utilization above which a node is considered saturated
+max_utilization = 0.95
+
+weights_event = 'lb_weights'
+
+# response header in which the go-load-balancer reports the pod that served a request
+final_host_header = 'X-Final-Host'
+
+
+def trace_server(trace: RequestTrace) -> str:
+    return trace.server
+
+
+def header_target(header: str = final_host_header) -> Callable[[RequestTrace], Optional[str]]:
+    """
+    :param header: the response header that holds the address (`ip[:port]`) of the pod, case-insensitive
+    :return: a `target_of` for requests routed via load balancers, it reads the pod from the headers of the trace
+    """
+    name = header.lower()
+
+    def target_of(trace: RequestTrace) -> Optional[str]:
+        if not trace.headers:
+            return None
+        try:
+            headers = json.loads(trace.headers)
+        except ValueError:
+            return None
+        for key, value in headers.items():
+            if key.lower() == name:
+                # e.g., http://10.0.0.1:8080/
+                return value.split('//')[-1].split('/')[0]
+        return None
+
+    return target_of
+
+
+class LatencyAwarePolicy(WeightPolicy):
+    """
+    Scales the weights of a base policy by how fast a pod is compared to the median pod: the score of a pod is its
+    smoothed latency times the expected queue length on its node (utilization / (1 - utilization)).
+    Pods without observations keep the weight of the base policy.
+    """
+
+    def __init__(self, base: WeightPolicy, scores: Dict[str, float]):
+        """
+        :param base: the policy whose weights are scaled
+        :param scores: score by pod name, lower is better
+        """
+        self.base = base
+        self.scores = scores
+        self.reference = statistics.median(scores.values()) if len(scores) > 0 else None
+
+    def factor(self, pod: Pod) -> float:
+        score = self.scores.get(pod.name)
+        if score is None or self.reference is None or score <= 0:
+            return 1
+        return min(max_factor, max(1 / max_factor, self.reference / score))
+
+    def pod_weight(self, fn: str, pod: Pod) -> float:
+        return self.base.pod_weight(fn, pod) * self.factor(pod)
+
+    def zone_weight(self, fn: str, lb: Pod, pods: List[Pod]) -> float:
+        factor = sum(self.factor(pod) for pod in pods) / len(pods) if len(pods) > 0 else 1
+        return self.base.zone_weight(fn, lb, pods) * factor
+
+
+class ReweightingController:
+    """
+    Rewrites the load balancer weights every `interval` seconds, based on the traces and telemetry observed since the
+    controller was started. Only tables that changed are written, each change is logged as experiment event.
+
+    Traces are attributed to pods with `target_of`, which returns the address that served a request. By default this is
+    the `server` of the trace, i.e., the host the client sent the request to. If requests are routed via load balancers,
+    that is the address of the load balancer, so pass a function that reads the backend from the trace instead, e.g.,
+    `header_target()` for the response header the go-load-balancer sets. If traces arrive but none of them can be
+    attributed to a pod, the controller stops with an error, since it could never adapt the weights.
+    """
+
+    def __init__(self, rds: redis.Redis, pods_per_cluster: Dict[Tuple[str, str], List[Pod]], lbs: Dict[str, Pod],
+                 exp: Experiment = None, policy: WeightPolicy = None, interval: float = default_reweight_interval,
+                 alpha: float = default_alpha, writer: WeightWriter = None,
+                 target_of: Callable[[RequestTrace], str] = trace_server):
+        self.rds = rds
+        self.pods_per_cluster = pods_per_cluster
+        self.lbs = lbs
+        self.exp = exp
+        self.policy = policy if policy is not None else RoundRobinPolicy()
+        self.interval = interval
+        self.alpha = alpha
+        self.writer = writer
+        self.target_of = target_of
+
+        self._pods_by_target: Dict[str, Pod] = {}
+        for pods in pods_per_cluster.values():
+            for pod in pods:
+                self._pods_by_target[pod.ip] = pod
+                self._pods_by_target[f'{pod.ip}:8080'] = pod
+        self._latencies: Dict[str, float] = {}
+        self._utilization: Dict[str, float] = {}
+        self._tables: Dict[Tuple[str, str], Dict] = compute_weights(pods_per_cluster, lbs, self.policy)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._pubsub = None
+        self._pubsub_thread = None
+        self._thread = None
+        # number of weight updates written
+        self.updates = 0
+        # number of successful traces, and how many of them were attributed to a pod
+        self.traces = 0
+        self.attributed = 0
+        self._unknown_target: Optional[str] = None
+
+    def _ewma(self, values: Dict[str, float], key: str, value: float):
+        last = values.get(key)
+        values[key] = value if last is None else self.alpha * value + (1 - self.alpha) * last
+
+    def _on_trace(self, message):
+        trace = parse_trace(decode(message['data']))
+        if trace is None or trace.status != 200 or trace.sent <= 0:
+            return
+        target = self.target_of(trace)
+        pod = self._pods_by_target.get(target)
+        with self._lock:
+            self.traces += 1
+            if pod is None:
+                self._unknown_target = target
+                return
+            self.attributed += 1
+            self._ewma(self._latencies, pod.name, trace.done - trace.sent)
+
+    def check_attribution(self):
+        """
+        :raises ValueError: if traces arrived, but none of them could be attributed to a pod
+        """
+        with self._lock:
+            if self.traces > 0 and self.attributed == 0:
+                raise ValueError(f'None of {self.traces} trace(s) could be attributed to a pod (e.g., target '
+                                 f'{self._unknown_target!r}), pass a `target_of` that returns the address of the pod')
+
+    def _on_telemetry(self, message):
+        # channel: telem/<node>/<metric>[/<subsystem>], data: '<timestamp> <value>'
+        parts = decode(message['channel']).split('/', maxsplit=3)
+        if len(parts) != 3 or parts[2] != 'cpu':
+            return
+        try:
+            utilization = float(decode(message['data']).split(' ')[1]) / 100
+        except (IndexError, ValueError):
+            return
+        with self._lock:
+            self._ewma(self._utilization, parts[1], utilization)
+
+    def scores(self) -> Dict[str, float]:
+        """
+        :return: the current score of every pod with observed latency, see `LatencyAwarePolicy`
+        """
+        scores = {}
+        with self._lock:
+            for pods in self.pods_per_cluster.values():
+                for pod in pods:
+                    latency = self._latencies.get(pod.name)
+                    if latency is None:
+                        continue
+                    utilization = min(max_utilization, self._utilization.get(pod.node, 0))
+                    scores[pod.name] = latency * (1 + utilization / (1 - utilization))
+        return scores
+
+    def update(self) -> List[str]:
+        """
+        Computes the weights from the current estimates and writes the tables that changed.
+        :return: the keys that were written
+        :raises ValueError: see `check_attribution`
+        """
+        self.check_attribution()
+        policy = LatencyAwarePolicy(self.policy, self.scores())
+        tables = compute_weights(self.pods_per_cluster, self.lbs, policy)
+        changed = {key: table for key, table in tables.items() if self._tables.get(key) != table}
+        if len(changed) == 0:
+            return []
+
+        writer = self.writer if self.writer is not None else WeightWriter()
+        for (zone, fn), table in changed.items():
+            writer.set(zone, fn, table)
+        keys = writer.commit()
+        self._tables.update(changed)
+        self.updates += 1
+        if self.exp is not None:
+            for (zone, fn), table in changed.items():
+                self.exp.event(weights_event, json.dumps({'zone': zone, 'fn': fn, **table}))
+        logger.info(f'Updated {len(keys)} weight table(s)')
+        return keys
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check_attribution()
+            except ValueError as e:
+                logger.error(f'Stop reweighting: {e}')
+                return
+            try:
+                self.update()
+            except Exception as e:
+                logger.error(f'Updating weights failed: {e}')
+
+    def start(self):
+        self._pubsub = self.rds.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{RedisTraceReporter.channel: self._on_trace})
+        self._pubsub.psubscribe(**{'telem/*': self._on_telemetry})
+        self._pubsub_thread = self._pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+        self._thread = threading.Thread(target=self._run, name='reweighting', daemon=True)
+        self._thread.start()
+        logger.info(f'Started reweighting every {self.interval}s')
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._pubsub_thread is not None:
+            self._pubsub_thread.stop()
+            self._pubsub.close()
+        logger.info(f'Stopped reweighting after {self.updates} update(s), {self.attributed} of {self.traces} '
+                    f'trace(s) attributed to pods')
@@ -0,0 +1,302 @@
+"""
+Synthetic arrival profiles that are generated with NumPy while they are uploaded, chunk by chunk.
+All profiles are seeded: the seed is drawn once if none is given and is part of `to_metadata`, so every profile can be
+reproduced from the experiment metadata.
+"""
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+from galileoexperiments.utils.arrivalprofile import ProfileSource, default_chunk_size
+
+
+def _new_seed() -> int:
+    return int(np.random.SeedSequence().entropy % (2 ** 63))
+
+
+class SyntheticProfile(ProfileSource):
+    """
+    Base class for generated profiles. A profile ends after `n` inter-arrivals or as soon as the arrivals pass
+    `duration` seconds, whichever comes first.
+    """
+    kind: str = None
+
+    def __init__(self, n: int = None, duration: float = None, seed: int = None):
+        if n is None and duration is None:
+            raise ValueError('Either n or duration has to be set')
+        self.n = n
+        self.duration = duration
+        self.seed = seed if seed is not None else _new_seed()
+
+    def chunks(self, chunk_size: int = default_chunk_size) -> Iterator[np.ndarray]:
+        rng = np.random.default_rng(self.seed)
+        remaining = self.n
+        elapsed = 0.0
+        for ias in self._generate(rng, chunk_size):
+            if remaining is not None:
+                ias = ias[:remaining]
+                remaining -= len(ias)
+            if self.duration is not None:
+                times = elapsed + np.cumsum(ias)
+                ias = ias[:np.searchsorted(times, self.duration, side='right')]
+            if len(ias) == 0:
+                return
+            elapsed += float(np.sum(ias))
+            yield ias
+            if remaining == 0:
+                return
+
+    def _generate(self, rng: np.random.Generator, chunk_size: int) -> Iterator[np.ndarray]:
+        """
+        Yields chunks of inter-arrivals endlessly (or until the profile is exhausted).
+        """
+        raise NotImplementedError
+
+    def to_metadata(self) -> Dict:
+        return {
+            'type': self.kind,
+            'n': self.n,
+            'duration': self.duration,
+            'seed': self.seed,
+            **self._params()
+        }
+
+    def _params(self) -> Dict:
+        return {}
+
+
+class PoissonProfile(SyntheticProfile):
+    """
+    Homogeneous Poisson process, i.e., exponentially distributed inter-arrivals.
+    """
+    kind = 'poisson'
+
+    def __init__(self, rate: float, n: int = None, duration: float = None, seed: int = None):
+        super().__init__(n, duration, seed)
+        if rate <= 0:
+            raise ValueError(f'rate must be positive, got {rate}')
+        self.rate = rate
+
+    def _generate(self, rng: np.random.Generator, chunk_size: int) -> Iterator[np.ndarray]:
+        while True:
+            yield rng.exponential(1 / self.rate, chunk_size)
+
+    def _params(self) -> Dict:
+        return {'rate': self.rate}
+
+
+class MMPPProfile(SyntheticProfile):
+    """
+    Markov-modulated Poisson process to model bursty workloads.
+    The process stays in each state for an exponentially distributed time (with mean `mean_dwell[state]`) and emits
+    requests with `rates[state]`. The next state is drawn from `transitions[state]`, by default all states are visited
+    in a cycle.
+    """
+    kind = 'mmpp'
+
+    # number of state sojourns generated at once
+    sojourns_per_batch = 1024
+
+    def __init__(self, rates: Sequence[float], mean_dwell: Sequence[float],
+                 transitions: Sequence[Sequence[float]] = None, n: int = None, duration: float = None,
+                 seed: int = None):
+        super().__init__(n, duration, seed)
+        if len(rates) != len(mean_dwell):
+            raise ValueError('rates and mean_dwell need one entry per state')
+        if transitions is None:
+            states = len(rates)
+            transitions = [[1.0 if j == (i + 1) % states else 0.0 for j in range(states)] for i in range(states)]
+        self.rates = list(rates)
+        self.mean_dwell = list(mean_dwell)
+        self.transitions = [list(row) for row in transitions]
+
+    def _states(self, rng: np.random.Generator, state: int) -> Tuple[np.ndarray, int]:
+        cumulative = np.cumsum(self.transitions, axis=1)
+        draws = rng.random(self.sojourns_per_batch)
+        states = np.empty(self.sojourns_per_batch, dtype=int)
+        for i, draw in enumerate(draws):
+            states[i] = state
+            state = min(int(np.searchsorted(cumulative[state], draw, side='right')), len(self.rates) - 1)
+        return states, state
+
+    def _generate(self, rng: np.random.Generator, chunk_size: int) -> Iterator[np.ndarray]:
+        rates = np.asarray(self.rates, dtype=float)
+        mean_dwell = np.asarray(self.mean_dwell, dtype=float)
+        state = 0
+        start = 0.0
+        last = 0.0
+        pending = np.empty(0)
+        while True:
+            states, state = self._states(rng, state)
+            dwell = rng.exponential(mean_dwell[states])
+            starts = start + np.concatenate(([0.0], np.cumsum(dwell)[:-1]))
+            start = starts[-1] + dwell[-1]
+            # within a sojourn the arrivals of a Poisson process are uniformly distributed
+            counts = rng.poisson(rates[states] * dwell)
+            times = np.repeat(starts, counts) + rng.random(counts.sum()) * np.repeat(dwell, counts)
+            times.sort()
+            ias = np.diff(times, prepend=last)
+            if len(times) > 0:
+                last = times[-1]
+            pending = np.concatenate((pending, ias))
+            while len(pending) >= chunk_size:
+                yield pending[:chunk_size]
+                pending = pending[chunk_size:]
+
+    def _params(self) -> Dict:
+        return {'rates': self.rates, 'mean_dwell': self.mean_dwell, 'transitions': self.transitions}
+
+
+class RateCurveProfile(SyntheticProfile):
+    """
+    Non-homogeneous Poisson process that replays a rate curve.
+    The rate (requests per second) is interpolated linearly between the given points in time and kept constant after
+    the last point. Arrivals are generated by inverting the cumulative rate (time-rescaling theorem).
+    """
+    kind = 'rate_curve'
+
+    def __init__(self, times: Sequence[float], rates: Sequence[float], n: int = None, duration: float = None,
+                 seed: int = None):
+        if n is None and duration is None:
+            # by default the curve is replayed once
+            duration = times[-1]
+        super().__init__(n, duration, seed)
+        if len(times) != len(rates) or len(times) == 0:
+            raise ValueError('times and rates need the same, non-zero length')
+        if np.any(np.diff(times) < 0):
+            raise ValueError('times must be sorted')
+        if np.any(np.asarray(rates) < 0):
+            raise ValueError('rates must not be negative')
+        self.times = [float(t) for t in times]
+        self.rates = [float(r) for r in rates]
+
+    def _generate(self, rng: np.random.Generator, chunk_size: int) -> Iterator[np.ndarray]:
+        times = np.asarray(self.times)
+        rates = np.asarray(self.rates)
+        # cumulative rate at each point of the curve (trapezoidal integral of the piecewise linear rate)
+        cumulative = np.concatenate(([0.0], np.cumsum(np.diff(times) * (rates[1:] + rates[:-1]) / 2)))
+        cumulative += times[0] * rates[0]
+        times = np.concatenate(([0.0], times))
+        cumulative = np.concatenate(([0.0], cumulative))
+        rates = np.concatenate(([rates[0]], rates))
+        tail_rate = rates[-1]
+
+        position = 0.0
+        last = 0.0
+        while True:
+            position = position + np.cumsum(rng.exponential(1.0, chunk_size))
+            arrivals = self._invert(position, times, cumulative, rates)
+            if tail_rate > 0:
+                after = position > cumulative[-1]
+                arrivals[after] = times[-1] + (position[after] - cumulative[-1]) / tail_rate
+            else:
+                arrivals = arrivals[position <= cumulative[-1]]
+            if len(arrivals) == 0:
+                return
+            yield np.diff(arrivals, prepend=last)
+            last = arrivals[-1]
+            position = position[-1]
+            if tail_rate <= 0 and position > cumulative[-1]:
+                return
+
+    @staticmethod
+    def _invert(position: np.ndarray, times: np.ndarray, cumulative: np.ndarray, rates: np.ndarray) -> np.ndarray:
+        # within a segment the rate is linear, therefore the cumulative rate is quadratic in time
+        idx = np.clip(np.searchsorted(cumulative, position, side='right') - 1, 0, len(times) - 2)
+        t0 = times[idx]
+        dt = times[idx + 1] - t0
+        r0 = rates[idx]
+        slope = np.divide(rates[idx + 1] - r0, dt, out=np.zeros_like(dt), where=dt > 0)
+        remainder = position - cumulative[idx]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            quadratic = (-r0 + np.sqrt(np.maximum(r0 ** 2 + 2 * slope * remainder, 0))) / slope
+            linear = remainder / r0
+        offset = np.where(slope != 0, quadratic, linear)
+        return t0 + np.clip(np.nan_to_num(offset, posinf=0.0), 0, dt)
+
+    def _params(self) -> Dict:
+        return {'times': self.times, 'rates': self.rates}
+
+
+class SinusoidProfile(RateCurveProfile):
+    """
+    Diurnal pattern: the rate follows `base_rate + amplitude * sin(2 * pi * t / period + phase)` (clipped at 0).
+    """
+    kind = 'sinusoid'
+
+    def __init__(self, base_rate: float, amplitude: float, period: float, duration: float, phase: float = 0,
+                 resolution: float = None, n: int = None, seed: int = None):
+        self.base_rate = base_rate
+        self.amplitude = amplitude
+        self.period = period
+        self.phase = phase
+        self.resolution = resolution if resolution is not None else period / 1000
+        times = np.arange(0, duration + self.resolution, self.resolution)
+        rates = np.maximum(base_rate + amplitude * np.sin(2 * np.pi * times / period + phase), 0)
+        super().__init__(times, rates, n, duration, seed)
+
+    def _params(self) -> Dict:
+        return {'base_rate': self.base_rate, 'amplitude': self.amplitude, 'period': self.period, 'phase': self.phase,
+                'resolution': self.resolution}
+
+
+class StepProfile(RateCurveProfile):
+    """
+    Keeps `rates[i]` constant for `step_durations[i]` seconds.
+    """
+    kind = 'step'
+
+    def __init__(self, rates: Sequence[float], step_durations: Sequence[float], n: int = None, seed: int = None):
+        if len(rates) != len(step_durations):
+            raise ValueError('rates and step_durations need the same length')
+        self.step_rates = list(rates)
+        self.step_durations = list(step_durations)
+        ends = np.cumsum(step_durations)
+        starts = ends - np.asarray(step_durations)
+        # two points per step, so the linear interpolation between steps becomes a jump
+        times = np.column_stack((starts, ends)).ravel()
+        curve = np.repeat(rates, 2)
+        super().__init__(times, curve, n, float(ends[-1]), seed)
+
+    def _params(self) -> Dict:
+        return {'rates': self.step_rates, 'step_durations': self.step_durations}
+
+
+class RampProfile(RateCurveProfile):
+    """
+    Linearly increases (or decreases) the rate from `start_rate` to `end_rate` over `duration` seconds.
+    """
+    kind = 'ramp'
+
+    def __init__(self, start_rate: float, end_rate: float, duration: float, n: int = None, seed: int = None):
+        self.start_rate = start_rate
+        self.end_rate = end_rate
+        super().__init__([0, duration], [start_rate, end_rate], n, duration, seed)
+
+    def _params(self) -> Dict:
+        return {'start_rate': self.start_rate, 'end_rate': self.end_rate}
+
+
+def replay(rates: Sequence[float], interval: float, n: int = None, seed: int = None) -> StepProfile:
+    """
+    Replays a rate curve sampled every `interval` seconds, e.g., the requests per second of a recorded trace.
+    :param rates: requests per second for each interval
+    :param interval: length of one interval in seconds
+    """
+    if len(rates) == 0:
+        raise ValueError('rates must not be empty')
+    return StepProfile(list(rates), [interval] * len(rates), n, seed)
+
+
+def profiles_for_clients(profile_type, n_clients: int, seed: int = None, **params) -> List[SyntheticProfile]:
+    """
+    Creates one profile per client, each with its own seed derived from `seed`.
+    :param profile_type: a subclass of `SyntheticProfile`, e.g., `PoissonProfile`
+    :param n_clients: the number of clients
+    :param seed: the seed from which the client seeds are derived, drawn if None
+    :param params: arguments passed to the profile
+    """
+    if seed is None:
+        seed = _new_seed()
+    seeds = np.random.SeedSequence(seed).generate_state(n_clients, dtype=np.uint64)
+    return [profile_type(seed=int(s) % (2 ** 63), **params) for s in seeds]
@@ -0,0 +1,81 @@
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple
+
+from galileoexperiments.utils.timing import span
+
+logger = logging.getLogger(__name__)
+
+# max. number of cleanups that run at the same time
+default_teardown_concurrency = 8
+
+
+@dataclass
+class TeardownResult:
+    # names of the cleanups that succeeded
+    succeeded: List[str] = field(default_factory=list)
+    # exception by name of the cleanups that failed
+    failed: Dict[str, Exception] = field(default_factory=dict)
+    elapsed: float = 0
+
+    @property
+    def ok(self) -> bool:
+        return len(self.failed) == 0
+
+
+class TeardownError(Exception):
+
+    def __init__(self, result: TeardownResult):
+        self.result = result
+        errors = ', '.join(f'{name}: {e}' for name, e in result.failed.items())
+        super().__init__(f'{len(result.failed)} cleanup(s) failed: {errors}')
+
+
+class Teardown:
+    """
+    Collects cleanups and runs them in stages: the cleanups of a stage run concurrently, stages run in ascending order.
+    A failing cleanup does not stop the others, all errors are collected in the `TeardownResult`.
+    """
+
+    def __init__(self, concurrency: int = default_teardown_concurrency):
+        self.concurrency = concurrency
+        self._stages: Dict[int, List[Tuple[str, Callable, tuple, dict]]] = {}
+
+    def add(self, name: str, fn: Callable, *args, stage: int = 0, **kwargs) -> 'Teardown':
+        self._stages.setdefault(stage, []).append((name, fn, args, kwargs))
+        return self
+
+    def _call(self, name: str, fn: Callable, args: tuple, kwargs: dict):
+        with span(name):
+            fn(*args, **kwargs)
+
+    def run(self, raise_errors: bool = False) -> TeardownResult:
+        """
+        Runs all cleanups.
+        :param raise_errors: if True, raises a `TeardownError` after all cleanups ran and at least one of them failed
+        :return: the names of the succeeded and failed cleanups
+        """
+        start = time.time()
+        result = TeardownResult()
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            for stage in sorted(self._stages.keys()):
+                # every cleanup runs in a copy of the current context, so its spans are part of the current timer
+                futures = [(name, executor.submit(contextvars.copy_context().run, self._call, name, fn, args, kwargs))
+                           for name, fn, args, kwargs in self._stages[stage]]
+                for name, future in futures:
+                    try:
+                        future.result()
+                        result.succeeded.append(name)
+                    except Exception as e:
+                        logger.error(f'Cleanup {name} failed: {e}')
+                        result.failed[name] = e
+        self._stages = {}
+        result.elapsed = time.time() - start
+        logger.info(f'Teardown of {len(result.succeeded) + len(result.failed)} resource(s) took {result.elapsed:.3f}s, '
+                    f'{len(result.failed)} failed')
+        if raise_errors and not result.ok:
+            raise TeardownError(result)
+        return result
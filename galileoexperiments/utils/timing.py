@@ -0,0 +1,164 @@
+"""
+Lightweight timing of the phases of an experiment run (e.g., spawning pods, uploading profiles, the requests).
+A `Timer` is started per run, code then marks phases with `span`, which nest::
+
+    timer = Timer().start()
+    try:
+        with span('setup'):
+            with span('spawn_pods'):
+                ...
+    finally:
+        timer.finish()
+
+Spans are recorded by the timer that is active in the current context (threads do not inherit it), without an active
+timer `span` does nothing. Hooks registered with `add_hook` are called with every finished timer.
+"""
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, asdict
+from typing import List, Dict, Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+prometheus_metric = 'galileo_experiments_phase_duration_seconds'
+
+
+@dataclass
+class Span:
+    name: str
+    # names of all enclosing spans and this one, separated by '/'
+    path: str
+    start: float
+    duration: float
+
+
+class Timer:
+
+    def __init__(self):
+        self.spans: List[Span] = []
+        self.created = time.time()
+        self._lock = threading.Lock()
+        self._token = None
+
+    def start(self) -> 'Timer':
+        """
+        Makes this timer the one that records spans in the current context.
+        """
+        self._token = _timer.set(self)
+        return self
+
+    def finish(self):
+        """
+        Deactivates the timer and passes it to all hooks.
+        """
+        if self._token is not None:
+            _timer.reset(self._token)
+            self._token = None
+        for hook in list(_hooks):
+            try:
+                hook(self)
+            except Exception as e:
+                logger.error(f'Timing hook {hook} failed: {e}')
+
+    def record(self, s: Span):
+        with self._lock:
+            self.spans.append(s)
+
+    def totals(self) -> Dict[str, float]:
+        """
+        :return: the summed duration of all spans by path
+        """
+        totals = {}
+        with self._lock:
+            for s in self.spans:
+                totals[s.path] = totals.get(s.path, 0) + s.duration
+        return totals
+
+    def to_metadata(self) -> Dict:
+        with self._lock:
+            spans = [asdict(s) for s in self.spans]
+        return {'spans': spans, 'totals': self.totals()}
+
+    def to_prometheus(self, metric: str = prometheus_metric, labels: Dict[str, str] = None) -> str:
+        """
+        :return: the totals in the Prometheus text exposition format, one sample per phase
+        """
+        labels = labels or {}
+        lines = [f'# TYPE {metric} gauge']
+        for path, duration in sorted(self.totals().items()):
+            sample_labels = ','.join(f'{k}="{v}"' for k, v in {**labels, 'phase': path}.items())
+            lines.append(f'{metric}{{{sample_labels}}} {duration:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+_timer: ContextVar[Optional[Timer]] = ContextVar('timer', default=None)
+_path: ContextVar[Tuple[str, ...]] = ContextVar('span_path', default=())
+_hooks: List[Callable[[Timer], None]] = []
+
+
+def current_timer() -> Optional[Timer]:
+    return _timer.get()
+
+
+@contextmanager
+def span(name: str):
+    """
+    Records the duration of the enclosed block as phase `name`, nested in the enclosing spans.
+    """
+    timer = _timer.get()
+    if timer is None:
+        yield
+        return
+    path = _path.get() + (name,)
+    token = _path.set(path)
+    start = time.time()
+    try:
+        yield
+    finally:
+        _path.reset(token)
+        timer.record(Span(name, '/'.join(path), start, time.time() - start))
+
+
+def timed(name: str = None):
+    """
+    Decorator that records every call of the function as span, named after the function by default.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name or fn.__name__):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add_hook(hook: Callable[[Timer], None]):
+    _hooks.append(hook)
+
+
+def remove_hook(hook: Callable[[Timer], None]):
+    _hooks.remove(hook)
+
+
+def log_hook(timer: Timer):
+    for path, duration in timer.totals().items():
+        logger.info(f'{path}: {duration:.3f}s')
+
+
+def prometheus_file_hook(path: str, labels: Dict[str, str] = None) -> Callable[[Timer], None]:
+    """
+    :return: a hook that writes the totals to the given file, e.g., for the textfile collector of the node exporter
+    """
+
+    def hook(timer: Timer):
+        with open(path, 'w') as fd:
+            fd.write(timer.to_prometheus(labels=labels))
+
+    return hook
@@ -0,0 +1,226 @@
+import logging
+import threading
+import time
+from typing import Dict, List, Tuple, Callable, Optional
+
+from kubernetes.client.exceptions import ApiException
+
+from galileoexperiments.api.model import Pod
+from galileoexperiments.utils.constants import zone_label, function_label, pod_type_label, api_gateway_type_label
+from galileoexperiments.utils.k8s import KubernetesClient, get_kube_client, to_pod, to_load_balancer_pod
+
+logger = logging.getLogger(__name__)
+
+# seconds after which a watch is re-established by the api server
+default_watch_timeout = 300
+
+
+class PodInformer:
+    """
+    Keeps a local copy of all pods that match the label selector, fed by a single list+watch stream that runs in a
+    background thread. Every change is passed to `on_event(event_type, pod)`, with `event_type` being 'ADDED',
+    'MODIFIED' or 'DELETED'.
+    """
+
+    def __init__(self, label_selector: str, on_event: Callable[[str, object], None], namespace: str = 'default',
+                 kube_client: KubernetesClient = None, watch_timeout: int = default_watch_timeout):
+        self.label_selector = label_selector
+        self.on_event = on_event
+        self.namespace = namespace
+        self.kube_client = kube_client
+        self.watch_timeout = watch_timeout
+        self._pods: Dict[str, object] = {}
+        self._resource_version: Optional[str] = None
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._watch = None
+
+    @property
+    def _client(self) -> KubernetesClient:
+        return self.kube_client if self.kube_client is not None else get_kube_client()
+
+    def start(self, timeout: float = 30):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=f'informer-{self.label_selector}', daemon=True)
+        self._thread.start()
+        if not self._synced.wait(timeout):
+            raise TimeoutError(f'Informer for {self.label_selector} did not sync within {timeout}s')
+
+    def stop(self):
+        self._stopped.set()
+        if self._watch is not None:
+            self._watch.stop()
+
+    def _list(self):
+        v1 = self._client.core_v1
+        pod_list = v1.list_namespaced_pod(self.namespace, label_selector=self.label_selector)
+        current = {pod.metadata.name: pod for pod in pod_list.items}
+        for name in set(self._pods.keys()) - set(current.keys()):
+            self.on_event('DELETED', self._pods.pop(name))
+        for name, pod in current.items():
+            self.on_event('MODIFIED' if name in self._pods else 'ADDED', pod)
+            self._pods[name] = pod
+        self._resource_version = pod_list.metadata.resource_version
+        self._synced.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if self._resource_version is None:
+                    self._list()
+                self._watch = self._client.watch()
+                for event in self._watch.stream(self._client.core_v1.list_namespaced_pod, self.namespace,
+                                                label_selector=self.label_selector,
+                                                resource_version=self._resource_version,
+                                                timeout_seconds=self.watch_timeout):
+                    event_type = event['type']
+                    if event_type not in ('ADDED', 'MODIFIED', 'DELETED'):
+                        continue
+                    pod = event['object']
+                    if event_type == 'DELETED':
+                        self._pods.pop(pod.metadata.name, None)
+                    else:
+                        self._pods[pod.metadata.name] = pod
+                    self.on_event(event_type, pod)
+                if self._watch.resource_version is not None:
+                    self._resource_version = self._watch.resource_version
+            except ApiException as e:
+                if e.status == 410:
+                    # resource version is too old, list again
+                    self._resource_version = None
+                else:
+                    logger.error(f'Watch for {self.label_selector} failed: {e}')
+                    self._stopped.wait(1)
+                    self._resource_version = None
+            except Exception as e:
+                logger.error(f'Watch for {self.label_selector} failed: {e}')
+                self._stopped.wait(1)
+                self._resource_version = None
+
+
+class TopologyIndex:
+    """
+    In-memory view of the load balancers and function pods, kept up to date by two informers (one selecting the load
+    balancers, one selecting pods with a function label). Lookups do not call the api server.
+    Only pods that have an IP and are not terminating are part of the index.
+    """
+
+    def __init__(self, namespace: str = 'default', kube_client: KubernetesClient = None):
+        self._lock = threading.RLock()
+        self._load_balancers: Dict[str, Pod] = {}
+        self._function_pods: Dict[str, Pod] = {}
+        self._by_fn_and_zone: Dict[Tuple[str, str], Dict[str, Pod]] = {}
+        self._by_node: Dict[str, Dict[str, Pod]] = {}
+        self._informers = [
+            PodInformer(f'{pod_type_label}={api_gateway_type_label}', self._on_load_balancer, namespace, kube_client),
+            PodInformer(function_label, self._on_function_pod, namespace, kube_client),
+        ]
+
+    def start(self, timeout: float = 30) -> 'TopologyIndex':
+        for informer in self._informers:
+            informer.start(timeout)
+        return self
+
+    def stop(self):
+        for informer in self._informers:
+            informer.stop()
+
+    @staticmethod
+    def _is_available(pod) -> bool:
+        return pod.metadata.deletion_timestamp is None and pod.status is not None and pod.status.pod_ip is not None
+
+    def _on_load_balancer(self, event_type: str, pod):
+        with self._lock:
+            for zone, lb in list(self._load_balancers.items()):
+                if lb.name == pod.metadata.name:
+                    del self._load_balancers[zone]
+            if event_type != 'DELETED' and self._is_available(pod):
+                try:
+                    lb = to_load_balancer_pod(pod)
+                except IndexError:
+                    logger.warning(f'Cannot determine zone of load balancer {pod.metadata.name}, add the zone label')
+                    return
+                self._load_balancers[lb.labels[zone_label]] = lb
+
+    def _on_function_pod(self, event_type: str, pod):
+        name = pod.metadata.name
+        with self._lock:
+            old = self._function_pods.pop(name, None)
+            if old is not None:
+                self._by_fn_and_zone.get(self._fn_and_zone(old), {}).pop(name, None)
+                self._by_node.get(old.node, {}).pop(name, None)
+            if event_type == 'DELETED' or not self._is_available(pod):
+                return
+            new = to_pod(pod)
+            self._function_pods[name] = new
+            self._by_fn_and_zone.setdefault(self._fn_and_zone(new), {})[name] = new
+            self._by_node.setdefault(new.node, {})[name] = new
+
+    @staticmethod
+    def _fn_and_zone(pod: Pod) -> Tuple[str, str]:
+        return pod.labels.get(function_label), pod.labels.get(zone_label)
+
+    def load_balancers(self) -> Dict[str, Pod]:
+        """
+        :return: load balancer pods by zone
+        """
+        with self._lock:
+            return dict(self._load_balancers)
+
+    def load_balancer(self, zone: str) -> Optional[Pod]:
+        with self._lock:
+            return self._load_balancers.get(zone)
+
+    def pods_of(self, fn: str, zone: str) -> List[Pod]:
+        with self._lock:
+            return list(self._by_fn_and_zone.get((fn, zone), {}).values())
+
+    def pods_on(self, node: str) -> List[Pod]:
+        with self._lock:
+            return list(self._by_node.get(node, {}).values())
+
+    def pods_per_fn_and_zone(self) -> Dict[Tuple[str, str], List[Pod]]:
+        with self._lock:
+            return {key: list(pods.values()) for key, pods in self._by_fn_and_zone.items() if len(pods) > 0}
+
+    def wait_for_load_balancers(self, zones: List[str], timeout: float = 30) -> Dict[str, Pod]:
+        """
+        Waits until the index contains a load balancer for each of the given zones.
+        """
+        deadline = time.time() + timeout
+        while True:
+            lbs = self.load_balancers()
+            missing = [zone for zone in zones if zone not in lbs]
+            if len(missing) == 0:
+                return lbs
+            if time.time() >= deadline:
+                raise TimeoutError(f'No load balancer found for zone(s): {missing}')
+            time.sleep(0.1)
+
+
+_topology: TopologyIndex = None
+_topology_lock = threading.Lock()
+
+
+def get_topology() -> TopologyIndex:
+    """
+    :return: the process-wide topology index, started on first use
+    """
+    global _topology
+    with _topology_lock:
+        if _topology is None:
+            _topology = TopologyIndex().start()
+        return _topology
+
+
+def set_topology(topology: Optional[TopologyIndex]):
+    """
+    Replaces (or with None, resets) the process-wide topology index.
+    """
+    global _topology
+    with _topology_lock:
+        if _topology is not None and _topology is not topology:
+            _topology.stop()
+        _topology = topology
@@ -0,0 +1,28 @@
+"""
+Parsing of the request traces galileo publishes on `RedisTraceReporter.channel`.
+"""
+from typing import Optional
+
+from galileodb.model import RequestTrace
+
+
+def decode(value) -> str:
+    """
+    :return: the value as string, regardless of whether the redis client decodes responses
+    """
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def parse_trace(line: str) -> Optional[RequestTrace]:
+    """
+    Parses a trace as published by galileo on `RedisTraceReporter.channel`.
+    :return: the trace, or None if the line is malformed
+    """
+    parts = line.split(',', maxsplit=10)
+    if len(parts) != 11:
+        return None
+    try:
+        return RequestTrace(parts[0], parts[1], parts[2], float(parts[3]), float(parts[4]), float(parts[5]),
+                            int(parts[6]), parts[7], parts[8], parts[9].replace('|', ','), parts[10])
+    except ValueError:
+        return None
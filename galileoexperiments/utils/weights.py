@@ -0,0 +1,185 @@
+"""
+Computation of load balancer weights.
+For every function and zone the load balancer of the zone gets a weight table that contains the local pods of the
+function and the load balancers of the other zones that host the function. How much each target receives is decided by
+a `WeightPolicy`.
+"""
+import abc
+import logging
+from collections import defaultdict
+from typing import Dict, List, Tuple, Iterable
+
+from galileodb.db import ExperimentDatabase
+
+from galileoexperiments.api.model import Pod
+
+logger = logging.getLogger(__name__)
+
+# weights are integers, fractional weights are scaled so that the largest weight of a table equals this value
+default_resolution = 100
+
+
+class WeightPolicy(abc.ABC):
+
+    @abc.abstractmethod
+    def pod_weight(self, fn: str, pod: Pod) -> float:
+        """
+        :return: the weight of a pod in the weight table of its own zone
+        """
+        ...
+
+    @abc.abstractmethod
+    def zone_weight(self, fn: str, lb: Pod, pods: List[Pod]) -> float:
+        """
+        :param lb: the load balancer of the remote zone
+        :param pods: the pods of the function in the remote zone
+        :return: the weight of a remote zone, i.e., its load balancer, in the weight table of another zone
+        """
+        ...
+
+
+class RoundRobinPolicy(WeightPolicy):
+    """
+    Every pod and every remote zone gets the same weight.
+    """
+
+    def pod_weight(self, fn: str, pod: Pod) -> float:
+        return 1
+
+    def zone_weight(self, fn: str, lb: Pod, pods: List[Pod]) -> float:
+        return 1
+
+
+class PodCountPolicy(RoundRobinPolicy):
+    """
+    Like round robin within a zone, but remote zones are weighted by the number of pods they host, so requests
+    forwarded across zones are spread evenly over all pods.
+    """
+
+    def zone_weight(self, fn: str, lb: Pod, pods: List[Pod]) -> float:
+        return len(pods)
+
+
+class CapacityPolicy(WeightPolicy):
+    """
+    Weights pods by the capacity (e.g., the max. throughput in requests per second) of a function on the node the pod
+    runs on, and remote zones by the summed capacity of their pods.
+    Capacities can be taken from profiling experiments with `capacities_from_experiments`.
+    """
+
+    def __init__(self, capacities: Dict[Tuple[str, str], float], default_capacity: float = None):
+        """
+        :param capacities: capacity by (function, node)
+        :param default_capacity: capacity of unknown nodes, defaults to the mean capacity of the function
+        """
+        self.capacities = capacities
+        self.default_capacity = default_capacity
+        self._mean_capacities = {}
+        per_fn = defaultdict(list)
+        for (fn, _), capacity in capacities.items():
+            per_fn[fn].append(capacity)
+        for fn, values in per_fn.items():
+            self._mean_capacities[fn] = sum(values) / len(values)
+
+    def capacity(self, fn: str, node: str) -> float:
+        capacity = self.capacities.get((fn, node))
+        if capacity is not None:
+            return capacity
+        if self.default_capacity is not None:
+            return self.default_capacity
+        return self._mean_capacities.get(fn, 1)
+
+    def pod_weight(self, fn: str, pod: Pod) -> float:
+        return self.capacity(fn, pod.node)
+
+    def zone_weight(self, fn: str, lb: Pod, pods: List[Pod]) -> float:
+        return sum(self.capacity(fn, pod.node) for pod in pods)
+
+
+def to_int_weights(weights: List[float], resolution: int = default_resolution) -> List[int]:
+    """
+    Keeps integer weights as they are, otherwise scales the weights so the largest equals `resolution`.
+    Positive weights are at least 1.
+    """
+    if all(float(w).is_integer() for w in weights):
+        return [int(w) for w in weights]
+    largest = max(weights)
+    return [max(1, round(w / largest * resolution)) if w > 0 else 0 for w in weights]
+
+
+def weight_table(targets: List[Tuple[Pod, float]], resolution: int = default_resolution) -> Dict:
+    return {
+        "ips": [f'{pod.ip}:8080' for pod, _ in targets],
+        "weights": to_int_weights([weight for _, weight in targets], resolution)
+    }
+
+
+def compute_weights(pods_per_cluster: Dict[Tuple[str, str], List[Pod]], lbs: Dict[str, Pod],
+                    policy: WeightPolicy = None,
+                    resolution: int = default_resolution) -> Dict[Tuple[str, str], Dict]:
+    """
+    Computes the weight tables of all functions and zones.
+    Each zone that hosts a function balances between its pods and the load balancers of the other zones that host the
+    function. Zones without pods forward all requests to the zones that host the function.
+    :param pods_per_cluster: a dict, that contains a List of Pods for each Tuple[function, cluster]
+    :param lbs: a dict, keyed by cluster and containing the associated load balancer pod
+    :param policy: decides the weight of each target, defaults to `RoundRobinPolicy`
+    :param resolution: see `to_int_weights`
+    :return: weight tables by (zone, function)
+    """
+    if policy is None:
+        policy = RoundRobinPolicy()
+
+    # zones that host each function, built once instead of scanning all zones per key
+    zones_by_fn: Dict[str, List[str]] = defaultdict(list)
+    for (fn, zone), pods in pods_per_cluster.items():
+        if len(pods) > 0:
+            zones_by_fn[fn].append(zone)
+
+    def remote_targets(fn: str, zone: str) -> List[Tuple[Pod, float]]:
+        return [(lbs[other], policy.zone_weight(fn, lbs[other], pods_per_cluster[(fn, other)]))
+                for other in zones_by_fn[fn] if other != zone and other in lbs]
+
+    tables = {}
+    for (fn, zone), pods in pods_per_cluster.items():
+        targets = [(pod, policy.pod_weight(fn, pod)) for pod in pods]
+        tables[(zone, fn)] = weight_table(targets + remote_targets(fn, zone), resolution)
+
+    # zones that do not host any instance re-route to the others
+    for fn in {fn for fn, _ in pods_per_cluster.keys()}:
+        for zone in lbs.keys():
+            if (fn, zone) in pods_per_cluster:
+                continue
+            tables[(zone, fn)] = weight_table(remote_targets(fn, zone), resolution)
+
+    return tables
+
+
+def experiment_throughput(db: ExperimentDatabase, exp_id: str) -> Tuple[str, str, float]:
+    """
+    Reads the throughput of a profiling experiment: the number of successful requests divided by the time between the
+    first request being sent and the last response.
+    :return: function, profiled host and throughput in requests per second
+    """
+    metadata = db.get_metadata(exp_id)
+    fn = metadata['exp']['app_name']
+    host = metadata['exp']['host']
+    traces = [t for t in db.get_traces(exp_id) if t.status == 200 and t.sent > 0 and t.done > 0]
+    if len(traces) == 0:
+        return fn, host, 0
+    duration = max(t.done for t in traces) - min(t.sent for t in traces)
+    return fn, host, len(traces) / duration if duration > 0 else 0
+
+
+def capacities_from_experiments(db: ExperimentDatabase, exp_ids: Iterable[str]) -> Dict[Tuple[str, str], float]:
+    """
+    Derives capacities for `CapacityPolicy` from profiling experiments: the highest throughput observed for a function
+    on a host.
+    :return: capacity by (function, host)
+    """
+    capacities = {}
+    for exp_id in exp_ids:
+        fn, host, throughput = experiment_throughput(db, exp_id)
+        logger.info(f'Experiment {exp_id}: {fn} on {host} served {throughput:.2f} req/s')
+        capacities[(fn, host)] = max(throughput, capacities.get((fn, host), 0))
+    return capacities